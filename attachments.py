@@ -0,0 +1,240 @@
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from prompt_input import BINARY_CHECK_SIZE, load_file_attachment
+from response_cache import ResponseCache, resolve_cache_directory
+
+DEFAULT_ATTACH_OPTIONS = {
+    "chunk_tokens": 4000,                    # 每个分块最多的 Token 数
+    "workers": 4,                            # 同时处理的分块数
+    "cache_directory": "attachment_cache",   # 分块结果的内容寻址缓存
+    "cache_megabytes": 200,
+}
+MAP_PROMPT = (
+    "You are reading one part of a larger file to help answer a question. "
+    "Extract everything in this part that is relevant to the question, keeping exact names, numbers and short quotes. "
+    "If nothing in this part is relevant, reply with only NONE.\n\n"
+    "Question: {question}\n\nPart of the file:\n{text}"
+)
+REDUCE_PROMPT = (
+    "Combine these notes taken from consecutive parts of a file into one set of notes for the question. "
+    "Keep every relevant detail and drop repetition.\n\nQuestion: {question}\n\n{notes}"
+)
+FINAL_PROMPT = (
+    "{question}\n\n"
+    "The file `{name}` was too large to send at once, so it was read in {parts} parts. "
+    "Notes taken from the parts, in order:\n\n{notes}"
+)
+DEFAULT_QUESTION = "Summarize this file."
+NO_NOTES = "NONE"
+# 等待分块结果时检查是否已取消的间隔秒数
+CANCEL_POLL_SECONDS = 0.1
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_attach_options(config):
+    """合并 config.json 中的 "attach" 配置和默认值。"""
+    options = dict(DEFAULT_ATTACH_OPTIONS)
+    options.update(config.get("attach") or {})
+    return options
+
+
+def get_attachment_cache(options):
+    """获取进程内共享的分块结果缓存（与响应缓存分开，不受 "response_cache" 开关影响）。"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(resolve_cache_directory(options["cache_directory"]),
+                                   int(options["cache_megabytes"] * 1024 * 1024))
+        return _cache
+
+
+def iter_token_chunks(path, max_tokens, count_text):
+    """流式读取文本文件，按行切成不超过 max_tokens 个 Token 的分块，超长的行按字符再切分。
+
+    Raises:
+        OSError: 文件无法读取。
+        ValueError: 文件看起来是二进制文件。
+    """
+    with open(path, "rb") as f:
+        if b"\0" in f.read(BINARY_CHECK_SIZE):
+            raise ValueError(f"{path} looks like a binary file.")
+    lines, used = [], 0
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            tokens = count_text(line)
+            while tokens > max_tokens:
+                # 按比例估算能放下的字符数，至少前进一个字符
+                if lines:
+                    yield "".join(lines)
+                    lines, used = [], 0
+                cut = max(1, len(line) * max_tokens // tokens)
+                yield line[:cut]
+                line = line[cut:]
+                tokens = count_text(line)
+            if used + tokens > max_tokens and lines:
+                yield "".join(lines)
+                lines, used = [], 0
+            lines.append(line)
+            used += tokens
+    if lines:
+        yield "".join(lines)
+
+
+class AttachmentReader:
+    """--attach 的 map-reduce：分块并发提取与问题相关的内容，再把结果合并为一条提示。
+
+    每个分块由 ChatGPT.complete 发出一次无状态的请求，结果按请求内容缓存，
+    同一个文件再次提问时只处理变化了的分块。分块的 Token 用量通过 defer_usage 计入下一轮对话。
+    """
+
+    def __init__(self, bot, options):
+        self.bot = bot
+        self.options = options
+        self.cache = get_attachment_cache(options)
+        self.parts = 0
+        self.cached = 0
+        self.lock = threading.Lock()
+        self.executors = []  # 取消后仍可能有进行中的分块，join 等待它们结束
+
+    def _complete(self, prompt):
+        content, token_usage = self.bot.complete([{"role": "user", "content": prompt}], cache=self.cache)
+        if token_usage.get("response_cache_hit"):
+            with self.lock:
+                self.cached += 1
+        else:
+            self.bot.defer_usage(token_usage)
+        # 被内容过滤等原因拦截的响应没有内容，视为这一部分没有相关内容
+        return (content or "").strip()
+
+    def _executor(self, workers):
+        executor = ThreadPoolExecutor(max_workers=workers)
+        with self.lock:
+            self.executors.append(executor)
+        return executor
+
+    def join(self):
+        """等待取消时仍在进行的分块请求结束（它们之后不会再写缓存或计入用量）。"""
+        with self.lock:
+            executors, self.executors = self.executors, []
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    def read(self, path, question, cancelled=None, on_progress=None):
+        """读取文件并生成最终发送的提示。
+
+        Args:
+            cancelled (callable): 返回 True 时不再处理剩下的分块，read 返回 None。
+            on_progress (callable): 每完成一个分块以 (已完成数, 已提交数) 调用。
+
+        Returns:
+            str: 最终提示，文件只有一个分块时直接附带全文。
+        """
+        question = question or DEFAULT_QUESTION
+        chunks = iter_token_chunks(path, self.options["chunk_tokens"], self.bot.context_window.count_text)
+        first = next(chunks, None)
+        second = next(chunks, None)
+        if second is None:
+            block, _ = load_file_attachment(path, os.path.getsize(path) + 1)
+            return f"{question}\n\n{block}"
+
+        workers = max(1, self.options["workers"])
+        # 限制已读入但还没处理的分块数，大文件不会整个读入内存
+        slots = threading.BoundedSemaphore(workers * 2)
+        done = [0]
+
+        def process(text):
+            try:
+                return self._complete(MAP_PROMPT.format(question=question, text=text))
+            finally:
+                slots.release()
+                with self.lock:
+                    done[0] += 1
+                    finished = done[0]
+                if on_progress:
+                    on_progress(finished, self.parts)
+
+        def acquire_slot():
+            while not slots.acquire(timeout=CANCEL_POLL_SECONDS):
+                if cancelled and cancelled():
+                    return False
+            return True
+
+        futures = []
+        # 取消时不再启动排队中的分块，也不等待进行中的请求（它们的用量仍会通过 defer_usage 计入）
+        executor = self._executor(workers)
+        try:
+            for text in itertools.chain([first, second], chunks):
+                if not acquire_slot():
+                    return None
+                if cancelled and cancelled():
+                    return None
+                self.parts += 1
+                futures.append(executor.submit(process, text))
+            if not wait_all(futures, cancelled):
+                return None
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        # 笔记为 (第一个分块, 最后一个分块, 内容)
+        notes = [(index, index, future.result()) for index, future in enumerate(futures, start=1)]
+        notes = [note for note in notes if note[2] and note[2].upper() != NO_NOTES]
+        notes = self.reduce(notes, question, cancelled)
+        if notes is None:
+            return None
+        text = "\n\n".join(format_note(note) for note in notes)
+        return FINAL_PROMPT.format(question=question, name=os.path.basename(path), parts=self.parts,
+                                   notes=text or "(No part of the file was relevant to the question.)")
+
+    def reduce(self, notes, question, cancelled=None):
+        """笔记总量超过一个分块时，把相邻的笔记分组合并，直到能放进一次请求。"""
+        count_text = self.bot.context_window.count_text
+        budget = self.options["chunk_tokens"]
+
+        def merge(group):
+            if len(group) == 1:
+                return group[0]
+            text = "\n\n".join(format_note(note) for note in group)
+            return group[0][0], group[-1][1], self._complete(REDUCE_PROMPT.format(question=question, notes=text))
+
+        while len(notes) > 1 and sum(count_text(note[2]) for note in notes) > budget:
+            if cancelled and cancelled():
+                return None
+            groups, group, used = [], [], 0
+            for note in notes:
+                tokens = count_text(note[2])
+                if group and used + tokens > budget:
+                    groups.append(group)
+                    group, used = [], 0
+                group.append(note)
+                used += tokens
+            groups.append(group)
+            if len(groups) == len(notes):
+                # 每条笔记本身就超出预算，无法再合并
+                break
+            executor = self._executor(max(1, self.options["workers"]))
+            try:
+                futures = [executor.submit(merge, group) for group in groups]
+                if not wait_all(futures, cancelled):
+                    return None
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+            notes = [future.result() for future in futures]
+        return notes
+
+
+def wait_all(futures, cancelled=None):
+    """等待所有任务完成；cancelled() 返回 True 时立即返回 False。"""
+    pending = set(futures)
+    while pending:
+        _, pending = wait(pending, timeout=CANCEL_POLL_SECONDS)
+        if pending and cancelled and cancelled():
+            return False
+    return True
+
+
+def format_note(note):
+    first, last, text = note
+    label = f"Part {first}" if first == last else f"Parts {first}-{last}"
+    return f"### {label}\n{text}"
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import os
+import time
+from openai_client import get_async_client, close_async_client
+from scheduler import get_scheduler
+from chatgpt import ChatGPT
+from utils import calculate_cost
+
+BATCH_API_URL = "/v1/chat/completions"
+
+
+def read_batch_items(file_path):
+    """逐行读取批处理文件，不把整个文件载入内存。
+
+    每行是一个 JSON 对象，支持的字段：
+        id / custom_id: 请求编号（缺省时使用行号）；
+        prompt: 用户输入，或 messages: 完整的消息列表（最后一条为用户消息）；
+        system: 可选的系统提示；model: 可选，覆盖 config.json 中的模型。
+
+    Yields:
+        tuple: (请求编号, 请求内容, 错误)。格式有误的行不会中断整个批处理，
+            请求内容为 None，错误为说明原因的字符串；正常的行错误为 None。
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            item = None
+            try:
+                item = json.loads(line)
+                if isinstance(item, str):
+                    item = {"prompt": item}
+                if not isinstance(item, dict):
+                    raise ValueError("expected a JSON object or string")
+                item_messages(item)
+            except ValueError as e:
+                item_id = (item.get("id") or item.get("custom_id")) if isinstance(item, dict) else None
+                yield str(item_id or line_number), None, f"Line {line_number}: {e}"
+                continue
+            item_id = item.get("id") or item.get("custom_id") or line_number
+            yield str(item_id), item, None
+
+
+def item_messages(item):
+    """把一条批处理请求转换为消息列表。
+
+    Raises:
+        ValueError: 请求中没有 prompt 或 messages，或者消息缺少 role、content。
+    """
+    if item.get("messages"):
+        try:
+            return [{"role": m["role"], "content": m["content"]} for m in item["messages"]]
+        except (KeyError, TypeError):
+            raise ValueError('every message needs "role" and "content"') from None
+    if "prompt" not in item:
+        raise ValueError('expected "prompt" or "messages"')
+    messages = []
+    if item.get("system"):
+        messages.append({"role": "system", "content": item["system"]})
+    messages.append({"role": "user", "content": item["prompt"]})
+    return messages
+
+
+def load_completed_ids(output_path):
+    """读取已有的结果文件，返回已成功完成的请求编号，用于中断后续跑。"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # 中断时可能留下不完整的最后一行
+                continue
+            # 不是本程序写出的结果行（没有 id）同样跳过
+            if isinstance(result, dict) and result.get("status") == "ok" and result.get("id") is not None:
+                completed.add(result["id"])
+    return completed
+
+
+def write_batch_api_file(input_path, output_path, model):
+    """把批处理文件转换为 OpenAI Batch API 的离线请求文件格式。
+
+    Returns:
+        int: 写入的请求数量。
+    """
+    count = 0
+    with open(output_path, "w", encoding="utf-8") as out:
+        for item_id, item, error in read_batch_items(input_path):
+            if error:
+                print(f"Skipped {error}")
+                continue
+            request = {
+                "custom_id": item_id,
+                "method": "POST",
+                "url": BATCH_API_URL,
+                "body": {"model": item.get("model") or model, "messages": item_messages(item)},
+            }
+            out.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+class BatchRunner:
+    """非交互式批处理：以有限的并发数运行提示文件中的请求，结果按完成顺序写入 JSONL。
+
+    每个请求使用独立的 ChatGPT 实例，因此有自己的日志和 Token 统计；
+    所有请求共享一个异步客户端。已成功的请求在重新运行时会被跳过。
+    """
+
+    def __init__(self, config, input_path, output_path, workers):
+        self.config = config
+        self.input_path = input_path
+        self.output_path = output_path
+        self.workers = max(1, workers)
+        self.succeeded = 0
+        self.failed = 0
+        self.total_token_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    async def run(self):
+        completed = load_completed_ids(self.output_path)
+        if completed:
+            print(f"Resuming: {len(completed)} requests already completed in {self.output_path}")
+        client = get_async_client(self.config)
+        semaphore = asyncio.Semaphore(self.workers)
+        tasks = set()
+        try:
+            with open(self.output_path, "a", encoding="utf-8") as out:
+                for item_id, item, error in read_batch_items(self.input_path):
+                    if item_id in completed:
+                        continue
+                    if error:
+                        self.write_result(out, {"id": item_id, "status": "error", "error": error}, 0)
+                        continue
+                    # 同时进行的请求数不超过 workers，输入文件按需读取
+                    await semaphore.acquire()
+                    task = asyncio.create_task(self.run_item(client, item_id, item, out))
+                    task.add_done_callback(lambda _: semaphore.release())
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks)
+        finally:
+            await close_async_client()
+        cost = calculate_cost(self.total_token_usage, self.config["pricing"])
+        print(f"Batch finished: {self.succeeded} succeeded, {self.failed} failed. "
+              f"Token Usage: {self.total_token_usage}, Cost: ${cost:.6f}")
+        key_pool = get_scheduler(self.config).key_pool
+        if len(key_pool.keys) > 1:
+            for stats in key_pool.stats():
+                print(f"  {stats['name']}: {stats['requests']} requests, {stats['tokens']} tokens, "
+                      f"{stats['rate_limited']} rate limited, {stats['status']}")
+
+    async def run_item(self, client, item_id, item, out):
+        bot = ChatGPT(model=item.get("model"))
+        bot.stream = False
+        messages = item_messages(item)
+        # 系统提示和之前的对话也写入日志，日志中是完整的请求
+        for message in messages[:-1]:
+            bot.messages.append(message)
+            bot.append_to_log(new_message=message)
+        start_time = time.perf_counter()
+        content, token_usage = await bot.achat(client, messages[-1]["content"])
+        latency = time.perf_counter() - start_time
+        # 关闭日志要等待写入线程，不阻塞事件循环
+        await asyncio.to_thread(bot.close_log)
+
+        result = {"id": item_id, "status": "ok" if content is not None else "error", "log_file": bot.log_file_name}
+        if content is not None:
+            for key in self.total_token_usage:
+                self.total_token_usage[key] += token_usage.get(key, 0)
+            result.update({
+                "model": bot.model,
+                "content": content,
+                "token_usage": token_usage,
+                "cost": calculate_cost(token_usage, self.config["pricing"]),
+                "latency": round(latency, 3),
+            })
+        else:
+            result["error"] = bot.last_error or "No response from the API."
+        self.write_result(out, result, latency)
+
+    def write_result(self, out, result, latency):
+        if result["status"] == "ok":
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+        error = f": {result['error']}" if result.get("error") else ""
+        print(f"[{result['id']}] {result['status']} ({latency:.1f}s){error}")
+
+
+def run_batch(config, input_path, output_path=None, workers=None, batch_api_file=None):
+    """运行批处理；指定 batch_api_file 时只生成 Batch API 文件，不调用 API。"""
+    if batch_api_file:
+        count = write_batch_api_file(input_path, batch_api_file, config["model"])
+        print(f"Wrote {count} requests to {batch_api_file} for the OpenAI Batch API.")
+        return
+    if output_path is None:
+        output_path = os.path.splitext(input_path)[0] + ".results.jsonl"
+    workers = workers or config.get("batch_workers", 4)
+    asyncio.run(BatchRunner(config, input_path, output_path, workers).run())
@@ -0,0 +1,281 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from log_writer import format_log_header
+from mock_server import MockCompletionServer
+from session_records import sidecar_paths, write_records
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, q):
+    """最近秩法求百分位数，sorted_values 需已排序。"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(q / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def summarize(name, samples, elapsed, unit_count=None):
+    """汇总一组耗时样本（秒）：百分位数（毫秒）和吞吐量（每秒次数）。"""
+    values = sorted(samples)
+    result = {
+        "name": name,
+        "count": len(values),
+        "mean_ms": statistics.fmean(values) * 1000 if values else 0.0,
+        "throughput": (unit_count or len(values)) / elapsed if elapsed else 0.0,
+    }
+    for q in PERCENTILES:
+        result[f"p{q}_ms"] = percentile(values, q) * 1000
+    return result
+
+
+def timed(call, repeat):
+    """运行 call repeat 次，返回 (每次耗时, 总耗时)。"""
+    samples = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call_start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - call_start)
+    return samples, time.perf_counter() - start
+
+
+def synthetic_turns(turns, turn_chars):
+    """生成一问一答的合成消息，助手消息带一段代码，模拟真实日志。"""
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"Question {i}: " + "q" * max(0, turn_chars // 4)})
+        body = "a" * max(0, turn_chars - 40)
+        messages.append({"role": "assistant", "content": f"Answer {i}\n```python\n    print({i})\n```\n{body}"})
+    return messages
+
+
+def write_synthetic_log(path, started_at, model, pricing, messages, sidecar=True):
+    """直接写出一个与 ChatLogWriter 格式相同的日志（以及结构化记录）。"""
+    usage = {"prompt_tokens": 1000, "cached_tokens": 200, "completion_tokens": 500}
+    parts = [format_log_header(started_at, model, usage, pricing)]
+    for message in messages:
+        parts.append(f"## {message['role'].capitalize()}\n{message['content']}\n\n")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(parts))
+    if sidecar:
+        write_records(path, messages)
+
+
+def generate_chat_logs(directory, files, turns, turn_chars, pricing, models=("gpt-4o", "o1-preview")):
+    """生成 files 个合成日志，日期分布在最近一年内。"""
+    os.makedirs(directory, exist_ok=True)
+    messages = synthetic_turns(turns, turn_chars)
+    start = datetime(2024, 1, 1)
+    for i in range(files):
+        started_at = start + timedelta(minutes=53 * i)
+        name = f"chat_{started_at.strftime('%Y%m%d_%H%M%S')}_{i}.md"
+        write_synthetic_log(os.path.join(directory, name), started_at, models[i % len(models)], pricing, messages)
+
+
+class BenchmarkSuite:
+    """各个热点路径的基准测试，全部在本地运行，请求发往模拟的 completions 服务。"""
+
+    def __init__(self, work_dir, args):
+        self.work_dir = work_dir
+        self.args = args
+        self.pricing = [0.000015, 0.0000075, 0.00006]
+        self.results = []
+
+    def write_config(self, base_url, stream):
+        config = {
+            "api_key": "mock-key",
+            "model": "mock-model",
+            "base_url": base_url,
+            "output_directory": os.path.join(self.work_dir, "session_logs"),
+            "stream": stream,
+            "context_budget": self.args.context_budget,
+            "response_cache": {"enabled": False},
+            "rate_limits": {"max_retries": 0},
+            "log_flush_policy": "write",
+            "pricing": self.pricing,
+        }
+        path = os.path.join(self.work_dir, f"config_{'stream' if stream else 'plain'}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+        return path
+
+    def record(self, result):
+        self.results.append(result)
+        print(f"  {result['name']}: p50 {result['p50_ms']:.2f} ms, p95 {result['p95_ms']:.2f} ms, "
+              f"{result['throughput']:.1f}/s")
+
+    def bench_chat(self, base_url):
+        from chatgpt import ChatGPT
+        for stream in (False, True):
+            bot = ChatGPT(config_file=self.write_config(base_url, stream))
+            ttfts = []
+
+            def call():
+                content, _ = bot.chat("Benchmark prompt " + "x" * self.args.prompt_chars, use_cache=False)
+                if content is None:
+                    raise RuntimeError("The mock server request failed.")
+                if bot.last_ttft is not None:
+                    ttfts.append(bot.last_ttft)
+
+            samples, elapsed = timed(call, self.args.requests)
+            bot.close_log()
+            name = "chat (stream)" if stream else "chat"
+            self.record(summarize(name, samples, elapsed))
+            if ttfts:
+                self.record(summarize("chat time to first token", ttfts, elapsed))
+
+    def bench_append_to_log(self):
+        from chatgpt import ChatGPT
+        bot = ChatGPT(config_file=self.write_config(None, False))
+        messages = synthetic_turns(self.args.session_turns, self.args.turn_chars)
+        index = iter(range(len(messages)))
+        usage = {"prompt_tokens": 10, "cached_tokens": 0, "completion_tokens": 10}
+
+        def call():
+            bot.append_to_log(usage, messages[next(index)])
+
+        start = time.perf_counter()
+        samples, _ = timed(call, len(messages))
+        bot.close_log()
+        # 日志在后台线程中写入，吞吐量按全部写完（包括关闭文件）计算
+        self.record(summarize("append_to_log", samples, time.perf_counter() - start))
+
+    def bench_load_chat_history(self):
+        from context_window import ContextWindow
+        from utils import load_chat_history
+        path = os.path.join(self.work_dir, "long_session.md")
+        messages = synthetic_turns(self.args.session_turns, self.args.turn_chars)
+        write_synthetic_log(path, datetime.now(), "mock-model", self.pricing, messages)
+        window = ContextWindow("mock-model", self.args.context_budget)
+
+        def load_tail():
+            load_chat_history(path, {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0},
+                              window.budget, window.count)
+
+        samples, elapsed = timed(load_tail, self.args.repeat)
+        self.record(summarize(f"load_chat_history ({self.args.session_turns} turns, tail)", samples, elapsed))
+
+        def load_markdown():
+            for sidecar in sidecar_paths(path):
+                if os.path.exists(sidecar):
+                    os.remove(sidecar)
+            load_chat_history(path, {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+
+        samples, elapsed = timed(load_markdown, self.args.repeat)
+        self.record(summarize(f"load_chat_history ({self.args.session_turns} turns, markdown + migration)", samples, elapsed))
+
+    def bench_calculate_total_cost(self):
+        from usage_ledger import LEDGER_FILE
+        from utils import calculate_total_cost
+        log_dir = os.path.join(self.work_dir, "chat_logs")
+        print(f"  generating {self.args.log_files} synthetic logs...")
+        generate_chat_logs(log_dir, self.args.log_files, self.args.log_turns, self.args.turn_chars, self.pricing)
+
+        def cold():
+            ledger = os.path.join(log_dir, LEDGER_FILE)
+            if os.path.exists(ledger):
+                os.remove(ledger)
+            calculate_total_cost(log_dir)
+
+        samples, elapsed = timed(cold, 1)
+        self.record(summarize(f"calculate_total_cost ({self.args.log_files} files, cold)", samples, elapsed,
+                              self.args.log_files))
+        samples, elapsed = timed(lambda: calculate_total_cost(log_dir), self.args.repeat)
+        self.record(summarize(f"calculate_total_cost ({self.args.log_files} files, warm)", samples, elapsed))
+        samples, elapsed = timed(lambda: calculate_total_cost(log_dir, group_by="day"), self.args.repeat)
+        self.record(summarize("calculate_total_cost (by day, warm)", samples, elapsed))
+
+    def run(self, only=None):
+        server = MockCompletionServer(
+            latency=self.args.latency, tokens=self.args.tokens, tokens_per_second=self.args.tokens_per_second,
+            replay_path=self.args.replay
+        )
+        base_url = server.start()
+        benches = {
+            "chat": lambda: self.bench_chat(base_url),
+            "append_to_log": self.bench_append_to_log,
+            "load_chat_history": self.bench_load_chat_history,
+            "calculate_total_cost": self.bench_calculate_total_cost,
+        }
+        try:
+            for name, bench in benches.items():
+                if only and name not in only:
+                    continue
+                print(f"{name}:")
+                bench()
+        finally:
+            server.close()
+        return self.results
+
+
+def print_results(results, baseline=None):
+    """打印结果表；提供上一次的结果时显示 p50/p95 的变化。"""
+    from rich.console import Console
+    from rich.table import Table
+    previous = {r["name"]: r for r in (baseline or [])}
+    table = Table(show_header=True, header_style="bold magenta")
+    for column in ("Benchmark", "Count", "p50 (ms)", "p95 (ms)", "p99 (ms)", "Throughput (/s)", "Change p50/p95"):
+        table.add_column(column)
+    for r in results:
+        change = ""
+        old = previous.get(r["name"])
+        if old and old["p50_ms"] and old["p95_ms"]:
+            change = (f"{(r['p50_ms'] / old['p50_ms'] - 1) * 100:+.1f}% / "
+                      f"{(r['p95_ms'] / old['p95_ms'] - 1) * 100:+.1f}%")
+        table.add_row(r["name"], str(r["count"]), f"{r['p50_ms']:.2f}", f"{r['p95_ms']:.2f}",
+                      f"{r['p99_ms']:.2f}", f"{r['throughput']:.1f}", change)
+    Console().print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the hot paths of ChatGPT CLI")
+    parser.add_argument("--only", nargs="+", choices=("chat", "append_to_log", "load_chat_history",
+                                                      "calculate_total_cost"))
+    parser.add_argument("--requests", type=int, default=100, help="Requests per chat benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock server latency in seconds")
+    parser.add_argument("--tokens", type=int, default=200, help="Output tokens per mock response")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Mock streaming speed (0 = unlimited)")
+    parser.add_argument("--prompt-chars", type=int, default=200)
+    parser.add_argument("--replay", help="Answer chat requests from a mock_server.py --record file")
+    parser.add_argument("--log-files", type=int, default=10000, help="Synthetic chat logs to generate")
+    parser.add_argument("--log-turns", type=int, default=5, help="Turns per synthetic chat log")
+    parser.add_argument("--session-turns", type=int, default=1000, help="Turns in the long session")
+    parser.add_argument("--turn-chars", type=int, default=400)
+    parser.add_argument("--context-budget", type=int, default=96000)
+    parser.add_argument("--repeat", type=int, default=10, help="Repetitions of the file benchmarks")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Show changes against a previous --output file")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated files")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="chatgpt_cli_bench_")
+    try:
+        results = BenchmarkSuite(work_dir, args).run(args.only)
+    finally:
+        if args.keep:
+            print(f"Generated files kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"time": datetime.now().isoformat(timespec="seconds"), "args": vars(args),
+                       "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,756 @@
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from openai_client import get_client, keyed_client
+from context_window import ContextWindow
+from response_cache import get_response_cache, make_cache_key
+from scheduler import get_scheduler
+from metrics import SessionMetrics, load_all_metrics, load_metrics, metrics_path, save_metrics
+from search_index import get_search_index
+from log_writer import ChatLogWriter, claim_log_file_name
+from hedging import HedgePolicy, arun_hedged, get_hedging_options, run_hedged
+from key_pool import current_api_key
+from semantic_memory import format_memory, get_memory_options, get_semantic_memory, text_digest
+from utils import load_config, load_chat_history, resolve_log_path, get_log_directory
+
+
+class RequestCancelled(Exception):
+    """请求所在的一轮已被取消。"""
+
+
+class ChatGPT:
+    def __init__(self, config_file="config.json", model=None):
+        """初始化 ChatGPT 实例，model 为空时使用 config.json 中的模型。"""
+        self.config = load_config(config_file)
+        self.model = model or self.config["model"]
+        self.stream = self.config.get("stream", False)
+        self.response_cache = get_response_cache(self.config)
+        self.scheduler = get_scheduler(self.config)
+        self.context_window = ContextWindow(
+            self.model, self.config.get("context_budget"), self.config.get("context_trim_ratio", 0.75)
+        )
+        self.last_ttft = None  # 最近一次请求的首 token 延迟（秒）
+        self.last_error = None  # 最近一次请求失败的原因
+        self.messages = []
+        self.pending_user_message = None
+        self.turn_lock = threading.RLock()
+        self.turn_count = 0
+        self.active_turn = None  # 进行中的一轮的编号
+        self.session_start_time = datetime.now()
+        self.log_file_name = self.generate_log_file_name()
+        self.log_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self.resumed = False  # 是否继续写入一个已有的日志
+        self.metrics = SessionMetrics()
+        self.stats_lock = threading.Lock()
+        hedging_options = get_hedging_options(self.config)
+        self.hedge = HedgePolicy(hedging_options, get_log_directory(self.config)) if hedging_options else None
+        # 语义记忆：请求前从旧会话中找出相关片段（索引在第一次使用时才加载）
+        self.memory_options = get_memory_options(self.config)
+        self.memory_enabled = self.memory_options["enabled"]
+        # 输掉的对冲请求的 Token 使用量，计入下一次返回的使用数据
+        self.discarded_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+        # 创建输出目录
+        output_dir = self.config["output_directory"]
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        self.log_writer = self.create_log_writer()
+
+    @property
+    def client(self):
+        """所有实例共享同一个带连接池的客户端，第一次发送请求时才创建（并导入 openai）。
+
+        在调度器中调用时使用调度器为本次请求选出的 API key。
+        """
+        return keyed_client(get_client(self.config))
+
+    def create_log_writer(self):
+        return ChatLogWriter(
+            self.log_file_name, self.session_start_time, self.model, self.config["pricing"],
+            flush_policy=self.config.get("log_flush_policy", "write"),
+            flush_interval=self.config.get("log_flush_interval", 1.0),
+            fsync=self.config.get("log_fsync", False),
+            on_write=lambda seconds: self.metrics.observe("log_write_seconds", self.model, seconds),
+            on_record=self.on_log_record
+        )
+
+    def on_log_record(self, message, seq):
+        """日志写入线程写入一条结构化记录后调用：更新全文搜索索引和语义记忆。"""
+        if self.config.get("search_index", True):
+            self.index_message(message, seq)
+        if self.memory_enabled:
+            memory = get_semantic_memory(self.config, get_log_directory(self.config), self.defer_usage)
+            if memory is not None:
+                memory.add_message(self.log_file_name, message, seq, self.defer_usage)
+
+    def index_message(self, message, seq):
+        """把写入日志的消息加入全文搜索索引（在日志写入线程中调用）。"""
+        try:
+            get_search_index(get_log_directory(self.config)).add_message(
+                self.log_file_name, self.model, self.session_start_time.strftime("%Y-%m-%d"), message, seq
+            )
+        except sqlite3.Error as e:
+            print(f"Error updating search index: {e}")
+
+    def generate_log_file_name(self):
+        """生成基于会话开始时间的日志文件名，同一秒内打开的多个会话会追加序号。"""
+        timestamp = self.session_start_time.strftime("%Y%m%d_%H%M%S")
+        return claim_log_file_name(self.config['output_directory'], f"chat_{timestamp}")
+
+    def append_to_log(self, token_usage=None, new_message=None, model=None):
+        """
+        更新聊天日志（由后台写入器异步完成）：
+        - 在头部原地更新 Token 消耗统计信息。
+        - 在末尾追加新消息。
+
+        Args:
+            token_usage (dict): 会话累计的 Token 使用数据。
+            new_message (dict): 最新的消息 {"role": str, "content": str}。
+            model (str): 回答这条消息的模型，记录在结构化记录中。
+        """
+        if new_message:
+            role = new_message["role"].capitalize()
+            content = new_message["content"]
+            self.log_writer.append(f"## {role}\n{content}\n\n")
+            self.log_writer.record(new_message, model)
+        if token_usage:
+            self.log_writer.update_usage(token_usage)
+
+    def append_raw_to_log(self, text):
+        """向日志末尾追加原始文本，用于流式响应的增量写入。"""
+        self.log_writer.append(text)
+
+    def add_log_usage(self, token_usage):
+        """累加本次请求的 Token 使用量，并更新日志头部。"""
+        for key in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+            self.log_usage[key] += token_usage.get(key, 0)
+        self.append_to_log(token_usage=self.log_usage)
+
+    def close_log(self):
+        """写完所有待处理的日志并关闭文件，同时保存本会话的性能指标。"""
+        discarded = self.take_discarded_usage()
+        if discarded["total_tokens"]:
+            self.add_log_usage(discarded)
+        self.close_log_writer()
+        if not self.metrics.has_samples() or not os.path.exists(self.log_file_name):
+            return
+        try:
+            save_metrics(self.metrics, metrics_path(self.log_file_name))
+            openmetrics_file = (self.config.get("metrics") or {}).get("openmetrics_file")
+            if openmetrics_file:
+                # 供抓取的文本文件，包含所有会话的指标
+                with open(openmetrics_file, "w", encoding="utf-8") as f:
+                    f.write(load_all_metrics(get_log_directory(self.config)).to_openmetrics())
+        except OSError as e:
+            print(f"Error saving session metrics: {e}")
+
+    def close_log_writer(self):
+        try:
+            self.log_writer.close()
+        except Exception as e:
+            print(f"Error writing log {self.log_file_name}: {e}")
+
+    def report_log_error(self):
+        """报告日志写入线程中上一次失败的写入（如磁盘已满），之后的写入照常进行。"""
+        try:
+            self.log_writer.raise_error()
+        except Exception as e:
+            print(f"Error writing log {self.log_file_name}: {e}")
+
+    def load_history(self, file_name, token_usage):
+        """加载指定的聊天历史，之后的对话继续追加到同一个日志文件中。"""
+        file_path = os.path.join(self.config["output_directory"], file_name)
+        history, header = load_chat_history(
+            file_path, token_usage, self.context_window.budget, self.context_window.count
+        )
+        self.messages = history
+        # 新会话尚未写入任何内容，换成写入原日志的写入器
+        self.close_log_writer()
+        self.log_file_name = resolve_log_path(file_path)
+        if header["started_at"]:
+            try:
+                self.session_start_time = datetime.strptime(header["started_at"], "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                pass
+        self.log_usage = {key: token_usage[key] for key in self.log_usage}
+        previous_metrics = load_metrics(metrics_path(self.log_file_name))
+        if previous_metrics is not None:
+            self.metrics.merge(previous_metrics)
+        self.resumed = True
+        self.log_writer = self.create_log_writer()
+
+    def remove_empty_log(self):
+        """会话没有任何内容时删除新建的日志文件，返回是否已删除。继续的旧日志不会被删除。"""
+        if self.resumed or self.has_messages():
+            return False
+        for path in (self.log_file_name, metrics_path(self.log_file_name)):
+            if os.path.exists(path):
+                os.remove(path)
+        return True
+
+    def chat(self, prompt, on_delta=None, use_cache=True):
+        """发送用户输入并获取 AI 响应，同时记录日志。
+
+        Args:
+            prompt (str): 用户输入。
+            on_delta (callable): 流式模式下每收到一段文本时的回调。
+            use_cache (bool): 为 False 时跳过本地响应缓存，强制请求 API。
+
+        Returns:
+            tuple: (响应内容, Token 使用数据)，失败时为 (None, None)。
+        """
+        turn = self.begin_turn(prompt)
+        self.last_error = None
+        response = state = token_usage = None
+        estimated_tokens = 0
+        try:
+            params = self.request_params(stream=self.stream)
+            cache_key = self.cache_key(params)
+            if use_cache:
+                cached = self.lookup_cache(turn, cache_key, on_delta)
+                if cached:
+                    return cached
+            # 经过调度器限流，遇到限流或临时错误时自动退避重试
+            estimated_tokens = self.context_window.last_stats["tokens"]
+            request_start = time.perf_counter()
+            response, hedged_model = self.open_request(params, estimated_tokens)
+            if self.stream:
+                # 流式响应在接收过程中已经写入日志
+                state = self.start_stream(turn, request_start)
+                for chunk in response:
+                    self.handle_stream_chunk(state, chunk, on_delta)
+                content, token_usage = self.end_stream(state)
+            else:
+                # GPT 响应
+                content, token_usage = self.parse_response(response)
+            self.scheduler.settle(estimated_tokens, token_usage["total_tokens"])
+            self.record_request_metrics(time.perf_counter() - request_start, token_usage, hedged_model)
+            token_usage = self.add_discarded_usage(token_usage)
+            self.finish_turn(turn, content, token_usage, logged=self.stream, hedged_model=hedged_model)
+            self.store_cache(cache_key, content, token_usage)
+            return content, token_usage
+
+        except RequestCancelled:
+            close = getattr(response, "close", None)
+            if close:
+                close()
+            self.discard_cancelled(estimated_tokens, state, token_usage)
+            return None, None
+        except Exception as e:
+            print(f"Error during chat: {e}")
+            self.last_error = str(e) or type(e).__name__
+            self.metrics.increment("request_errors", self.model)
+            self.abort_turn(turn)
+            return None, None
+
+    async def achat(self, client, prompt, on_delta=None, use_cache=True):
+        """chat 的异步版本，使用共享的 AsyncOpenAI 客户端。
+
+        Args:
+            client (AsyncOpenAI): 异步客户端。
+            prompt (str): 用户输入。
+            on_delta (callable): 流式模式下每收到一段文本时的回调。
+            use_cache (bool): 为 False 时跳过本地响应缓存，强制请求 API。
+
+        Returns:
+            tuple: (响应内容, Token 使用数据)，失败时为 (None, None)。
+        """
+        import asyncio
+        turn = self.begin_turn(prompt)
+        self.last_error = None
+        response = state = token_usage = None
+        estimated_tokens = 0
+        try:
+            if self.memory_enabled:
+                # 召回时查询的向量化可能需要请求 API，不阻塞事件循环
+                params = await asyncio.to_thread(self.request_params, self.stream)
+            else:
+                params = self.request_params(stream=self.stream)
+            cache_key = self.cache_key(params)
+            if use_cache:
+                cached = self.lookup_cache(turn, cache_key, on_delta)
+                if cached:
+                    return cached
+            estimated_tokens = self.context_window.last_stats["tokens"]
+            request_start = time.perf_counter()
+            response, buffered, hedged_model = await self.aopen_request(client, params, estimated_tokens)
+            if self.stream:
+                state = self.start_stream(turn, request_start)
+                for chunk in buffered:
+                    self.handle_stream_chunk(state, chunk, on_delta)
+                async for chunk in response:
+                    self.handle_stream_chunk(state, chunk, on_delta)
+                content, token_usage = self.end_stream(state)
+            else:
+                content, token_usage = self.parse_response(response)
+            self.scheduler.settle(estimated_tokens, token_usage["total_tokens"])
+            self.record_request_metrics(time.perf_counter() - request_start, token_usage, hedged_model)
+            token_usage = self.add_discarded_usage(token_usage)
+            self.finish_turn(turn, content, token_usage, logged=self.stream, hedged_model=hedged_model)
+            self.store_cache(cache_key, content, token_usage)
+            return content, token_usage
+
+        except (RequestCancelled, asyncio.CancelledError) as e:
+            # 任务被取消（引擎的 --cancel）时撤销本轮，然后继续传播 CancelledError
+            self.cancel(turn)
+            close = getattr(response, "close", None) or getattr(response, "aclose", None)
+            if close:
+                await close()
+            self.discard_cancelled(estimated_tokens, state, token_usage)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return None, None
+        except Exception as e:
+            print(f"Error during chat: {e}")
+            self.last_error = str(e) or type(e).__name__
+            self.metrics.increment("request_errors", self.model)
+            self.abort_turn(turn)
+            return None, None
+
+    def count_retry(self):
+        self.metrics.increment("retries", self.model)
+
+    def open_request(self, params, estimated_tokens):
+        """发出请求。启用对冲时，主请求迟迟没有结果或失败后再向同一个或备用模型发出对冲请求，先可用的胜出。
+
+        Returns:
+            tuple: (响应或流式 chunk 的迭代器, 发出过对冲请求时回答的模型，否则为 None)。
+        """
+        delay = self.hedge.delay(self.metrics, self.model, self.stream) if self.hedge else None
+        if delay is None:
+            return self.scheduler.run(
+                lambda: self.client.chat.completions.create(**params), estimated_tokens, self.count_retry
+            ), None
+        models = (self.model, self.hedge.hedge_model(self.model))
+        hedge_sent = []
+
+        def open_attempt(model, cancel):
+            def create():
+                # 另一个请求已经胜出（例如这个请求还在排队或等待重试）时不再发出
+                if cancel.is_set():
+                    raise RequestCancelled()
+                return self.client.chat.completions.create(**dict(params, model=model))
+
+            response = self.scheduler.run(create, estimated_tokens, self.count_retry)
+            # 调度器为这次请求选出的 API key
+            api_key = current_api_key.get()
+            if not self.stream:
+                # 已经发出的非流式请求无法中断，返回后由 discard 统计用量
+                return response, [], response, api_key
+            # 流式请求等到第一段内容才算可用；另一个请求胜出时立即关闭响应，接收随即结束
+            cancel.on_cancel(response.close)
+            iterator = iter(response)
+            buffered = []
+            try:
+                for chunk in iterator:
+                    buffered.append(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        break
+            except Exception:
+                if not cancel.is_set():
+                    raise
+            return response, buffered, iterator, api_key
+
+        def discard(model, result):
+            response, buffered, _, api_key = result
+            if self.stream:
+                response.close()
+                self.discard_attempt(estimated_tokens, buffered, api_key=api_key)
+            else:
+                self.discard_attempt(estimated_tokens, [], response.usage, api_key)
+
+        def on_hedge():
+            hedge_sent.append(True)
+            self.metrics.increment("hedged_requests", self.model)
+
+        index, (response, buffered, iterator, api_key) = run_hedged(open_attempt, models, delay, discard, on_hedge)
+        # 之后的 settle 修正胜出请求所用 key 的用量
+        current_api_key.set(api_key)
+        if index:
+            self.metrics.increment("hedge_wins", models[index])
+        answered_by = models[index] if hedge_sent else None
+        if self.stream:
+            return itertools.chain(buffered, iterator), answered_by
+        return response, answered_by
+
+    async def aopen_request(self, client, params, estimated_tokens):
+        """open_request 的异步版本，输掉的请求被取消。
+
+        Returns:
+            tuple: (响应或流式 chunk 的迭代器, 流式响应中已经收到的 chunk, 发出过对冲请求时回答的模型，否则为 None)。
+        """
+        import asyncio
+        delay = self.hedge.delay(self.metrics, self.model, self.stream) if self.hedge else None
+        if delay is None:
+            response = await self.scheduler.arun(
+                lambda: keyed_client(client).chat.completions.create(**params), estimated_tokens, self.count_retry
+            )
+            return response, [], None
+        models = (self.model, self.hedge.hedge_model(self.model))
+        hedge_sent = []
+
+        async def open_attempt(model):
+            response = await self.scheduler.arun(
+                lambda: keyed_client(client).chat.completions.create(**dict(params, model=model)),
+                estimated_tokens, self.count_retry
+            )
+            api_key = current_api_key.get()
+            if not self.stream:
+                return response, [], response, api_key
+            iterator = response.__aiter__()
+            buffered = []
+            try:
+                async for chunk in iterator:
+                    buffered.append(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        break
+            except asyncio.CancelledError:
+                await response.close()
+                raise
+            return response, buffered, iterator, api_key
+
+        def discard(model, result):
+            if result is None:
+                self.discard_attempt(estimated_tokens, [])
+                return
+            response, buffered, _, api_key = result
+            if self.stream:
+                asyncio.ensure_future(response.close())
+                self.discard_attempt(estimated_tokens, buffered, api_key=api_key)
+            else:
+                self.discard_attempt(estimated_tokens, [], response.usage, api_key)
+
+        def on_hedge():
+            hedge_sent.append(True)
+            self.metrics.increment("hedged_requests", self.model)
+
+        index, (_, buffered, response, api_key) = await arun_hedged(open_attempt, models, delay, discard, on_hedge)
+        current_api_key.set(api_key)
+        if index:
+            self.metrics.increment("hedge_wins", models[index])
+        return response, buffered, models[index] if hedge_sent else None
+
+    def discard_attempt(self, estimated_tokens, received_chunks, usage=None, api_key=None):
+        """记录输掉的对冲请求的用量：完整返回的按实际用量，被取消的按估算的输入 Token 和已收到的输出计。"""
+        if usage is not None:
+            token_usage = self.usage_to_dict(usage)
+        else:
+            text = "".join(chunk.choices[0].delta.content or "" for chunk in received_chunks if chunk.choices)
+            token_usage = self.estimate_usage(estimated_tokens, text)
+        self.scheduler.settle(estimated_tokens, token_usage["total_tokens"], api_key)
+        self.defer_usage(token_usage)
+
+    def discard_cancelled(self, estimated_tokens, state, token_usage):
+        """记录已取消请求的用量：已经收到完整响应的按实际用量，被中断的流式请求按估算计。"""
+        if token_usage is None:
+            text = "".join(state["parts"]) if state else ""
+            token_usage = self.estimate_usage(estimated_tokens, text)
+            self.scheduler.settle(estimated_tokens, token_usage["total_tokens"])
+        self.defer_usage(token_usage)
+
+    def estimate_usage(self, estimated_tokens, received_text):
+        completion_tokens = self.context_window.count_text(received_text) if received_text else 0
+        return {"prompt_tokens": estimated_tokens, "cached_tokens": 0,
+                "completion_tokens": completion_tokens, "total_tokens": estimated_tokens + completion_tokens}
+
+    def defer_usage(self, token_usage):
+        """记录不属于某一轮对话的请求用量（可以从其他线程调用），计入下一次返回的使用数据。"""
+        with self.stats_lock:
+            for key in self.discarded_usage:
+                self.discarded_usage[key] += token_usage.get(key, 0)
+
+    def take_discarded_usage(self):
+        with self.stats_lock:
+            usage = dict(self.discarded_usage)
+            for key in self.discarded_usage:
+                self.discarded_usage[key] = 0
+        return usage
+
+    def add_discarded_usage(self, token_usage):
+        """把输掉的对冲请求、已取消请求和附件分块请求的用量加到本次请求的使用数据中（非流式的同步请求无法中断，会在之后的某次请求中计入）。"""
+        discarded = self.take_discarded_usage()
+        if not discarded["total_tokens"]:
+            return token_usage
+        return {key: token_usage.get(key, 0) + discarded.get(key, 0) for key in
+                ("prompt_tokens", "cached_tokens", "completion_tokens", "total_tokens")}
+
+    def record_request_metrics(self, latency, token_usage, model=None):
+        """记录一次请求的延迟、首 token 延迟和输出速度（model 为回答的模型，默认是当前模型）。"""
+        model = model or self.model
+        self.metrics.increment("requests", model)
+        self.metrics.observe("request_latency_seconds", model, latency)
+        ttft = self.last_ttft if self.stream else None
+        self.metrics.observe("time_to_first_token_seconds", model, ttft)
+        generation_time = latency - (ttft or 0)
+        if token_usage["completion_tokens"] and generation_time > 0:
+            self.metrics.observe("output_tokens_per_second", model,
+                                 token_usage["completion_tokens"] / generation_time)
+
+    def cache_key(self, params):
+        """计算本次请求的响应缓存键，未启用缓存时返回 None。"""
+        return make_cache_key(params) if self.response_cache else None
+
+    def lookup_cache(self, turn, cache_key, on_delta=None):
+        """命中本地响应缓存时直接完成本轮对话，返回 (响应内容, Token 使用数据)；未命中返回 None。"""
+        if cache_key is None:
+            return None
+        entry = self.response_cache.get(cache_key)
+        if entry is None:
+            return None
+        content = entry["content"]
+        # 缓存命中不产生 API 费用
+        token_usage = {
+            "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
+            "response_cache_hit": True
+        }
+        self.last_ttft = 0.0
+        self.metrics.increment("response_cache_hits", self.model)
+        if on_delta:
+            on_delta(content)
+        self.finish_turn(turn, content, token_usage)
+        return content, token_usage
+
+    def store_cache(self, cache_key, content, token_usage):
+        """把新的响应写入本地响应缓存。"""
+        if cache_key is None or content is None:
+            return
+        try:
+            self.response_cache.put(cache_key, {
+                "model": self.model, "content": content, "token_usage": token_usage, "created": time.time()
+            })
+        except OSError as e:
+            print(f"Error writing response cache: {e}")
+
+    def begin_turn(self, prompt):
+        """记录用户输入：加入消息列表，等收到响应后再写入日志，失败的请求不会留在日志中。
+
+        Returns:
+            int: 本轮的编号，之后修改消息列表和日志前都要确认本轮没有被取消。
+        """
+        self.report_log_error()
+        user_message = {"role": "user", "content": prompt}
+        with self.turn_lock:
+            self.turn_count += 1
+            self.active_turn = self.turn_count
+            self.messages.append(user_message)
+            self.pending_user_message = user_message
+            return self.turn_count
+
+    def check_turn(self, turn):
+        """确认本轮仍在进行（调用方持有 turn_lock），已被取消时抛出 RequestCancelled。"""
+        if self.active_turn != turn:
+            raise RequestCancelled()
+
+    def cancel(self, turn=None):
+        """取消进行中的一轮（turn 为空时取消当前一轮）：撤销用户输入和已经写入日志的流式内容。
+
+        可以从其他线程调用；被取消的请求之后不会再修改消息列表和日志。
+
+        Returns:
+            bool: 有请求被取消时返回 True。
+        """
+        with self.turn_lock:
+            if self.active_turn is None or (turn is not None and self.active_turn != turn):
+                return False
+            self.active_turn = None
+            self.discard_pending_user_message()
+            self.log_writer.rollback()
+        self.metrics.increment("requests_cancelled", self.model)
+        return True
+
+    def discard_pending_user_message(self):
+        if self.pending_user_message is not None:
+            if self.messages and self.messages[-1] is self.pending_user_message:
+                self.messages.pop()
+            self.pending_user_message = None
+
+    def log_pending_user_message(self):
+        """把本轮的用户输入写入日志（收到响应时调用）。"""
+        if self.pending_user_message is not None:
+            self.append_to_log(new_message=self.pending_user_message)
+            self.pending_user_message = None
+
+    def abort_turn(self, turn):
+        """请求最终失败时撤销本轮的用户输入和已写入日志的流式内容，使历史记录保持一问一答。"""
+        with self.turn_lock:
+            if self.active_turn != turn:
+                return
+            self.active_turn = None
+            self.discard_pending_user_message()
+            self.log_writer.rollback()
+
+    def finish_turn(self, turn, content, token_usage, logged=False, hedged_model=None):
+        """记录 AI 回答并累加 Token 使用量。
+
+        Args:
+            turn (int): begin_turn 返回的编号，本轮已被取消时抛出 RequestCancelled。
+            content (str): 响应内容。
+            token_usage (dict): 本次请求的 Token 使用数据。
+            logged (bool): 响应内容是否已经（流式）写入日志。
+            hedged_model (str): 发出过对冲请求时实际回答的模型。
+        """
+        with self.turn_lock:
+            self.check_turn(turn)
+            self.active_turn = None
+            # GPT 回答后立即记录日志
+            assistant_message = {"role": "assistant", "content": content}
+            self.messages.append(assistant_message)
+            model = hedged_model or self.model
+            if not logged:
+                self.log_pending_user_message()
+                self.append_to_log(new_message=assistant_message, model=model)
+            else:
+                # 流式输出时 Markdown 已经写入，这里补上两条结构化记录
+                if self.pending_user_message is not None:
+                    self.log_writer.record(self.pending_user_message)
+                    self.pending_user_message = None
+                self.log_writer.record(assistant_message, model)
+                self.log_writer.commit()
+            if hedged_model:
+                self.append_raw_to_log(f"<!-- answered by {hedged_model} (hedged request) -->\n\n")
+            self.add_log_usage(token_usage)
+
+    def request_params(self, stream=False):
+        """构造 chat.completions.create 的请求参数。"""
+        # 只发送预算内的消息
+        messages = self.context_window.select(self.messages)
+        if self.memory_enabled:
+            messages = self.add_memory(messages)
+        params = {"model": self.model, "messages": messages}
+        if stream:
+            params["stream"] = True
+            params["stream_options"] = {"include_usage": True}
+        return params
+
+    def complete(self, messages, cache=None):
+        """无状态的单次请求：不读写消息列表和日志，用于 --attach 的分块处理等内部请求。
+
+        经过调度器限流和重试，并记录性能指标；用量由调用方通过 defer_usage 计入会话。
+
+        Args:
+            messages (list): 完整的消息列表。
+            cache (ResponseCache): 按请求内容缓存结果，为空时使用本地响应缓存（如已启用）。
+
+        Returns:
+            tuple: (响应内容, Token 使用数据)。
+        """
+        params = {"model": self.model, "messages": messages}
+        cache = cache or self.response_cache
+        cache_key = make_cache_key(params) if cache else None
+        entry = cache.get(cache_key) if cache_key else None
+        if entry is not None:
+            return entry["content"], {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                                      "total_tokens": 0, "response_cache_hit": True}
+        estimated_tokens = sum(self.context_window.count(m) for m in messages)
+        request_start = time.perf_counter()
+        response = self.scheduler.run(
+            lambda: self.client.chat.completions.create(**params), estimated_tokens, self.count_retry
+        )
+        content, token_usage = self.parse_response(response)
+        self.scheduler.settle(estimated_tokens, token_usage["total_tokens"])
+        latency = time.perf_counter() - request_start
+        self.metrics.increment("requests", self.model)
+        self.metrics.observe("request_latency_seconds", self.model, latency)
+        if cache_key and content is not None:
+            try:
+                cache.put(cache_key, {"model": self.model, "content": content, "token_usage": token_usage,
+                                      "created": time.time()})
+            except OSError as e:
+                print(f"Error writing response cache: {e}")
+        return content, token_usage
+
+    def add_memory(self, messages):
+        """把语义记忆召回的相关片段加在最新的用户消息前面。
+
+        片段只加在本次请求中，不进入消息列表和日志；已经在上下文中的消息不会被召回。
+        """
+        memory = get_semantic_memory(self.config, get_log_directory(self.config), self.defer_usage)
+        if memory is None or not messages or messages[-1]["role"] != "user":
+            return messages
+        # 向量化请求的用量与附件分块一样推迟计入
+        memory.refresh_in_background(self.defer_usage)
+        try:
+            results = memory.recall(messages[-1]["content"],
+                                    exclude_digests={text_digest(m["content"]) for m in messages if m["content"]},
+                                    on_usage=self.defer_usage)
+        except Exception as e:
+            print(f"Error recalling memory: {e}")
+            return messages
+        content, recalled = format_memory(results, self.context_window.count_text, self.memory_options["max_tokens"])
+        if content is None:
+            return messages
+        # 合并到本轮的用户消息中，不产生连续两条 user 消息；不支持系统消息的模型（如 o1）也可以使用
+        user_message = messages[-1]
+        merged = dict(user_message, content=f"{content}\n\n---\n\n{user_message['content']}")
+        stats = self.context_window.last_stats
+        stats["tokens"] += self.context_window.count(merged) - self.context_window.count(user_message)
+        stats["recalled"] = recalled
+        return messages[:-1] + [merged]
+
+    @staticmethod
+    def parse_response(response):
+        """从非流式响应中提取内容和 Token 使用数据。"""
+        content = response.choices[0].message.content
+        return content, ChatGPT.usage_to_dict(response.usage)
+
+    @staticmethod
+    def usage_to_dict(usage):
+        """把响应中的 usage 转换为 Token 使用数据，包括命中服务端前缀缓存的 Token 数。"""
+        if usage is None:
+            return {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        return {
+            "prompt_tokens": usage.prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens
+        }
+
+    def start_stream(self, turn, start_time=None):
+        """开始接收流式响应：写入用户输入和助手标题并开始计时（start_time 为发出请求的时间）。
+
+        日志中先设置检查点，请求被取消或中途失败时截断到这里；结构化记录在本轮完成时才写入。
+        """
+        with self.turn_lock:
+            self.check_turn(turn)
+            self.last_ttft = None
+            self.log_writer.checkpoint()
+            if self.pending_user_message is not None:
+                self.log_writer.append(f"## User\n{self.pending_user_message['content']}\n\n")
+            self.append_raw_to_log("## Assistant\n")
+        return {"turn": turn, "start_time": start_time or time.perf_counter(), "parts": [], "usage": None}
+
+    def handle_stream_chunk(self, state, chunk, on_delta=None):
+        """处理一个流式 chunk：边接收边追加到日志，并记录首 token 延迟。"""
+        # 最后一个 chunk 只携带 usage，没有 choices
+        if chunk.usage is not None:
+            state["usage"] = chunk.usage
+        if not chunk.choices:
+            return
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            return
+        with self.turn_lock:
+            self.check_turn(state["turn"])
+            if self.last_ttft is None:
+                self.last_ttft = time.perf_counter() - state["start_time"]
+            state["parts"].append(delta)
+            self.append_raw_to_log(delta)
+        if on_delta:
+            on_delta(delta)
+
+    def end_stream(self, state):
+        """结束流式响应，返回完整内容和 Token 使用数据。"""
+        with self.turn_lock:
+            self.check_turn(state["turn"])
+            self.append_raw_to_log("\n\n")
+        return "".join(state["parts"]), self.usage_to_dict(state["usage"])
+
+    def has_messages(self):
+        """检查是否有实际的聊天内容（不包括系统消息）"""
+        return any(msg["role"] == "user" or msg["role"] == "assistant" for msg in self.messages)
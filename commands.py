@@ -0,0 +1,359 @@
+import os
+import sqlite3
+import time
+from rich.console import Console
+from rich.table import Table
+from attachments import AttachmentReader, get_attach_options
+from control import other_process_addresses, send_command
+from log_archive import archive_logs, load_manifest
+from metrics import load_all_metrics, load_metrics, metrics_path
+from prompt_input import load_file_attachment
+from search_index import SNIPPET_END, SNIPPET_START, get_search_index
+from semantic_memory import get_semantic_memory
+from utils import (
+    calculate_cost, cache_hit_ratio, calculate_total_cost, list_log_files, get_log_directory, get_all_sessions_from_file
+)
+
+# 所有会话共用的终端输出，使用终端的实际宽度
+console = Console()
+
+
+def close_other_processes():
+    """通过控制通道通知其他窗口关闭它们的会话。"""
+    for address in other_process_addresses(get_all_sessions_from_file()):
+        if send_command(address, "close") is None:
+            print(f"Could not reach session at {address.partition('#')[0]}")
+
+
+def set_render_mode(renderer, prompt):
+    """--render 命令：显示或切换响应的显示方式。"""
+    args = prompt.split(" ")[1:]
+    if args:
+        try:
+            renderer.set_mode(args[0].lower())
+        except ValueError as e:
+            print(e)
+            return
+    print(f"Render mode: {renderer.mode} (responses over {renderer.options['large_response_lines']} lines "
+          f"use the fast path in auto mode).")
+
+
+def start_search_index_refresh(config):
+    """程序启动后在后台补齐搜索索引，使第一次 --search 不必等待扫描日志目录。"""
+    if not config.get("search_index", True):
+        return
+    try:
+        get_search_index(get_log_directory(config)).refresh_in_background()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error opening search index: {e}")
+
+
+def print_search_results(config, prompt):
+    """--search 命令：在所有聊天记录中全文检索，显示片段和可用于 --continue 的文件名。"""
+    from rich.markup import escape
+    query = prompt.partition(" ")[2].strip()
+    if not query:
+        print("Please provide something to search for, e.g. --search rate limit role:assistant")
+        return
+    start_time = time.perf_counter()
+    try:
+        results = get_search_index(get_log_directory(config)).search(query)
+    except (sqlite3.Error, ValueError) as e:
+        print(f"Search failed: {e}")
+        return
+    elapsed = (time.perf_counter() - start_time) * 1000
+    if not results:
+        print(f"No matches ({elapsed:.0f} ms).")
+        return
+    table = Table(show_header=True, header_style="bold magenta", show_lines=True)
+    for column in ("File", "Date", "Model", "Role", "Snippet"):
+        table.add_column(column)
+    for result in results:
+        snippet = escape(" ".join(result["snippet"].split()))
+        snippet = snippet.replace(SNIPPET_START, "[bold yellow]").replace(SNIPPET_END, "[/bold yellow]")
+        table.add_row(os.path.splitext(result["path"])[0], result["day"] or "", result["model"] or "",
+                      result["role"], snippet)
+    console.print(table)
+    print(f"{len(results)} matches in {elapsed:.0f} ms. Use --continue <file> to resume a conversation.")
+
+
+def archive_old_logs(config, prompt, exclude=()):
+    """--archive 命令：把超过指定天数（默认 archive_after_days）未修改的日志压缩归档。"""
+    args = prompt.split(" ")[1:]
+    try:
+        days = float(args[0]) if args else config.get("archive_after_days", 90)
+    except ValueError:
+        print("Please provide the number of days, e.g. --archive 90")
+        return
+    try:
+        # 其他窗口和进程中仍在使用的日志也不归档
+        exclude = list(exclude) + [session["session_name"] for session in get_all_sessions_from_file()]
+    except sqlite3.Error as e:
+        print(f"Archiving failed: could not read the session registry: {e}")
+        return
+    try:
+        count, raw_bytes, archived_bytes = archive_logs(get_log_directory(config), days, exclude)
+    except (OSError, ValueError) as e:
+        print(f"Archiving failed: {e}")
+        return
+    if not count:
+        print(f"No chat logs older than {days:g} days.")
+        return
+    print(f"Archived {count} chat logs older than {days:g} days: "
+          f"{raw_bytes / 1024:.0f} KB -> {archived_bytes / 1024:.0f} KB.")
+
+
+def print_stats(bot, prompt):
+    """--stats 命令：按模型显示请求延迟等指标的 p50/p95/p99。
+
+    --stats 显示当前会话，--stats all 合并所有已保存的会话，
+    --stats openmetrics <file> 把所有会话的指标以 OpenMetrics 文本格式写入文件。
+    """
+    args = prompt.split(" ")[1:]
+    metrics = bot.metrics
+    if args and args[0].lower() in ("all", "openmetrics"):
+        metrics = load_all_metrics(get_log_directory(bot.config))
+        # 当前会话的指标在关闭时才保存，这里加上尚未保存的部分
+        saved = load_metrics(metrics_path(bot.log_file_name))
+        if saved is None:
+            metrics.merge(bot.metrics)
+    if args and args[0].lower() == "openmetrics":
+        if len(args) < 2:
+            print(metrics.to_openmetrics(), end="")
+            return
+        try:
+            with open(args[1], "w", encoding="utf-8") as f:
+                f.write(metrics.to_openmetrics())
+        except OSError as e:
+            print(f"Failed to write metrics: {e}")
+            return
+        print(f"Metrics written to {args[1]}")
+        return
+
+    rows = metrics.summary_rows()
+    if not rows:
+        print("No requests recorded yet.")
+        return
+    table = Table(show_header=True, header_style="bold magenta")
+    for column in ("Model", "Metric", "Samples", "p50", "p95", "p99"):
+        table.add_column(column)
+    for model, name, count, values in rows:
+        if name == "output_tokens_per_second":
+            cells = [f"{v:.1f}/s" for v in values]
+        else:
+            cells = [f"{v * 1000:.0f} ms" if v < 1 else f"{v:.2f} s" for v in values]
+        table.add_row(model, name, str(count), *cells)
+    console.print(table)
+    counters = ", ".join(f"{name} ({model}): {value}" for (name, model), value in sorted(metrics.counters.items()))
+    if counters:
+        print(f"Counters: {counters}")
+
+
+def manage_memory(bot, prompt):
+    """--memory [on|off|rebuild|<query>]：查看或开关语义记忆、重建索引，或查看一个问题会召回哪些片段。"""
+    argument = prompt.strip().partition(" ")[2].strip()
+    if argument.lower() in ("on", "off"):
+        bot.memory_enabled = argument.lower() == "on"
+        print(f"Semantic memory is {argument.lower()} for this session.")
+        return
+    memory = get_semantic_memory(bot.config, get_log_directory(bot.config), bot.defer_usage)
+    if memory is None:
+        return
+    if argument.lower() == "rebuild":
+        print(f"Memory rebuilt with {memory.rebuild(bot.defer_usage)} snippets.")
+    elif argument:
+        memory.refresh(bot.defer_usage)
+        results = memory.recall(argument, top_k=bot.memory_options["top_k"], on_usage=bot.defer_usage)
+        if not results:
+            print("Nothing relevant in memory.")
+            return
+        table = Table(show_header=True, header_style="bold magenta")
+        for column in ("Score", "File", "Role", "Snippet"):
+            table.add_column(column)
+        for score, chunk in results:
+            snippet = " ".join(chunk["text"].split())
+            table.add_row(f"{score:.2f}", chunk["path"], chunk["role"], snippet[:160])
+        console.print(table)
+    else:
+        memory.refresh(bot.defer_usage)
+        stats = memory.stats()
+        state = "on" if bot.memory_enabled else "off"
+        print(f"Semantic memory is {state}: {stats['chunks']} snippets from {stats['logs']} chat logs, "
+              f"{stats['bytes'] / 1024 / 1024:.1f} MB of vectors ({stats['embedder']}).")
+
+
+def print_cancel_result(cancelled, dropped):
+    if dropped:
+        print(f"Dropped {dropped} queued message(s).")
+    if not cancelled and not dropped:
+        print("No request in progress.")
+
+
+def print_current_usage(token_usage, pricing, scheduler=None):
+    """打印当前会话的 Token 使用量、缓存命中率和成本，以及请求调度器的状态。"""
+    print(f"Token Usage: {token_usage}")
+    print(f"Cache Hit Ratio: {cache_hit_ratio(token_usage.get('cached_tokens', 0), token_usage['prompt_tokens']):.1%}")
+    print(f"Current Session Total Cost: ${calculate_cost(token_usage, pricing):.6f}")
+    if scheduler is not None:
+        stats = scheduler.stats()
+        print(f"Requests: {stats['queue_depth']} queued, {stats['in_flight']} in flight, {stats['retries']} retries")
+
+
+def add_api_key(scheduler, prompt):
+    """--add key / --ak 命令：把 API key 加入本进程的 key 池（已停用的 key 重新启用）。"""
+    args = prompt.split()
+    if args[0].lower() == "--add":
+        args = args[1:] if len(args) > 1 and args[1].lower() == "key" else []
+    if len(args) < 2:
+        print("Please provide an API key to add, e.g. --add key sk-...")
+        return
+    api_key = scheduler.key_pool.add(args[1])
+    print(f"API key {api_key.name} added ({len(scheduler.key_pool.keys)} keys in the pool).")
+
+
+def print_key_stats(scheduler):
+    """--keys 命令：显示 key 池中每个 key 的状态和用量。"""
+    table = Table(show_header=True, header_style="bold magenta")
+    for column in ("Key", "Status", "In flight", "Requests", "Errors", "Rate limited", "Tokens"):
+        table.add_column(column)
+    for stats in scheduler.key_pool.stats():
+        table.add_row(stats["name"], stats["status"], str(stats["in_flight"]), str(stats["requests"]),
+                      str(stats["errors"]), str(stats["rate_limited"]), str(stats["tokens"]))
+    console.print(table)
+
+
+def print_total_usage(config, prompt):
+    """打印所有日志的 Token 使用量，可按天或模型分组（--tu [day|model]）。"""
+    parts = prompt.split(" ")
+    group_by = parts[1].lower() if len(parts) > 1 and parts[1] else None
+    if group_by not in (None, "day", "model"):
+        print("Usage: --tu [day|model]")
+        return
+    total_stats = calculate_total_cost(config["output_directory"], group_by)
+    print("\nSummary of All Logs:")
+    print(f"- Total Input Tokens: {total_stats['total_input_tokens']}")
+    print(f"- Total Cached Tokens: {total_stats['total_cached_tokens']}")
+    print(f"- Cache Hit Ratio: {cache_hit_ratio(total_stats['total_cached_tokens'], total_stats['total_input_tokens']):.1%}")
+    print(f"- Total Output Tokens: {total_stats['total_output_tokens']}")
+    print(f"- Total Cost: ${total_stats['total_cost']:.6f}")
+    if group_by:
+        table = Table(show_header=True, header_style="bold magenta")
+        for column in (group_by.capitalize(), "Logs", "Input", "Cached", "Cache Hit", "Output", "Cost"):
+            table.add_column(column)
+        for group in total_stats["groups"]:
+            table.add_row(
+                str(group[group_by]), str(group["file_count"]), str(group["total_input_tokens"]),
+                str(group["total_cached_tokens"]),
+                f"{cache_hit_ratio(group['total_cached_tokens'], group['total_input_tokens']):.1%}",
+                str(group["total_output_tokens"]), f"${group['total_cost']:.6f}"
+            )
+        console.print(table)
+
+
+def print_cache_stats(response_cache, prompt):
+    """打印本地响应缓存的命中统计；"--cache clear" 清空缓存。"""
+    if response_cache is None:
+        print('Response cache is disabled. Set "response_cache": {"enabled": true} in config.json.')
+        return
+    if prompt.lower().split(" ")[1:2] == ["clear"]:
+        response_cache.clear()
+        print("Response cache cleared.")
+        return
+    stats = response_cache.stats()
+    print(f"Response Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['bytes'] / 1024 / 1024:.2f} MB")
+
+
+def split_path_argument(prompt):
+    """拆分 "--命令 <path> [message]" 的参数，路径中有空格时可以加引号。
+
+    Returns:
+        tuple: (路径, 消息)，没有参数时路径为空字符串。
+    """
+    argument = prompt.strip().partition(" ")[2].strip()
+    if argument.startswith('"') and '"' in argument[1:]:
+        path, _, message = argument[1:].partition('"')
+    elif os.path.isfile(argument):
+        path, message = argument, ""
+    else:
+        path, _, message = argument.partition(" ")
+    return os.path.expanduser(path), message.strip()
+
+
+def attach_file(bot, input_options, attachments, prompt):
+    """--file <path> [message]：读取文件，随下一条消息发送。
+
+    路径中有空格时可以加引号。带 message 时返回这条消息，由调用方立即发送。
+    """
+    path, message = split_path_argument(prompt)
+    if not path:
+        print("Please provide a file path, e.g. --file app.py explain this")
+        return None
+    try:
+        block, truncated = load_file_attachment(path, input_options["max_file_bytes"])
+    except (OSError, ValueError) as e:
+        print(f"Could not attach file: {e}")
+        return None
+    attachments.append(block)
+    note = f", truncated to {input_options['max_file_bytes']} bytes" if truncated else ""
+    print(f"Attached {path} (about {bot.context_window.count_text(block)} tokens{note}).")
+    message = message.strip()
+    if not message:
+        print("It will be sent with your next message.")
+    return message or None
+
+
+def parse_attach_command(prompt):
+    """--attach <path> [question]：检查文件，返回 (路径, 问题)；参数有误时路径为 None。"""
+    path, question = split_path_argument(prompt)
+    if not path:
+        print("Please provide a file path, e.g. --attach report.txt what are the main risks?")
+        return None, None
+    if not os.path.isfile(path):
+        print(f"File not found: {path}")
+        return None, None
+    return path, question
+
+
+def read_attachment(bot, path, question, cancelled=None, on_progress=None):
+    """--attach：分块并发处理文件。
+
+    Returns:
+        tuple: (最终发送的提示, 处理情况的说明)。失败或被取消时提示为 None。
+    """
+    reader = AttachmentReader(bot, get_attach_options(bot.config))
+    try:
+        prompt = reader.read(path, question, cancelled, on_progress)
+    except (OSError, ValueError) as e:
+        return None, f"Could not attach file: {e}"
+    except Exception as e:
+        return None, f"Error reading {path}: {e}"
+    if prompt is None or not reader.parts:
+        return prompt, None
+    return prompt, f"Read {os.path.basename(path)} in {reader.parts} parts ({reader.cached} from cache)."
+
+
+def add_attachments(prompt, attachments):
+    """把 --file 附加的文件放在消息后面，并清空附件列表。"""
+    if not attachments:
+        return prompt
+    prompt = "\n\n".join([prompt] + attachments)
+    attachments.clear()
+    return prompt
+
+
+def split_fresh_prefix(prompt):
+    """处理 "--fresh <消息>"：返回 (消息, 是否使用响应缓存)。"""
+    if prompt.lower().startswith("--fresh "):
+        return prompt[len("--fresh "):], False
+    return prompt, True
+
+
+def print_log_files(config):
+    """列出所有聊天历史文件。"""
+    log_directory = get_log_directory(config)
+    log_files = list_log_files(log_directory)
+    archived = sorted(load_manifest(log_directory))
+    if not log_files and not archived:
+        print('No history in "chat_logs" folder')
+    else:
+        print("\n".join(log_files + [f"{name} (archived)" for name in archived]))
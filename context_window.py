@@ -0,0 +1,123 @@
+import threading
+
+# 每条消息除内容外的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def load_tokenizer(model):
+    """加载本地分词器。安装了 tiktoken 时使用精确计数，否则返回 None 并使用估算。"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def estimate_tokens(text):
+    """没有分词器时的粗略估算：ASCII 约 4 个字符一个 token，其他字符（如中文）约一个字符一个 token。"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+class ContextWindow:
+    """按 Token 预算决定每次请求发送哪些历史消息。
+
+    - 每条消息的 Token 数只计算一次并缓存。
+    - 始终保留系统消息和最新的用户消息，超出预算的旧消息被裁掉（不做摘要：
+      摘要需要额外的请求，而且会改变请求前缀，使服务端的前缀缓存失效）。
+    - 裁剪起点在两次裁剪之间保持不变：超出预算时一次裁到 budget * trim_ratio，
+      之后的若干轮请求前缀完全相同，可以命中服务端的前缀缓存。
+    - budget 为 0 或 None 时不裁剪，只统计大小。
+    """
+
+    def __init__(self, model, budget=None, trim_ratio=0.75):
+        self.model = model
+        self._tokenizer = None
+        self.tokenizer_loaded = False
+        self.tokenizer_lock = threading.Lock()
+        self.budget = budget
+        self.trim_ratio = trim_ratio
+        self.start_index = 0  # 保留的第一条非系统消息的位置
+        self.token_cache = {}
+        self.cache_lock = threading.Lock()
+        self.last_stats = None
+
+    @property
+    def tokenizer(self):
+        """本地分词器，第一次计数时才加载（tiktoken 导入和加载编码较慢，不放在启动路径上）。"""
+        if not self.tokenizer_loaded:
+            with self.tokenizer_lock:
+                if not self.tokenizer_loaded:
+                    self._tokenizer = load_tokenizer(self.model)
+                    self.tokenizer_loaded = True
+        return self._tokenizer
+
+    def count_text(self, text):
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, disallowed_special=()))
+        return estimate_tokens(text)
+
+    def count(self, message):
+        """返回一条消息的 Token 数（带缓存）。"""
+        key = (message["role"], message["content"])
+        with self.cache_lock:
+            tokens = self.token_cache.get(key)
+        if tokens is None:
+            tokens = self.count_text(message["content"] or "") + MESSAGE_OVERHEAD_TOKENS
+            with self.cache_lock:
+                self.token_cache[key] = tokens
+        return tokens
+
+    def select(self, messages):
+        """选出本次请求要发送的消息，并把统计信息保存在 last_stats 中。
+
+        Args:
+            messages (list): 完整的聊天消息记录。
+
+        Returns:
+            list: 在预算内的消息列表，顺序与原列表一致。
+        """
+        system_messages = [m for m in messages if m["role"] == "system"]
+        other_messages = [m for m in messages if m["role"] != "system"]
+        system_tokens = sum(self.count(m) for m in system_messages)
+
+        # 历史被替换（如加载了其他会话）时重新从头开始
+        if self.start_index >= len(other_messages):
+            self.start_index = 0
+        start = self.start_index
+        used = system_tokens + sum(self.count(m) for m in other_messages[start:])
+
+        if self.budget and used > self.budget:
+            # 一次裁到低水位，而不是每轮只裁掉一条，保持之后几轮的前缀稳定
+            target = self.budget * self.trim_ratio
+            # 最新的一条消息无论多大都要发送
+            while start < len(other_messages) - 1 and used > target:
+                used -= self.count(other_messages[start])
+                start += 1
+            # 保证保留的历史从用户消息开始，不留下孤立的助手回复
+            while start < len(other_messages) - 1 and other_messages[start]["role"] != "user":
+                used -= self.count(other_messages[start])
+                start += 1
+            self.start_index = start
+        kept = other_messages[start:]
+
+        self.last_stats = {
+            "tokens": used,
+            "messages": len(system_messages) + len(kept),
+            "trimmed": len(other_messages) - len(kept),
+        }
+        return system_messages + kept
+
+    def describe(self):
+        """返回最近一次选择结果的简短描述。"""
+        if not self.last_stats:
+            return ""
+        text = f"context {self.last_stats['tokens']} tokens, {self.last_stats['messages']} messages"
+        if self.last_stats["trimmed"]:
+            text += f", {self.last_stats['trimmed']} trimmed"
+        if self.last_stats.get("recalled"):
+            text += f", {self.last_stats['recalled']} recalled"
+        return text
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import secrets
+import socket
+import sys
+import tempfile
+import threading
+
+# 控制消息为单行 JSON，请求和响应都很小
+MAX_MESSAGE_SIZE = 64 * 1024
+
+
+def focus_console_window():
+    """把当前控制台窗口切换到前台（Windows）；其他平台响铃提示。"""
+    if os.name == "nt":
+        import ctypes
+        hwnd = ctypes.windll.kernel32.GetConsoleWindow()
+        if hwnd:
+            ctypes.windll.user32.ShowWindow(hwnd, 9)  # SW_RESTORE
+            ctypes.windll.user32.SetForegroundWindow(hwnd)
+            return
+    print("\a\nAnother session asked to focus this window.")
+    sys.stdout.flush()
+
+
+class ControlServer:
+    """每个进程一个的本地控制通道，其他进程通过它立即下发 close/list/focus 等命令。
+
+    POSIX 下使用 Unix 域套接字，Windows 下使用只监听 127.0.0.1 的 TCP 端口并附带随机令牌。
+    地址写入会话登记表，命令到达时直接唤醒，不需要轮询。
+
+    Args:
+        handlers (dict): 命令名 -> 处理函数，处理函数接收请求字典并返回可序列化为 JSON 的结果。
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.token = secrets.token_hex(16)
+        self.socket_path = None
+        self.address = None
+        self.sock = None
+        self.server = None
+
+    def _listen(self):
+        if hasattr(socket, "AF_UNIX") and os.name == "posix":
+            self.socket_path = os.path.join(tempfile.gettempdir(), f"chatgpt_cli_{os.getpid()}.sock")
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+            self.address = f"unix:{self.socket_path}#{self.token}"
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(("127.0.0.1", 0))
+            self.address = f"tcp:127.0.0.1:{sock.getsockname()[1]}#{self.token}"
+        sock.listen(8)
+        return sock
+
+    def dispatch(self, data):
+        """处理一条请求并返回响应字节。"""
+        try:
+            request = json.loads(data)
+            if request.get("token") != self.token:
+                response = {"ok": False, "error": "invalid token"}
+            elif request.get("command") not in self.handlers:
+                response = {"ok": False, "error": f"unknown command: {request.get('command')}"}
+            else:
+                result = self.handlers[request["command"]](request)
+                response = {"ok": True, "result": result}
+        except Exception as e:
+            response = {"ok": False, "error": str(e)}
+        return (json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def start(self):
+        """在后台线程中阻塞等待连接（accept 阻塞，不轮询）。"""
+        self.sock = self._listen()
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self.address
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                # 套接字已关闭
+                return
+            with conn:
+                try:
+                    conn.settimeout(5)
+                    data = conn.makefile("rb").readline(MAX_MESSAGE_SIZE)
+                    conn.sendall(self.dispatch(data))
+                except OSError:
+                    pass
+
+    async def start_async(self):
+        """在当前事件循环中提供服务，不占用额外线程。"""
+        self.sock = self._listen()
+        if self.socket_path:
+            self.server = await asyncio.start_unix_server(self._handle_async, sock=self.sock)
+        else:
+            self.server = await asyncio.start_server(self._handle_async, sock=self.sock)
+        return self.address
+
+    async def _handle_async(self, reader, writer):
+        try:
+            data = await reader.readline()
+            writer.write(self.dispatch(data))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        elif self.sock is not None:
+            self.sock.close()
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def send_command(address, command, timeout=2.0, **kwargs):
+    """向另一个进程的控制通道发送命令。
+
+    Returns:
+        dict: 对方的响应；无法连接时返回 None。
+    """
+    if not address:
+        return None
+    location, _, token = address.partition("#")
+    try:
+        if location.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(location[len("unix:"):])
+        else:
+            host, port = location[len("tcp:"):].rsplit(":", 1)
+            sock = socket.create_connection((host, int(port)), timeout=timeout)
+        with sock:
+            request = dict(kwargs, command=command, token=token)
+            sock.sendall((json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8"))
+            data = sock.makefile("rb").readline(MAX_MESSAGE_SIZE)
+        return json.loads(data) if data else None
+    except (OSError, ValueError):
+        return None
+
+
+def other_process_addresses(sessions):
+    """从会话列表中取出其他进程的控制地址（去重）。"""
+    addresses = []
+    for session in sessions:
+        address = session.get("address")
+        if session["pid"] != os.getpid() and address and address not in addresses:
+            addresses.append(address)
+    return addresses
@@ -0,0 +1,424 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+from rich.table import Table
+from control import ControlServer, focus_console_window
+from openai_client import get_async_client, close_async_client
+from chatgpt import ChatGPT
+from commands import (
+    console, print_current_usage, print_total_usage, print_log_files, print_cache_stats, split_fresh_prefix,
+    close_other_processes, set_render_mode, print_stats, print_search_results, start_search_index_refresh,
+    archive_old_logs, add_api_key, print_key_stats, print_cancel_result, attach_file, add_attachments,
+    manage_memory, parse_attach_command, read_attachment
+)
+from prompt_input import aread_prompt, get_input_options
+from renderer import get_renderer
+from utils import add_session_to_file, remove_session_from_file
+
+
+class EngineSession:
+    """引擎中的一个会话：在共享的事件循环中以任务形式运行，按顺序处理自己的提示队列。"""
+
+    def __init__(self, engine, bot, total_token_usage):
+        self.engine = engine
+        self.bot = bot
+        self.total_token_usage = total_token_usage
+        self.session_name = bot.log_file_name
+        self.prompts = asyncio.Queue()
+        self.outbox = []  # 会话不在前台时收到的响应，切换过来后再显示
+        self.attachments = []  # --file 读取的文件，随下一条消息发送
+        self.busy = False
+        self.task = None
+        self.request_task = None  # 进行中的请求，--cancel 取消它
+        self.request_cancelled = False
+
+    def start(self):
+        add_session_to_file(self.session_name, 'Open', self.engine.control_address)
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            prompt, use_cache, attachment = await self.prompts.get()
+            self.busy = True
+            self.request_cancelled = False
+            self.request_task = asyncio.create_task(self.process(prompt, use_cache, attachment))
+            try:
+                response, token_usage = await self.request_task
+            except asyncio.CancelledError:
+                if not self.request_cancelled:
+                    # 会话任务本身被取消（等待中的请求也随之取消）
+                    raise
+                self.engine.deliver_notice(self, "Request cancelled.")
+                continue
+            finally:
+                self.busy = False
+                self.request_task = None
+            if token_usage is not None:
+                for key in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+                    self.total_token_usage[key] += token_usage.get(key, 0)
+            self.engine.deliver(self, response)
+
+    async def process(self, prompt, use_cache, attachment):
+        """处理一条消息；--attach 的分块在线程池中处理，不阻塞事件循环。"""
+        if attachment:
+            prompt, summary = await asyncio.to_thread(
+                read_attachment, self.bot, attachment, prompt, lambda: self.request_cancelled
+            )
+            if summary:
+                self.engine.deliver_notice(self, summary)
+            if prompt is None:
+                return None, None
+        return await self.bot.achat(self.engine.client, prompt, use_cache=use_cache)
+
+    async def submit(self, prompt, attachment=None):
+        prompt, use_cache = split_fresh_prefix(prompt)
+        await self.prompts.put((add_attachments(prompt, self.attachments), use_cache, attachment))
+
+    def cancel(self, drain=False):
+        """取消进行中的请求，drain 为 True 时同时丢弃排队中的提示。返回 (是否取消了请求, 丢弃的提示数)。"""
+        dropped = 0
+        while drain and not self.prompts.empty():
+            self.prompts.get_nowait()
+            dropped += 1
+        cancelled = self.request_task is not None and not self.request_task.done()
+        if cancelled:
+            self.request_cancelled = True
+            self.request_task.cancel()
+        return cancelled, dropped
+
+    async def close(self):
+        """取消会话任务并清理日志和会话记录。"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        remove_session_from_file(self.session_name)
+        self.bot.close_log()
+        if self.bot.remove_empty_log():
+            print(f"Session {self.session_name} was empty and has been deleted.")
+        else:
+            print(f"Session {self.session_name} has been closed.")
+
+
+class SessionEngine:
+    """单进程异步引擎：所有会话共享一个带连接池的 AsyncOpenAI 客户端和一个事件循环。
+
+    会话之间可以随时切换，后台会话的请求照常进行，响应在切换回来时显示。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.client = get_async_client(config)
+        self.sessions = []
+        self.active = None
+        self.running = True
+        self.control = ControlServer({
+            "close": self.request_close,
+            "list": lambda _: [{"session_name": s.session_name, "busy": s.busy} for s in self.sessions],
+            "focus": lambda _: focus_console_window(),
+            "ping": lambda _: "pong",
+        })
+        self.control_address = None
+        self.renderer = get_renderer(config, console)
+        self.input_options = get_input_options(config)
+        self.read_task = None
+        self.stdin_lines = None
+
+    def open_session(self, bot=None, total_token_usage=None):
+        """在当前进程中新建一个会话并切换到它。"""
+        bot = bot or ChatGPT()
+        if total_token_usage is None:
+            total_token_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        session = EngineSession(self, bot, total_token_usage)
+        self.sessions.append(session)
+        session.start()
+        self.active = session
+        print(f"Session {len(self.sessions)} opened: {session.session_name}")
+        return session
+
+    def request_close(self, _):
+        """控制通道的 close 命令：停止读取输入，关闭所有会话。"""
+        print("\nClose requested by another session.")
+        self.running = False
+        if self.read_task is not None:
+            self.read_task.cancel()
+
+    def session_index(self, session):
+        return self.sessions.index(session) + 1
+
+    def deliver(self, session, response):
+        """显示响应：前台会话直接渲染，后台会话先缓存并提示。"""
+        if session is self.active:
+            self.render(session, response)
+            context = session.bot.context_window.describe()
+            if context:
+                console.print(f"[dim]Sent {context}.[/dim]")
+            self.print_prompt()
+        else:
+            session.outbox.append(response)
+            index = self.session_index(session)
+            console.print(f"\n[dim]Session {index} has a new response. Type --switch {index} to view it.[/dim]")
+            self.print_prompt()
+
+    def deliver_notice(self, session, text):
+        """显示会话的提示信息，后台会话注明会话编号。"""
+        if session is self.active:
+            print(f"\n{text}")
+        else:
+            console.print(f"\n[dim]Session {self.session_index(session)}: {text}[/dim]")
+        self.print_prompt()
+
+    def cancel_active(self):
+        """Ctrl-C：取消前台会话进行中的请求。"""
+        if self.active and self.active.cancel()[0]:
+            return
+        print("\nNo request in progress. Type --exit to quit.")
+        self.print_prompt()
+
+    def render(self, session, response):
+        print("\n")
+        if response is not None:
+            render_start = time.perf_counter()
+            self.renderer.render(response)
+            session.bot.metrics.observe("render_seconds", session.bot.model, time.perf_counter() - render_start)
+        else:
+            print("Failed to get a response from the AI.")
+
+    def print_prompt(self):
+        if self.active:
+            print(f"\033[31mYou [{self.session_index(self.active)}]: \033[0m", end="", flush=True)
+
+    def switch(self, index):
+        if not 1 <= index <= len(self.sessions):
+            print(f"No session {index}. Type --sessions to see open sessions.")
+            return
+        self.active = self.sessions[index - 1]
+        print(f"Switched to session {index}: {self.active.session_name}")
+        for response in self.active.outbox:
+            self.render(self.active, response)
+        self.active.outbox.clear()
+
+    def list_sessions(self):
+        table = Table(show_header=True, header_style="bold magenta")
+        for column in ("#", "Session", "Status"):
+            table.add_column(column)
+        for index, session in enumerate(self.sessions, start=1):
+            if session.busy:
+                status = "Waiting for response"
+            elif session.outbox:
+                status = f"{len(session.outbox)} unread"
+            else:
+                status = "Idle"
+            marker = " *" if session is self.active else ""
+            table.add_row(f"{index}{marker}", session.session_name, status)
+        console.print(table)
+
+    async def close_session(self, session):
+        index = self.session_index(session)
+        await session.close()
+        self.sessions.remove(session)
+        if session is self.active:
+            self.active = self.sessions[min(index, len(self.sessions)) - 1] if self.sessions else None
+
+    async def read_prompt(self):
+        """读取一条消息，一次粘贴的多行内容合并为一条。"""
+        return await aread_prompt(self.read_line, self.input_options["paste_burst_seconds"])
+
+    async def read_line(self, timeout=None):
+        """异步读取一行输入，timeout 秒内没有输入时返回 None。POSIX 下直接监听 stdin，不额外占用线程。"""
+        loop = asyncio.get_running_loop()
+        try:
+            if os.name == "posix" and sys.stdin.isatty():
+                future = loop.create_future()
+                fd = sys.stdin.fileno()
+
+                def on_readable():
+                    if not future.done():
+                        future.set_result(sys.stdin.readline())
+
+                loop.add_reader(fd, on_readable)
+                try:
+                    line = await asyncio.wait_for(future, timeout)
+                finally:
+                    loop.remove_reader(fd)
+            else:
+                # 阻塞的 readline 放在守护线程中，退出时不需要等待它
+                if self.stdin_lines is None:
+                    self.stdin_lines = asyncio.Queue()
+                    threading.Thread(target=self._read_stdin, args=(loop,), daemon=True).start()
+                line = await asyncio.wait_for(self.stdin_lines.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if line == "":
+            raise EOFError
+        return line.rstrip("\n")
+
+    def _read_stdin(self, loop):
+        while True:
+            line = sys.stdin.readline()
+            loop.call_soon_threadsafe(self.stdin_lines.put_nowait, line)
+            if line == "":
+                return
+
+    async def handle_commands(self, prompt):
+        prompt_lower = prompt.lower().split(" ")[0]
+        args = prompt.split(" ")[1:]
+        if prompt_lower in ("--help", "--h"):
+            self.print_help()
+        elif prompt_lower in ("--sessions", "--s"):
+            self.list_sessions()
+        elif prompt_lower in ("--switch", "--sw"):
+            try:
+                self.switch(int(args[0]))
+            except (IndexError, ValueError):
+                print("Please provide a session number, e.g. --switch 2")
+        elif prompt_lower in ("--open", "--o"):
+            self.open_session()
+        elif prompt_lower in ("--continue", "--cont"):
+            if not args:
+                print("Please provide a file name to continue the conversation.")
+                return True
+            bot = ChatGPT()
+            total_token_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+            try:
+                bot.load_history(args[0], total_token_usage)
+            except FileNotFoundError as e:
+                print(e)
+                bot.close_log()
+                return True
+            self.open_session(bot, total_token_usage)
+            print(f"Continuing conversation from {args[0]}")
+        elif prompt_lower in ("--close", "--c"):
+            if args and args[0].lower() == "all":
+                print("Closing all conversations...")
+                close_other_processes()
+                self.running = False
+                return True
+            await self.close_session(self.active)
+            if not self.sessions:
+                self.running = False
+        elif prompt_lower in ("--exit", "--quit", "--e", "--q"):
+            print("Exiting Chat.")
+            self.running = False
+        elif prompt_lower in ("--current usage", "--cu"):
+            print_current_usage(self.active.total_token_usage, self.config["pricing"], self.active.bot.scheduler)
+        elif prompt_lower in ("--total usage", "--tu"):
+            print_total_usage(self.config, prompt)
+        elif prompt_lower in ("--list", "--ls", "--history"):
+            print_log_files(self.config)
+        elif prompt_lower == "--cache":
+            print_cache_stats(self.active.bot.response_cache, prompt)
+        elif prompt_lower in ("--add", "--ak"):
+            add_api_key(self.active.bot.scheduler, prompt)
+        elif prompt_lower == "--keys":
+            print_key_stats(self.active.bot.scheduler)
+        elif prompt_lower == "--cancel":
+            cancelled, dropped = self.active.cancel(args[:1] == ["all"])
+            if dropped or not cancelled:
+                print_cancel_result(cancelled, dropped)
+        elif prompt_lower == "--attach":
+            path, question = parse_attach_command(prompt)
+            if path:
+                await self.active.submit(question, attachment=path)
+        elif prompt_lower == "--memory":
+            manage_memory(self.active.bot, prompt)
+        elif prompt_lower == "--file":
+            message = attach_file(self.active.bot, self.input_options, self.active.attachments, prompt)
+            if message:
+                await self.active.submit(message)
+        elif prompt_lower == "--render":
+            set_render_mode(self.renderer, prompt)
+        elif prompt_lower == "--stats":
+            print_stats(self.active.bot, prompt)
+        elif prompt_lower == "--search":
+            print_search_results(self.config, prompt)
+        elif prompt_lower == "--archive":
+            archive_old_logs(self.config, prompt, [session.bot.log_file_name for session in self.sessions])
+        elif prompt_lower == "--fresh":
+            return False
+        elif prompt_lower.startswith("-") and len(prompt) <= 20:
+            print("Unknown command. Type --help to see available commands.")
+        else:
+            return False
+        return True
+
+    def print_help(self):
+        table = Table(show_header=True, header_style="bold magenta", show_lines=True)
+        table.add_column("Command", width=50)
+        table.add_column("Description", width=48)
+        table.add_row("--open or --o", "Open a new session in this window.")
+        table.add_row("--continue or --cont <filename>", "Continue a previous chat session in this window.")
+        table.add_row("--sessions or --s", "List sessions in this window.")
+        table.add_row("--switch or --sw <number>", "Switch to another session.")
+        table.add_row("--close or --c [all]", "Close the current session, or all sessions in every window.")
+        table.add_row("--exit or --quit or --e or --q", "Close all sessions and exit.")
+        table.add_row("--current usage or --cu", "View token usage for current session.")
+        table.add_row("--total usage or --tu [day|model]", "View token usage for all recorded sessions.")
+        table.add_row("--list or --ls or --history", "List all chat history files.")
+        table.add_row("--fresh <message>", "Send a message without using the local response cache.")
+        table.add_row("--cancel [all]",
+                      "Cancel the request in progress (Ctrl-C does the same), and with all also drop queued messages.")
+        table.add_row("--file <path> [message]", "Send a file with the next message, or right away with a message.")
+        table.add_row("--attach <path> [question]",
+                      "Ask about a large file: its parts are read in parallel and combined into one answer.")
+        table.add_row("--memory [on|off|rebuild|<question>]",
+                      "Show or switch semantic memory, rebuild it, or show what a question would recall.")
+        table.add_row("--cache [clear]", "Show response cache hits and misses, or clear the cache.")
+        table.add_row("--add key or --ak <api_key>", "Add an OpenAI API key to the key pool.")
+        table.add_row("--keys", "Show the status, requests and tokens of every API key in the pool.")
+        table.add_row("--render [auto|markdown|raw]", "Show or change how responses are displayed.")
+        table.add_row("--stats [all|openmetrics <file>]",
+                      "Latency percentiles per model for this session or all sessions, or write them for scraping.")
+        table.add_row("--search <words> [role: model: since: until: limit:]",
+                      "Search all chat logs, e.g. --search docker compose role:assistant since:2024-06-01")
+        table.add_row("--archive [days]", "Compress chat logs not changed for this many days into chat_logs/archive.")
+        console.print(table)
+
+    async def run(self):
+        self.control_address = await self.control.start_async()
+        for session in self.sessions:
+            add_session_to_file(session.session_name, 'Open', self.control_address)
+        start_search_index_refresh(self.config)
+        loop = asyncio.get_running_loop()
+        if os.name == "posix":
+            # Ctrl-C 只取消前台会话的请求
+            loop.add_signal_handler(signal.SIGINT, self.cancel_active)
+        while self.running and self.sessions:
+            self.print_prompt()
+            self.read_task = asyncio.create_task(self.read_prompt())
+            try:
+                prompt = await self.read_task
+            except (EOFError, asyncio.CancelledError):
+                break
+            finally:
+                self.read_task = None
+            if not prompt.strip():
+                continue
+            try:
+                if "\n" not in prompt and await self.handle_commands(prompt):
+                    continue
+                await self.active.submit(prompt)
+            except Exception as e:
+                # 与同步模式一样只报告错误，继续读取输入，退出时仍会关闭所有会话
+                print(f"Input error: {e}")
+        for session in self.sessions[:]:
+            await self.close_session(session)
+        if os.name == "posix":
+            loop.remove_signal_handler(signal.SIGINT)
+        self.control.close()
+        await close_async_client()
+
+
+def run_engine(bot, total_token_usage):
+    """以单进程异步引擎模式运行，bot 作为第一个会话。"""
+    async def start():
+        engine = SessionEngine(bot.config)
+        engine.open_session(bot, total_token_usage)
+        await engine.run()
+
+    asyncio.run(start())
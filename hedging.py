@@ -0,0 +1,189 @@
+import asyncio
+import queue
+import threading
+from metrics import HISTOGRAMS, Histogram, load_all_metrics
+from scheduler import is_retryable
+
+DEFAULT_HEDGING_OPTIONS = {
+    "enabled": False,
+    "fallback_model": None,   # 为空时对冲请求使用同一个模型
+    "percentile": 95,         # 等待超过历史首 token 延迟（非流式为请求延迟）的这个百分位数时发出对冲请求
+    "deadline": 60,           # 样本不足时的等待秒数，同时也是等待时间的上限；为 null 时样本不足不对冲
+    "min_samples": 20,
+    "min_delay": 2.0,
+}
+
+
+def get_hedging_options(config):
+    """合并 config.json 中的 "hedging" 配置和默认值，未启用时返回 None。"""
+    options = dict(DEFAULT_HEDGING_OPTIONS)
+    options.update(config.get("hedging") or {})
+    return options if options["enabled"] else None
+
+
+class HedgePolicy:
+    """决定一次请求等待多久后发出对冲请求。
+
+    等待时间取该模型历史延迟的 percentile 百分位数（已保存的会话加上当前会话），
+    样本不足 min_samples 时使用 deadline，并限制在 [min_delay, deadline] 之间。
+    """
+
+    def __init__(self, options, log_directory):
+        self.fallback_model = options["fallback_model"]
+        self.percentile = options["percentile"]
+        self.deadline = options["deadline"]
+        self.min_samples = options["min_samples"]
+        self.min_delay = options["min_delay"]
+        self.log_directory = log_directory
+        self.history = None  # 已保存会话的指标，第一次需要时才加载
+        self.lock = threading.Lock()
+
+    def hedge_model(self, model):
+        return self.fallback_model or model
+
+    def delay(self, metrics, model, stream):
+        """返回发出对冲请求前等待的秒数，为 None 时不对冲。"""
+        name = "time_to_first_token_seconds" if stream else "request_latency_seconds"
+        with self.lock:
+            if self.history is None:
+                self.history = load_all_metrics(self.log_directory)
+        combined = Histogram(HISTOGRAMS[name][2])
+        for source in (self.history, metrics):
+            with source.lock:
+                histogram = source.histograms.get((name, model))
+                if histogram is not None and histogram.bounds == combined.bounds:
+                    combined.merge(histogram)
+        delay = self.deadline
+        if combined.count >= self.min_samples:
+            estimate = combined.percentile(self.percentile)
+            delay = estimate if delay is None else min(delay, estimate)
+        if delay is None:
+            return None
+        return max(delay, self.min_delay)
+
+
+class AttemptCancel:
+    """一个对冲请求的取消信号：另一个请求胜出时被设置，并调用已登记的关闭函数（例如关闭流式响应）。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.callbacks = []
+
+    def is_set(self):
+        return self.cancelled
+
+    def on_cancel(self, callback):
+        """登记取消时调用的函数，已经取消时立即调用。"""
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def set(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def run_hedged(open_attempt, models, delay, discard, on_hedge=None):
+    """同步执行对冲请求：先发出 models[0]，delay 秒内没有结果（或已失败）时再发出 models[1]。
+
+    每个请求在自己的线程中执行 open_attempt(model, cancel)，先成功返回的胜出，另一个请求的
+    cancel（AttemptCancel）随即被设置：尚未发出的不再发出，已经打开的响应由登记的函数关闭。
+    输掉的请求返回后交给 discard(model, result) 关闭并统计用量。
+    主请求因不可重试的错误（如参数错误）失败时直接抛出，不发出对冲请求。
+
+    Returns:
+        tuple: (胜出的序号, open_attempt 的返回值)。两个请求都失败时抛出主请求的异常。
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    state = {"winner": None}
+    cancels = [AttemptCancel() for _ in models]
+
+    def attempt(index):
+        try:
+            result = open_attempt(models[index], cancels[index])
+        except Exception as e:
+            results.put((index, None, e))
+            return
+        with lock:
+            won = state["winner"] is None
+            if won:
+                state["winner"] = index
+        if won:
+            for other, cancel in enumerate(cancels):
+                if other != index:
+                    cancel.set()
+            results.put((index, result, None))
+        else:
+            discard(models[index], result)
+
+    def launch(index):
+        threading.Thread(target=attempt, args=(index,), daemon=True).start()
+
+    launch(0)
+    started, errors = 1, []
+    while True:
+        try:
+            timeout = delay if started == 1 else None
+            index, result, error = results.get(timeout=timeout)
+        except queue.Empty:
+            index, result, error = None, None, None
+        if error is None and index is not None:
+            return index, result
+        if error is not None:
+            if started == 1 and not is_retryable(error):
+                raise error
+            errors.append((index, error))
+        if started == 1:
+            # 主请求超时或可重试的错误用尽重试次数，发出对冲请求
+            if on_hedge:
+                on_hedge()
+            launch(1)
+            started = 2
+        elif len(errors) == started:
+            raise min(errors, key=lambda item: item[0])[1]
+
+
+async def arun_hedged(open_attempt, models, delay, discard, on_hedge=None):
+    """run_hedged 的异步版本，open_attempt(model) 返回协程；输掉的请求被取消后调用 discard(model, None)。
+
+    与 run_hedged 一样，主请求因不可重试的错误失败时直接抛出。
+    """
+    tasks = {asyncio.ensure_future(open_attempt(models[0])): 0}
+    errors = []
+    try:
+        while True:
+            timeout = delay if len(tasks) == 1 and not errors else None
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = tasks.pop(task)
+                error = task.exception()
+                if error is None:
+                    return index, task.result()
+                if len(tasks) + len(errors) == 0 and not is_retryable(error):
+                    # 还没有发出对冲请求时，不可重试的错误直接抛出
+                    raise error
+                errors.append((index, error))
+            if len(errors) + len(tasks) == 1:
+                # 主请求超时或失败，发出对冲请求
+                if on_hedge:
+                    on_hedge()
+                tasks[asyncio.ensure_future(open_attempt(models[1]))] = 1
+            elif not tasks:
+                raise min(errors, key=lambda item: item[0])[1]
+    finally:
+        for task, index in tasks.items():
+            if not task.done():
+                task.cancel()
+                discard(models[index], None)
+            elif not task.cancelled() and task.exception() is None:
+                # 与胜出的请求同时完成
+                discard(models[index], task.result())
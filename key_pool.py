@@ -0,0 +1,148 @@
+import contextvars
+import threading
+import time
+
+# 调度器为当前请求（线程或异步任务）选出的 key，客户端据此发送请求
+current_api_key = contextvars.ContextVar("current_api_key", default=None)
+# 被限流且没有 Retry-After 时，key 移出轮换的秒数
+DEFAULT_COOLDOWN = 30.0
+DISABLING_STATUS_CODES = (401, 403)
+
+
+def mask_key(key):
+    return f"{key[:3]}...{key[-4:]}" if len(key) > 12 else "***"
+
+
+class ApiKey:
+    """池中的一个 API key：各自的 RPM/TPM 令牌桶、健康状态和用量统计。"""
+
+    def __init__(self, key, name=None, requests_per_minute=None, tokens_per_minute=None):
+        from scheduler import TokenBucket
+        self.key = key
+        self.name = name or mask_key(key)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.tokens = 0
+        self.cooldown_until = 0.0
+        self.disabled = None  # 被停用的原因
+
+    def wait_time(self, estimated_tokens, now):
+        """现在使用这个 key 需要等待的秒数（不预留令牌）。"""
+        wait = max(0.0, self.cooldown_until - now)
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.wait_time(1))
+        if self.token_bucket and estimated_tokens:
+            wait = max(wait, self.token_bucket.wait_time(estimated_tokens))
+        return wait
+
+    def reserve(self, estimated_tokens, now):
+        wait = max(0.0, self.cooldown_until - now)
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket and estimated_tokens:
+            wait = max(wait, self.token_bucket.reserve(estimated_tokens))
+        return wait
+
+    def status(self):
+        if self.disabled:
+            return f"disabled ({self.disabled})"
+        remaining = self.cooldown_until - time.monotonic()
+        if remaining > 0:
+            return f"rate limited ({remaining:.0f}s)"
+        return "ok"
+
+
+class KeyPool:
+    """API key 池：每次请求选用等待时间最短、并发最少的健康 key。
+
+    限流（429）的 key 在 Retry-After 期间移出轮换，认证失败或额度用尽的 key 停用，
+    直到通过 --add key 重新加入。
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """由 config.json 的 "api_keys"（没有时使用 "api_key"）创建。"""
+        entries = config.get("api_keys") or [{"key": config["api_key"]}]
+        return cls([ApiKey(entry["key"], entry.get("name"), entry.get("requests_per_minute"),
+                           entry.get("tokens_per_minute")) for entry in entries])
+
+    def add(self, key):
+        """加入一个 key；已在池中时重新启用。"""
+        with self.lock:
+            for api_key in self.keys:
+                if api_key.key == key:
+                    api_key.disabled = None
+                    api_key.cooldown_until = 0.0
+                    return api_key
+            api_key = ApiKey(key)
+            self.keys.append(api_key)
+            return api_key
+
+    def acquire(self, estimated_tokens=0):
+        """选出一个 key 并预留配额，返回 (key, 需要等待的秒数)。所有 key 都已停用时抛出 RuntimeError。"""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [k for k in self.keys if not k.disabled]
+            if not candidates:
+                raise RuntimeError("All API keys are disabled. Use --add key <api_key> to add a working key.")
+            api_key = min(candidates, key=lambda k: (k.wait_time(estimated_tokens, now), k.in_flight, k.requests))
+            wait = api_key.reserve(estimated_tokens, now)
+            api_key.in_flight += 1
+        return api_key, wait
+
+    def release(self, api_key, succeeded):
+        with self.lock:
+            api_key.in_flight -= 1
+            if succeeded:
+                api_key.requests += 1
+
+    def report_error(self, api_key, error, retry_after=None):
+        """请求失败时调用：限流的 key 暂时移出轮换，认证失败的 key 停用。
+
+        Returns:
+            bool: key 被移出轮换且池中还有其他可用 key 时返回 True，调用方可以立即换 key 重试。
+        """
+        status_code = getattr(error, "status_code", None)
+        with self.lock:
+            api_key.errors += 1
+            if status_code in DISABLING_STATUS_CODES or getattr(error, "code", None) == "insufficient_quota":
+                api_key.disabled = "insufficient quota" if status_code == 429 else f"HTTP {status_code}"
+                print(f"API key {api_key.name} disabled: {api_key.disabled}")
+            elif status_code == 429:
+                api_key.rate_limited += 1
+                api_key.cooldown_until = time.monotonic() + (retry_after or DEFAULT_COOLDOWN)
+            else:
+                return False
+            now = time.monotonic()
+            return any(not k.disabled and k.cooldown_until <= now for k in self.keys)
+
+    def refund(self, api_key, estimated_tokens):
+        """归还失败的请求为这个 key 预留的 RPM/TPM 配额。"""
+        if api_key.request_bucket:
+            api_key.request_bucket.refund(1)
+        if api_key.token_bucket and estimated_tokens:
+            api_key.token_bucket.refund(estimated_tokens)
+
+    def settle(self, api_key, estimated_tokens, actual_tokens):
+        """请求完成后按实际 Token 数修正该 key 的 TPM 令牌桶并累计用量。"""
+        if actual_tokens is None:
+            return
+        if api_key.token_bucket:
+            api_key.token_bucket.adjust(estimated_tokens - actual_tokens)
+        with self.lock:
+            api_key.tokens += actual_tokens
+
+    def stats(self):
+        """每个 key 一个字典：名称、状态、并发数、请求数、错误数、限流次数和 Token 用量。"""
+        with self.lock:
+            return [{"name": k.name, "status": k.status(), "in_flight": k.in_flight, "requests": k.requests,
+                     "errors": k.errors, "rate_limited": k.rate_limited, "tokens": k.tokens}
+                    for k in self.keys]
@@ -0,0 +1,232 @@
+import json
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from session_records import parse_markdown_text, sidecar_paths
+from usage_ledger import HEADER_READ_SIZE, parse_log_header
+
+ARCHIVE_DIRECTORY = "archive"
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "manifest.lock"
+READ_CHUNK_SIZE = 64 * 1024
+_manifest_lock = threading.Lock()
+
+
+def archive_directory(log_directory):
+    return os.path.join(log_directory, ARCHIVE_DIRECTORY)
+
+
+def member_paths(log_path):
+    """日志及其附属文件的路径：Markdown、结构化记录和性能指标。"""
+    stem = os.path.splitext(log_path)[0]
+    return {"md": log_path, "jsonl": sidecar_paths(log_path)[0], "metrics": f"{stem}.metrics.json"}
+
+
+@contextmanager
+def manifest_lock(log_directory):
+    """归档清单的跨进程锁：进程内用 threading.Lock，进程之间用锁文件上的系统文件锁，
+    多个窗口同时归档或恢复日志时，清单的读取-修改-写入不会互相覆盖。"""
+    directory = archive_directory(log_directory)
+    os.makedirs(directory, exist_ok=True)
+    with _manifest_lock, open(os.path.join(directory, LOCK_FILE), "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    # LK_LOCK 重试 10 次（约 10 秒）后仍被占用时抛出 OSError，继续等待
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def load_manifest(log_directory):
+    """读取归档清单：日志文件名 -> 所在分段、各成员的位置和使用量统计。没有归档时返回空字典。"""
+    path = os.path.join(archive_directory(log_directory), MANIFEST_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["logs"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_manifest(log_directory, logs):
+    path = os.path.join(archive_directory(log_directory), MANIFEST_FILE)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "logs": logs}, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def compress_member(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31：gzip 格式
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_member(log_directory, location):
+    """流式解压一个归档成员，逐块产出原始字节。
+
+    Args:
+        location (list): [分段文件名, 偏移量, 压缩后长度]。
+    """
+    segment, offset, length = location
+    decompressor = zlib.decompressobj(31)
+    with open(os.path.join(archive_directory(log_directory), segment), "rb") as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError(f"Archive segment {segment} is truncated.")
+            remaining -= len(chunk)
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def read_member(log_directory, entry, member):
+    """读取归档日志的一个成员（md、jsonl 或 metrics），不存在时返回 None。"""
+    location = entry["members"].get(member)
+    if location is None:
+        return None
+    return b"".join(iter_member(log_directory, location))
+
+
+def iter_archived_lines(log_directory, location):
+    """流式解压并逐行产出一个归档成员（不含换行符），不完整的最后一行被丢弃。"""
+    pending = b""
+    for data in iter_member(log_directory, location):
+        lines = (pending + data).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+
+
+def read_archived_messages(log_directory, entry, start=0):
+    """读取归档日志中第 start 条及之后的消息：优先使用结构化记录，否则解析 Markdown。"""
+    location = entry["members"].get("jsonl")
+    if location is None:
+        text = read_member(log_directory, entry, "md").decode("utf-8", errors="replace")
+        return parse_markdown_text(text)[start:]
+    messages = []
+    for i, line in enumerate(iter_archived_lines(log_directory, location)):
+        if i >= start and line:
+            record = json.loads(line)
+            messages.append({"role": record["role"], "content": record["content"]})
+    return messages
+
+
+def archive_logs(log_directory, older_than_days, exclude=()):
+    """把超过 older_than_days 天未修改的日志打包进一个新的压缩分段，并从日志目录中删除原文件。
+
+    Args:
+        log_directory (str): 日志目录。
+        older_than_days (float): 最后修改时间早于这么多天前的日志会被归档。
+        exclude (iterable): 仍在使用中的日志路径（包括其他进程中的会话），不归档。
+
+    Returns:
+        tuple: (归档的日志数, 归档前的字节数, 分段文件的字节数)。
+    """
+    # 整个归档过程持有清单锁，其他进程不会同时归档同一批日志
+    with manifest_lock(log_directory):
+        return _archive_logs(log_directory, older_than_days, exclude)
+
+
+def _archive_logs(log_directory, older_than_days, exclude):
+    cutoff = time.time() - older_than_days * 86400
+    open_names = {os.path.basename(name) for name in exclude}
+    candidates = []
+    with os.scandir(log_directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".md") and entry.name not in open_names:
+                if entry.stat().st_mtime < cutoff:
+                    candidates.append(entry.path)
+    if not candidates:
+        return 0, 0, 0
+
+    # 每个日志的各个文件分别压缩为独立的 gzip 成员，可以单独定位和解压，整个分段仍是合法的 gzip 文件
+    stem = f"segment_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+    segment = f"{stem}.gz"
+    # 同一秒内再次归档时不能覆盖已登记在清单中的分段
+    suffix = 1
+    while os.path.exists(os.path.join(archive_directory(log_directory), segment)):
+        suffix += 1
+        segment = f"{stem}_{suffix}.gz"
+    segment_path = os.path.join(archive_directory(log_directory), segment)
+    new_entries = {}
+    raw_bytes = 0
+    with open(segment_path, "wb") as out:
+        for log_path in sorted(candidates):
+            paths = member_paths(log_path)
+            entry = {"segment": segment, "members": {}}
+            for member, path in paths.items():
+                if not os.path.exists(path):
+                    continue
+                with open(path, "rb") as f:
+                    data = f.read()
+                if member == "md":
+                    header = parse_log_header(data[:HEADER_READ_SIZE])
+                    entry.update({key: header[key] for key in (
+                        "day", "model", "input_tokens", "cached_tokens", "output_tokens", "cost")})
+                    entry["size"] = len(data)
+                compressed = compress_member(data)
+                entry["members"][member] = [segment, out.tell(), len(compressed)]
+                out.write(compressed)
+                raw_bytes += len(data)
+            new_entries[os.path.basename(log_path)] = entry
+        out.flush()
+        os.fsync(out.fileno())
+
+    logs = load_manifest(log_directory)
+    logs.update(new_entries)
+    save_manifest(log_directory, logs)
+
+    # 清单落盘后才删除原文件
+    for log_path in candidates:
+        for path in list(member_paths(log_path).values()) + [sidecar_paths(log_path)[1]]:
+            if os.path.exists(path):
+                os.remove(path)
+    return len(new_entries), raw_bytes, os.path.getsize(segment_path)
+
+
+def restore_log(log_directory, name):
+    """把一个归档日志流式解压回日志目录（例如 --continue 时），并从清单中移除。
+
+    Returns:
+        bool: 清单中有该日志并已恢复时返回 True。
+    """
+    if name not in load_manifest(log_directory):
+        return False
+    with manifest_lock(log_directory):
+        logs = load_manifest(log_directory)
+        entry = logs.get(name)
+        if entry is None:
+            return False
+        paths = member_paths(os.path.join(log_directory, name))
+        for member, location in entry["members"].items():
+            temp_path = f"{paths[member]}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                for data in iter_member(log_directory, location):
+                    f.write(data)
+            os.replace(temp_path, paths[member])
+        del logs[name]
+        save_manifest(log_directory, logs)
+    return True
@@ -0,0 +1,322 @@
+import mmap
+import os
+import queue
+import threading
+import time
+from session_records import INDEX_ENTRY, encode_record, read_offsets, sidecar_paths
+from utils import calculate_cost
+
+# 头部数值字段的固定宽度，保证头部长度不变，可以原地覆盖
+HEADER_NUMBER_WIDTH = 12
+HEADER_COST_WIDTH = 16
+FLUSH_POLICIES = ("write", "interval", "close")
+
+# 本进程已分配的日志文件名（文件在首次写入时才创建，不能只靠检查文件是否存在）
+_claimed_file_names = set()
+_claimed_file_names_lock = threading.Lock()
+
+
+def claim_log_file_name(directory, stem):
+    """分配一个未被占用的日志文件名，同一秒内创建的多个会话会追加序号。
+
+    Args:
+        directory (str): 日志目录。
+        stem (str): 不含扩展名的文件名，如 chat_20241204_233543。
+
+    Returns:
+        str: 日志文件路径。
+    """
+    with _claimed_file_names_lock:
+        file_name = f"{directory}/{stem}.md"
+        suffix = 2
+        while file_name in _claimed_file_names or os.path.exists(file_name):
+            file_name = f"{directory}/{stem}_{suffix}.md"
+            suffix += 1
+        _claimed_file_names.add(file_name)
+    return file_name
+
+
+def format_log_header(session_start_time, model, token_usage, pricing):
+    """生成定长的日志头部。
+
+    数值字段用空格右侧补齐到固定宽度，因此 Token 统计变化时头部的字节长度不变。
+
+    Args:
+        session_start_time (datetime): 会话开始时间。
+        model (str): 使用的模型名称。
+        token_usage (dict): Token 使用数据。
+        pricing (list): Token 价格 [input, cached input, output]。
+
+    Returns:
+        str: Markdown 格式的日志头部。
+    """
+    token_usage = token_usage or {}
+    input_tokens = token_usage.get("prompt_tokens", 0)
+    cached_tokens = token_usage.get("cached_tokens", 0)
+    output_tokens = token_usage.get("completion_tokens", 0)
+    cost = calculate_cost(token_usage, pricing) if token_usage else 0
+
+    header = f"# Chat Log - {session_start_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+    header += f"**Model**: {model}\n"
+    header += f"**Token Usage**:\n"
+    header += f"- Input Tokens: {input_tokens:<{HEADER_NUMBER_WIDTH}}\n"
+    header += f"- Cached Tokens: {cached_tokens:<{HEADER_NUMBER_WIDTH}}\n"
+    header += f"- Output Tokens: {output_tokens:<{HEADER_NUMBER_WIDTH}}\n"
+    header += f"**Cost**: {f'${cost:.4f}':<{HEADER_COST_WIDTH}}\n\n"
+    return header
+
+
+class ChatLogWriter:
+    """只追加的 Markdown 聊天日志写入器。
+
+    - 每条消息只做一次追加写入，不再读取并重写整个文件。
+    - 头部为定长格式，Token 统计原地更新。
+    - 每条完整消息同时写入旁边的 .jsonl 结构化记录和 .idx 偏移索引，用于无损、快速地恢复会话。
+    - 所有写操作在后台线程中执行，不阻塞请求路径。
+
+    刷新策略 (flush_policy)：
+        "write": 每批写入后立即刷新；
+        "interval": 最多每 flush_interval 秒刷新一次；
+        "close": 只在关闭时刷新。
+    fsync 为 True 时，每次刷新后调用 os.fsync 落盘。
+    on_write 为每个写操作（包括刷新）完成后的回调，参数为耗时（秒）；
+    on_record 在每条结构化记录写入后以 (消息, 序号) 为参数调用（例如更新搜索索引）。
+    后台线程中的写入错误会被保存，在下一次 flush、close 或 raise_error 时抛出给会话。
+    """
+
+    def __init__(self, file_path, session_start_time, model, pricing,
+                 flush_policy="write", flush_interval=1.0, fsync=False, on_write=None, on_record=None):
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError(f"Unknown log flush policy: {flush_policy}")
+        self.file_path = file_path
+        self.session_start_time = session_start_time
+        self.model = model
+        self.pricing = pricing
+        self.flush_policy = flush_policy
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.on_write = on_write
+        self.on_record = on_record
+        self.token_usage = None
+        self.file = None
+        self.records_file = None
+        self.index_file = None
+        self.record_count = 0
+        self.header_length = 0
+        self.checkpoint_offset = None  # 检查点在正文中的位置（不含头部，头部长度可能变化）
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        self.closed = False
+        self.error = None  # 后台线程中尚未报告的写入错误
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, text):
+        """在日志末尾追加文本（异步）。"""
+        if text:
+            self.queue.put(("append", text))
+
+    def record(self, message, model=None):
+        """把一条完整消息写入结构化记录（异步），model 为回答这条消息的模型。"""
+        payload = {"role": message["role"], "content": message["content"]}
+        if model:
+            payload["model"] = model
+        self.queue.put(("record", payload))
+
+    def checkpoint(self):
+        """在当前日志末尾设置检查点（异步），之后可以用 rollback 撤销检查点之后追加的文本。"""
+        self.queue.put(("checkpoint", None))
+
+    def rollback(self):
+        """把日志截断到检查点（异步），没有检查点时不做任何事。结构化记录不受影响。"""
+        self.queue.put(("rollback", None))
+
+    def commit(self):
+        """清除检查点（异步）。"""
+        self.queue.put(("commit", None))
+
+    def update_usage(self, token_usage):
+        """更新头部的 Token 统计（异步）。"""
+        self.queue.put(("usage", dict(token_usage)))
+
+    def flush(self):
+        """刷新缓冲区并等待所有已提交的写操作完成，之前有写入失败时抛出该错误。"""
+        if self.closed:
+            return
+        self.queue.put(("flush", None))
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        """写完所有待处理的操作并关闭文件，之前有写入失败时抛出该错误。"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(("close", None))
+        self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        """抛出后台线程中尚未报告的写入错误（不等待待处理的写操作，每个错误只抛出一次）。"""
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.flush_policy == "interval" and self.dirty:
+                timeout = max(0.0, self.flush_interval - (time.monotonic() - self.last_flush))
+            try:
+                kind, payload = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._guarded(self._timed, self._flush)
+                continue
+            if kind == "close":
+                self._guarded(self._close)
+                self.queue.task_done()
+                return
+            start_time = time.perf_counter()
+            self._guarded(self._apply, kind, payload)
+            self.queue.task_done()
+            if self.on_write:
+                self.on_write(time.perf_counter() - start_time)
+
+    def _apply(self, kind, payload):
+        if kind == "append":
+            self._append(payload)
+        elif kind == "record":
+            self._record(payload)
+            if self.on_record:
+                self.on_record(payload, self.record_count - 1)
+        elif kind == "usage":
+            self._update_header(payload)
+        elif kind == "checkpoint":
+            self._open()
+            self.checkpoint_offset = self.file.seek(0, os.SEEK_END) - self.header_length
+        elif kind == "rollback":
+            self._rollback()
+        elif kind == "commit":
+            self.checkpoint_offset = None
+        elif kind == "flush":
+            self._flush()
+        if self.flush_policy == "write" and self.queue.empty():
+            self._flush()
+        elif self.flush_policy == "interval" and time.monotonic() - self.last_flush >= self.flush_interval:
+            self._flush()
+
+    def _guarded(self, operation, *args):
+        """在后台线程中执行写操作，出错时保留第一个错误，由会话在下一次 flush/close 时报告。"""
+        try:
+            operation(*args)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+    def _close(self):
+        try:
+            self._flush()
+        finally:
+            files = (self.file, self.records_file, self.index_file)
+            self.file = self.records_file = self.index_file = None
+            for file in files:
+                if file:
+                    file.close()
+
+    def _timed(self, operation):
+        start_time = time.perf_counter()
+        operation()
+        if self.on_write:
+            self.on_write(time.perf_counter() - start_time)
+
+    def _header_bytes(self):
+        return format_log_header(self.session_start_time, self.model,
+                                 self.token_usage, self.pricing).encode("utf-8")
+
+    def _open(self):
+        """首次写入时才创建文件，这样空会话不会留下日志。"""
+        if self.file:
+            return
+        header = self._header_bytes()
+        if os.path.exists(self.file_path):
+            with open(self.file_path, "rb") as f:
+                existing = f.read()
+            split_index = existing.find(b"## ")
+            body = existing[split_index:] if split_index != -1 else b""
+            if split_index != len(header):
+                # 头部不是定长格式（旧日志），一次性重写整个文件
+                with open(self.file_path, "wb") as f:
+                    f.write(header + body)
+        else:
+            with open(self.file_path, "wb") as f:
+                f.write(header)
+        self.file = open(self.file_path, "r+b")
+        self.file.seek(0, os.SEEK_END)
+        self.header_length = len(header)
+
+    def _append(self, text):
+        self._open()
+        self.file.write(text.encode("utf-8"))
+        self.dirty = True
+
+    def _rollback(self):
+        if self.checkpoint_offset is None:
+            return
+        self.file.truncate(self.header_length + self.checkpoint_offset)
+        self.file.seek(0, os.SEEK_END)
+        self.checkpoint_offset = None
+        self.dirty = True
+
+    def _open_records(self):
+        if self.records_file:
+            return
+        records_path, index_path = sidecar_paths(self.file_path)
+        if os.path.exists(records_path) and os.path.getsize(records_path) > 0:
+            with open(records_path, "r+b") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    # 校验（必要时重建）索引，并截掉中断写入留下的不完整记录
+                    self.record_count = len(read_offsets(data, index_path))
+                    end = data.rfind(b"\n") + 1
+                if end != os.path.getsize(records_path):
+                    f.truncate(end)
+        self.records_file = open(records_path, "ab")
+        self.index_file = open(index_path, "ab")
+
+    def _record(self, message):
+        self._open_records()
+        offset = self.records_file.tell()
+        self.records_file.write(encode_record(message))
+        self.index_file.write(INDEX_ENTRY.pack(offset))
+        self.record_count += 1
+        self.dirty = True
+
+    def _update_header(self, token_usage):
+        self.token_usage = token_usage
+        self._open()
+        header = self._header_bytes()
+        if len(header) == self.header_length:
+            self.file.seek(0)
+            self.file.write(header)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            # 数值超出固定宽度，退化为重写整个文件
+            self.file.flush()
+            self.file.seek(self.header_length)
+            body = self.file.read()
+            self.file.seek(0)
+            self.file.write(header + body)
+            self.file.truncate()
+            self.header_length = len(header)
+        self.dirty = True
+
+    def _flush(self):
+        if not self.dirty:
+            return
+        for file in (self.file, self.records_file, self.index_file):
+            if file:
+                file.flush()
+                if self.fsync:
+                    os.fsync(file.fileno())
+        self.dirty = False
+        self.last_flush = time.monotonic()
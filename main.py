@@ -1,16 +1,24 @@
+import time
+# 用于 --bench-startup 统计导入耗时
+IMPORT_START_TIME = time.perf_counter()
 import os
-import openai
 import sys
-from datetime import datetime
+from chatgpt import ChatGPT
+from commands import (
+    console, print_current_usage, print_total_usage, print_log_files, print_cache_stats, split_fresh_prefix,
+    close_other_processes, set_render_mode, print_stats, print_search_results, start_search_index_refresh,
+    archive_old_logs, add_api_key, print_key_stats, print_cancel_result, attach_file, add_attachments,
+    manage_memory, parse_attach_command, read_attachment
+)
+from control import ControlServer, focus_console_window, send_command
+from renderer import get_renderer
+from prompt_input import get_input_options, read_prompt, read_terminal_line
 from utils import (
-    load_config, save_chat_to_markdown, calculate_cost, format_markdown, calculate_total_cost, list_log_files,
-    load_chat_history, add_session_to_file, remove_session_from_file, get_all_sessions_from_file
+    calculate_cost, add_session_to_file, remove_session_from_file, get_all_sessions_from_file
 )
-from rich.console import Console
-from rich.markdown import Markdown
 from rich.table import Table
 import threading
-import time
+import queue
 import argparse
 import subprocess
 import traceback
@@ -19,7 +27,6 @@ import traceback
 os.system('')
 
 exit_event = threading.Event()  # 创建全局退出事件
-console = Console(width=100)
 conversations = []
 conversations_lock = threading.Lock()
 
@@ -27,119 +34,287 @@ class Conversation:
     def __init__(self, bot, total_token_usage):
         self.bot = bot
         self.total_token_usage = total_token_usage
-        self.prompt_queue = []
-        self.response_ready = threading.Event()
-        self.waiting_for_response = False
+        # 用户可以继续输入，提示按顺序排队处理；None 通知处理线程退出
+        self.prompt_queue = queue.Queue()
+        self.pending = 0  # 排队中和进行中的提示数
+        self.request = None  # 进行中的请求
+        self.last_cancel_time = 0.0
+        self.attachments = []  # --file 读取的文件，随下一条消息发送
+        self.input_options = get_input_options(bot.config)
+        self.stream_parts = []
+        self.renderer = get_renderer(bot.config, console)
         self.lock = threading.Lock()
         self.input_thread = threading.Thread(target=self.user_input_loop, daemon=True)
-        self.gpt_thread = None
+        self.gpt_thread = threading.Thread(target=self.gpt_reply_loop, daemon=True)
         self.session_name = self.bot.log_file_name
         self.exit_event = threading.Event()  # 为每个会话添加一个退出事件
         self.closed = False
         self.token_usage_lock = threading.Lock()
+        self.on_first_prompt = None  # 第一次显示输入提示前调用（--bench-startup 的子进程在这里报告耗时）
 
-    def start(self):
-        add_session_to_file(self.session_name, 'Open')
+    def start(self, control_address=None):
+        add_session_to_file(self.session_name, 'Open', control_address)
+        self.gpt_thread.start()
         self.input_thread.start()
 
     def close(self):
         """关闭当前会话，停止线程并清理资源。"""
         self.exit_event.set()
         self.closed = True
-        # 通知等待中的线程
-        self.response_ready.set()
-        # 等待 GPT 回复线程结束
-        if self.gpt_thread and self.gpt_thread.is_alive():
+        # 通知处理线程退出，它会等进行中的请求结束
+        self.prompt_queue.put(None)
+        if self.gpt_thread.is_alive():
             self.gpt_thread.join()
-        # 等待输入线程结束
-        if threading.current_thread() != self.input_thread and self.input_thread.is_alive():
-            self.input_thread.join()
+        # 输入线程可能阻塞在 input() 上，它是守护线程，会随进程退出，这里不等待
         # 更新会话状态文件
         remove_session_from_file(self.session_name)
-        # 检查是否有聊天内容
-        if not self.bot.has_messages():
-            # 删除日志文件
-            if os.path.exists(self.bot.log_file_name):
-                os.remove(self.bot.log_file_name)
+        # 写完所有待处理的日志
+        self.bot.close_log()
+        # 没有聊天内容时删除日志文件
+        if self.bot.remove_empty_log():
             print(f"Session {self.session_name} was empty and has been deleted.")
         else:
             print(f"Session {self.session_name} has been closed.")
 
+    def is_busy(self):
+        with self.lock:
+            return self.pending > 0
+
     def user_input_loop(self):
         while not self.exit_event.is_set() and not exit_event.is_set():
-            # 检查退出标志文件
-            if os.path.exists("exit_flag.txt"):
-                print("Exit flag detected. Closing conversation.")
-                self.close()
-                break
             try:
-                if not self.waiting_for_response:
+                if not self.is_busy():
+                    if self.on_first_prompt:
+                        self.on_first_prompt()
+                        self.on_first_prompt = None
                     print("\033[31mYou: \033[0m", end="")
-                    prompt = input("")
-                    if self.handle_commands(prompt):
-                        continue
-                    with self.lock:
-                        self.prompt_queue.append(prompt)
-                        self.waiting_for_response = True
-                    self.response_ready.clear()
-                    self.gpt_thread = threading.Thread(target=self.gpt_reply_loop, daemon=True)
-                    self.gpt_thread.start()
-                else:
-                    self.response_ready.wait(timeout=1)
+                # 一次粘贴的多行内容合并为一条消息
+                prompt = read_prompt(read_terminal_line, self.input_options["paste_burst_seconds"])
+                if "\n" not in prompt and self.handle_commands(prompt):
+                    continue
+                self.submit(prompt)
             except EOFError:
+                # Windows 下 Ctrl-C 会让 input() 抛出 EOFError，取消请求后继续读取输入
+                time.sleep(0.2)
+                if time.monotonic() - self.last_cancel_time < 1:
+                    continue
                 break
             except Exception as e:
                 print(f"Input error: {e}")
-                break
+                continue
 
-    def gpt_reply_loop(self):
-        if self.exit_event.is_set() or exit_event.is_set():
-            return
-            # 检查退出标志文件
-        if os.path.exists("exit_flag.txt"):
-            print("Exit flag detected in GPT thread. Closing conversation.")
-            self.close()
-            return
+    def submit(self, prompt, attachment=None):
+        """把一条消息（连同 --file 附加的文件）加入队列，attachment 为 --attach 的文件路径。"""
+        prompt, use_cache = split_fresh_prefix(prompt)
+        prompt = add_attachments(prompt, self.attachments)
         with self.lock:
-            if not self.prompt_queue:
-                return
-            prompt = self.prompt_queue.pop(0)
-        self.waiting_for_response = True
-
-        loading_thread = threading.Thread(target=self.loading_indicator, daemon=True)
-        loading_thread.start()
-        response, token_usage = self.bot.chat(prompt)
-        self.waiting_for_response = False  # 停止加载指示器
-        loading_thread.join()  # 等待加载指示器线程结束
-        print("\n")  # 确保输出位置正确
-        if response is not None:
-            console.print(Markdown(f"# AI Response\n{response}"))
-        else:
-            print("Failed to get a response from the AI.")
-
-        if token_usage is not None:
-            with self.token_usage_lock:
-                self.total_token_usage["prompt_tokens"] += token_usage.get("prompt_tokens", 0)
-                self.total_token_usage["completion_tokens"] += token_usage.get("completion_tokens", 0)
-                if "cached_tokens" in token_usage:
-                    self.total_token_usage["cached_tokens"] += token_usage.get("cached_tokens", 0)
-        else:
-            print("Token usage information is not available.")
+            ahead = self.pending
+            self.pending += 1
+        self.prompt_queue.put((prompt, use_cache, attachment))
+        if ahead:
+            console.print(f"[dim](queued, {ahead} ahead)[/dim]")
 
-        self.response_ready.set()
+    def gpt_reply_loop(self):
+        """按顺序处理排队的提示。每个请求在单独的线程中执行，被取消时不再等待它结束。"""
+        while True:
+            item = self.prompt_queue.get()
+            if item is None or self.exit_event.is_set() or exit_event.is_set():
+                return
+            prompt, use_cache, attachment = item
+            request = {"done": threading.Event(), "started": False, "cancelled": False,
+                       "spinner": False, "spinner_thread": None, "live": None, "status": None}
+            with self.lock:
+                self.request = request
+            threading.Thread(target=self.reply, args=(prompt, use_cache, attachment, request), daemon=True).start()
+            request["done"].wait()
+            with self.lock:
+                self.request = None
+                self.pending -= 1
+                idle = self.pending == 0
+            if request["cancelled"]:
+                self.stop_display(request)
+                print("\nRequest cancelled.")
+            if idle and not self.exit_event.is_set() and not exit_event.is_set():
+                print("\033[31mYou: \033[0m", end="", flush=True)
+
+    def reply(self, prompt, use_cache, attachment, request):
+        """执行一个请求并显示响应；请求被取消后不再输出任何内容。"""
+        try:
+            if attachment:
+                prompt = self.read_attachment(attachment, prompt, request)
+                if prompt is None:
+                    return
+            with self.lock:
+                if request["cancelled"]:
+                    return
+                request["started"] = True
+            if self.bot.stream:
+                response, token_usage = self.stream_reply(prompt, use_cache, request)
+            else:
+                self.start_spinner(request)
+                response, token_usage = self.bot.chat(prompt, use_cache=use_cache)
+                if request["cancelled"]:
+                    return
+                self.stop_display(request)
+                print("\n")  # 确保输出位置正确
+                if response is not None:
+                    render_start = time.perf_counter()
+                    self.renderer.render(response)
+                    self.bot.metrics.observe("render_seconds", self.bot.model, time.perf_counter() - render_start)
+            if request["cancelled"]:
+                return
+            if response is None:
+                print("Failed to get a response from the AI.")
+
+            if token_usage is not None:
+                with self.token_usage_lock:
+                    self.total_token_usage["prompt_tokens"] += token_usage.get("prompt_tokens", 0)
+                    self.total_token_usage["completion_tokens"] += token_usage.get("completion_tokens", 0)
+                    if "cached_tokens" in token_usage:
+                        self.total_token_usage["cached_tokens"] += token_usage.get("cached_tokens", 0)
+            else:
+                print("Token usage information is not available.")
+        finally:
+            request["done"].set()
+
+    def read_attachment(self, path, question, request):
+        """--attach 的分块处理阶段，加载指示器显示进度；返回最终发送的提示。"""
+        name = os.path.basename(path)
+        request["status"] = f"Reading {name}"
+        self.start_spinner(request)
+
+        def on_progress(done, total):
+            request["status"] = f"Reading {name}: {done}/{total} parts"
+
+        prompt, summary = read_attachment(self.bot, path, question, lambda: request["cancelled"], on_progress)
+        if request["cancelled"]:
+            return None
+        self.stop_display(request)
+        request["status"] = None
+        if summary:
+            console.print(f"[dim]{summary}[/dim]" if prompt else summary)
+        return prompt
+
+    def cancel(self, drain=False):
+        """取消进行中的请求，drain 为 True 时同时丢弃排队中的提示。
+
+        被取消的请求不会在消息列表和日志中留下半个回合；无法中断的非流式请求在后台结束，用量之后再计入。
+
+        Returns:
+            tuple: (是否取消了进行中的请求, 丢弃的排队提示数)。
+        """
+        dropped = 0
+        if drain:
+            while True:
+                try:
+                    item = self.prompt_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # 会话正在关闭，放回退出通知
+                    self.prompt_queue.put(None)
+                    break
+                dropped += 1
         with self.lock:
-            self.waiting_for_response = False
+            self.pending -= dropped
+            request = self.request
+            cancelled = request is not None and not request["done"].is_set()
+            if cancelled and not self.bot.cancel() and request["started"]:
+                # 响应已经完整收到，只差显示
+                cancelled = False
+            if cancelled:
+                request["cancelled"] = True
+                self.last_cancel_time = time.monotonic()
+        if cancelled:
+            request["done"].set()
+        return cancelled, dropped
+
+    def start_spinner(self, request):
+        request["spinner"] = True
+        request["spinner_thread"] = threading.Thread(target=self.loading_indicator, args=(request,), daemon=True)
+        request["spinner_thread"].start()
+
+    def stop_display(self, request):
+        """停止请求的加载指示器和实时渲染（可以重复调用）。"""
+        request["spinner"] = False
+        if request["spinner_thread"] is not None:
+            request["spinner_thread"].join()
+        live = request["live"]
+        if live is not None:
+            request["live"] = None
+            live.refresh()
+            live.stop()
+
+    def stream_reply(self, prompt, use_cache, request):
+        """流式获取 AI 响应：首个 token 到达前显示加载指示器，之后实时刷新 Markdown 视图。"""
+        self.stream_parts = []
+        self.start_spinner(request)
+        started = False
+        passthrough = False
+        line_count = 0
+
+        def on_delta(delta):
+            nonlocal started, passthrough, line_count
+            if request["cancelled"]:
+                return
+            if not started:
+                # 收到首个 token，停止加载指示器并开始实时渲染
+                started = True
+                self.stop_display(request)
+                print("\n")
+                if self.renderer.mode == "raw":
+                    passthrough = True
+                    self.renderer.write_raw("AI Response\n")
+                else:
+                    # Markdown 只在每次刷新时解析一次，避免每个 token 都重新解析全文
+                    from rich.live import Live
+                    request["live"] = Live(get_renderable=self.render_stream, console=console,
+                                           refresh_per_second=8, vertical_overflow="visible")
+                    request["live"].start()
+            self.stream_parts.append(delta)
+            line_count += delta.count("\n")
+            if passthrough:
+                self.renderer.write_raw(delta)
+            elif self.renderer.mode == "auto" and line_count > self.renderer.options["large_response_lines"]:
+                # 响应太长，每次刷新都重新解析全文会越来越慢：停止实时渲染，之后的内容原样输出
+                self.stop_display(request)
+                passthrough = True
 
-    def loading_indicator(self):
+        try:
+            response, token_usage = self.bot.chat(prompt, on_delta=on_delta, use_cache=use_cache)
+        finally:
+            if not request["cancelled"]:
+                # 被取消时由处理线程清理显示
+                was_live = request["live"] is not None
+                self.stop_display(request)
+                if passthrough:
+                    self.renderer.write_raw("\n\n")
+                elif not was_live:
+                    print("\n")
+        if self.bot.last_ttft is not None and not request["cancelled"]:
+            console.print(f"[dim]Time to first token: {self.bot.last_ttft:.2f}s[/dim]")
+        return response, token_usage
+
+    def render_stream(self):
+        from rich.markdown import Markdown
+        return Markdown("# AI Response\n" + "".join(self.stream_parts))
+
+    def loading_indicator(self, request):
         frames = ["◐", "◓", "◑", "◒"]
-        while self.waiting_for_response and not self.exit_event.is_set():
+        while request["spinner"] and not self.exit_event.is_set():
             for char in frames:
-                if not self.waiting_for_response or self.exit_event.is_set():
+                if not request["spinner"] or self.exit_event.is_set():
                     break
-                print(f"\rWaiting for GPT response... {char}", end="", flush=True)
+                if request["status"]:
+                    line = request["status"]
+                else:
+                    # 显示本次请求发送的上下文大小
+                    context = self.bot.context_window.describe()
+                    line = f"Waiting for GPT response{' (' + context + ')' if context else ''}"
+                print(f"\r{line}... {char}", end="", flush=True)
                 time.sleep(0.5)
             # 清除行
-        print("\r" + " " * 50 + "\r", end="", flush=True)
+        print("\r" + " " * console.width + "\r", end="", flush=True)
 
     def print_help(self):
         # 创建表格对象，设置列间分隔符
@@ -152,21 +327,42 @@ class Conversation:
         # 添加行到表格中
         table.add_row("--exit or --quit or --e or --q", "End the chat.")
         table.add_row("--current usage or --cu", "View token usage for current session.")
-        table.add_row("--total usage or --tu", "View token usage for all recorded sessions.")
+        table.add_row("--total usage or --tu [day|model]",
+                      "View token usage for all recorded sessions, optionally grouped by day or model.")
         table.add_row("--list or --ls or --history --h", "List all chat history files.")
         table.add_row("--continue or --cont <filename>", "Continue a previous chat session.")
         table.add_row("--open or --o", "Open a new chat session.")
         table.add_row("--sessions or --s", "List all current open sessions.")
-        table.add_row("--close or --c", "Close the current session.")
-        table.add_row("--add key or --ak <api_key>", "Add an OpenAI API key.")
+        table.add_row("--close or --c", "Close all sessions in every window.")
+        table.add_row("--focus or --f <number>", "Bring the window of a session from --sessions to the front.")
+        table.add_row("--add key or --ak <api_key>", "Add an OpenAI API key to the key pool.")
+        table.add_row("--keys", "Show the status, requests and tokens of every API key in the pool.")
+        table.add_row("--fresh <message>", "Send a message without using the local response cache.")
+        table.add_row("--cancel [all]",
+                      "Cancel the request in progress (Ctrl-C does the same), and with all also drop queued messages.")
+        table.add_row("--file <path> [message]", "Send a file with the next message, or right away with a message.")
+        table.add_row("--attach <path> [question]",
+                      "Ask about a large file: its parts are read in parallel and combined into one answer.")
+        table.add_row("--memory [on|off|rebuild|<question>]",
+                      "Show or switch semantic memory, rebuild it, or show what a question would recall.")
+        table.add_row("--cache [clear]", "Show response cache hits and misses, or clear the cache.")
+        table.add_row("--render [auto|markdown|raw]", "Show or change how responses are displayed.")
+        table.add_row("--stats [all|openmetrics <file>]",
+                      "Latency percentiles per model for this session or all sessions, or write them for scraping.")
+        table.add_row("--search <words> [role: model: since: until: limit:]",
+                      "Search all chat logs, e.g. --search docker compose role:assistant since:2024-06-01")
+        table.add_row("--archive [days]", "Compress chat logs not changed for this many days into chat_logs/archive.")
 
         # 输出帮助信息
+        from rich.markdown import Markdown
         console.print(Markdown("# User Manual\n"))
         console.print(Markdown("## Type your message and press Enter to chat with the AI.\n"))
         console.print(Markdown("---\n"))
         console.print(Markdown("## Commands:\n"))
         console.print(Markdown("- Any sentence started with \"--\" or \"-\" "
                                "and the length less than 20 chars, will be considered as a command \n"))
+        console.print(Markdown("- Pasted lines are sent as one message. Type \"\"\" on its own line to start "
+                               "and end a message of several lines.\n"))
         console.print(table)
         console.print(Markdown("---\n"))
 
@@ -182,50 +378,49 @@ class Conversation:
             return True
         elif prompt_lower in ("--close", "--c"):
             print("Closing all conversations...")
-            # 关闭所有会话
-            with conversations_lock:
-                for conv in conversations[:]:
-                    print(f"Closing session: {conv.session_name}")
-                    conv.bot.append_to_log(conv.total_token_usage)
-                    conv.close()
-                    conversations.remove(conv)
-            # 设置全局退出事件，通知主线程退出
+            # 通过控制通道通知其他窗口立即关闭
+            close_other_processes()
+            # 设置全局退出事件，主线程会关闭本窗口的会话
             exit_event.set()
-            with open("exit_flag.txt", "w") as f:
-                f.write("exit")
-
-            # 删除sessions.json文件
-            if os.path.exists("sessions.json"):
-                os.remove("sessions.json")
-
             return True
         elif prompt_lower in ("--exit", "--quit", "--e", "--q"):
             print("Exiting Chat.")
-            # 设置全局退出事件，通知所有会话退出
+            # 设置全局退出事件，主线程会关闭本窗口的会话
             exit_event.set()
-            # 修改session.json文件内容，以删除当前会话
-            remove_session_from_file(self.session_name)
+            return True
+        elif prompt_lower == "--render":
+            set_render_mode(self.renderer, prompt)
+            return True
+        elif prompt_lower == "--stats":
+            print_stats(self.bot, prompt)
+            return True
+        elif prompt_lower == "--search":
+            print_search_results(self.bot.config, prompt)
+            return True
+        elif prompt_lower == "--archive":
+            archive_old_logs(self.bot.config, prompt, [self.bot.log_file_name])
+            return True
+        elif prompt_lower in ("--focus", "--f"):
+            try:
+                focus_session(int(prompt.split(" ")[1]))
+            except (IndexError, ValueError):
+                print("Please provide a session number from --sessions, e.g. --focus 2")
             return True
         elif prompt_lower in ("--current usage", "--cu"):
-            print(f"Token Usage: {self.total_token_usage}")
-            print(
-                f"Current Session Total Cost: ${calculate_cost(self.total_token_usage, self.bot.config['pricing']):.6f}")
+            print_current_usage(self.total_token_usage, self.bot.config["pricing"], self.bot.scheduler)
             return True
         elif prompt_lower in ("--total usage", "--tu"):
-            total_stats = calculate_total_cost(self.bot.config["output_directory"])
-            print("\nSummary of All Logs:")
-            print(f"- Total Input Tokens: {total_stats['total_input_tokens']}")
-            print(f"- Total Cached Tokens: {total_stats['total_cached_tokens']}")
-            print(f"- Total Output Tokens: {total_stats['total_output_tokens']}")
-            print(f"- Total Cost: ${total_stats['total_cost']:.6f}")
+            print_total_usage(self.bot.config, prompt)
             return True
         elif prompt_lower in ("--list", "--ls", "--history", "--h"):
-            log_files = list_log_files(self.bot.config["output_directory"])
-            if not log_files:
-                print('No history in "chat_logs" folder')
-            else:
-                print("\n".join(log_files))
+            print_log_files(self.bot.config)
             return True
+        elif prompt_lower == "--cache":
+            print_cache_stats(self.bot.response_cache, prompt)
+            return True
+        elif prompt_lower == "--fresh":
+            # 不是命令，而是跳过响应缓存发送的消息
+            return False
         elif prompt_lower in ("--open", "--o"):
             try:
                 if getattr(sys, 'frozen', False):
@@ -266,14 +461,28 @@ class Conversation:
                 print(f"Failed to continue conversation: {e}")
                 traceback.print_exc()
             return True
-        elif prompt_lower in ("--add key", "--ak"):
-            try:
-                api_key = prompt.split(" ")[1]
-                self.bot.config["api_key"] = api_key
-                openai.api_key = api_key
-                print("API key updated successfully.")
-            except IndexError:
-                print("Please provide an API key to add.")
+        elif prompt_lower in ("--add", "--ak"):
+            add_api_key(self.bot.scheduler, prompt)
+            return True
+        elif prompt_lower == "--keys":
+            print_key_stats(self.bot.scheduler)
+            return True
+        elif prompt_lower == "--cancel":
+            drain = prompt.lower().split(" ")[1:2] == ["all"]
+            print_cancel_result(*self.cancel(drain))
+            return True
+        elif prompt_lower == "--memory":
+            manage_memory(self.bot, prompt)
+            return True
+        elif prompt_lower == "--file":
+            message = attach_file(self.bot, self.input_options, self.attachments, prompt)
+            if message:
+                self.submit(message)
+            return True
+        elif prompt_lower == "--attach":
+            path, question = parse_attach_command(prompt)
+            if path:
+                self.submit(question, attachment=path)
             return True
         elif prompt_lower.startswith(("-",)) and prompt.__len__() <= 20:
             print("Unknown command. Type --help to see available commands.")
@@ -291,7 +500,8 @@ class Conversation:
         print("\nCurrent Open Conversations:")
         for idx, session in enumerate(sessions):
             session_name = session['session_name']
-            print(f"{idx + 1}. Session Name: {session_name}")
+            window = " (this window)" if session['pid'] == os.getpid() else ""
+            print(f"{idx + 1}. Session Name: {session_name} (PID {session['pid']}){window}")
         print("")
 
     def get_token_usage_and_cost(self):
@@ -304,132 +514,57 @@ class Conversation:
         return token_usage, cost
 
 
-class ChatGPT:
-    def __init__(self, config_file="config.json"):
-        """初始化 ChatGPT 实例。"""
-        self.config = load_config(config_file)
-        openai.api_key = self.config["api_key"]
-        self.model = self.config["model"]
-        self.messages = []
-        self.session_start_time = datetime.now()
-        self.log_file_name = self.generate_log_file_name()
-        self.stats_lock = threading.Lock()
-
-        # 创建输出目录
-        output_dir = self.config["output_directory"]
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-    def generate_log_file_name(self):
-        """生成基于会话开始时间的日志文件名。"""
-        timestamp = self.session_start_time.strftime("%Y%m%d_%H%M%S")
-        return f"{self.config['output_directory']}/chat_{timestamp}.md"
-
-    def append_to_log(self, token_usage=None, new_message=None):
-        """
-        更新聊天日志：
-        - 在头部更新 Token 消耗统计信息。
-        - 在末尾追加新消息。
+def focus_session(index):
+    """把 --sessions 列表中第 index 个会话所在的窗口切换到前台。"""
+    sessions = get_all_sessions_from_file()
+    if not 1 <= index <= len(sessions):
+        print(f"No session {index}. Type --sessions to see open sessions.")
+        return
+    session = sessions[index - 1]
+    if session["pid"] == os.getpid():
+        print("That session is in this window.")
+    elif send_command(session.get("address"), "focus") is None:
+        print(f"Could not reach session {session['session_name']}.")
 
-        Args:
-            token_usage (dict): Token 使用数据。
-            new_message (dict): 最新的消息 {"role": str, "content": str}。
-        """
-        # 从 token_usage 获取数据
-        input_tokens = token_usage.get("prompt_tokens", 0) if token_usage else 0
-        cached_tokens = token_usage.get("cached_tokens", 0) if token_usage else 0
-        output_tokens = token_usage.get("completion_tokens", 0) if token_usage else 0
-
-        cost = calculate_cost(token_usage, self.config["pricing"]) if token_usage else 0
-
-        # 格式化日志头部
-        header = f"# Chat Log - {self.session_start_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-        header += f"**Model**: {self.model}\n"
-        header += f"**Token Usage**:\n"
-        header += f"- Input Tokens: {input_tokens}\n"
-        header += f"- Cached Tokens: {cached_tokens}\n"
-        header += f"- Output Tokens: {output_tokens}\n"
-        header += f"**Cost**: ${cost:.4f}\n\n"
-
-        # 格式化新消息
-        new_message_content = ""
-        if new_message:
-            role = new_message["role"].capitalize()
-            content = new_message["content"]
-            new_message_content = f"## {role}\n{content}\n\n"
 
-        try:
-            # 读取现有内容
-            if os.path.exists(self.log_file_name):
-                with open(self.log_file_name, "r", encoding="utf-8") as f:
-                    existing_content = f.read()
-            else:
-                existing_content = ""
+def control_handlers():
+    """本窗口控制通道支持的命令。"""
+    def close(_):
+        print("\nClose requested by another session.")
+        exit_event.set()
 
-            # 提取现有消息内容部分
-            split_index = existing_content.find("## ")
-            if split_index != -1:
-                existing_messages = existing_content[split_index:]
-            else:
-                existing_messages = ""
+    def list_sessions(_):
+        with conversations_lock:
+            return [{"session_name": conv.session_name, "busy": conv.is_busy()} for conv in conversations]
 
-            # 组装日志内容
-            updated_log = header + existing_messages + new_message_content
+    def focus(_):
+        focus_console_window()
 
-            # 写入文件
-            with open(self.log_file_name, "w", encoding="utf-8") as f:
-                f.write(updated_log)
+    return {"close": close, "list": list_sessions, "focus": focus, "ping": lambda _: "pong"}
 
-        except Exception as e:
-            print(f"Error writing log: {e}")
 
-    def load_history(self, file_name, token_usage):
-        """加载指定的聊天历史。"""
-        file_path = os.path.join(self.config["output_directory"], file_name)
-        history = load_chat_history(file_path, token_usage)
-        self.messages = history
+def cancel_requests():
+    """取消本窗口所有会话进行中的请求（Ctrl-C），返回是否有请求被取消。"""
+    with conversations_lock:
+        current = conversations[:]
+    cancelled = False
+    for conv in current:
+        cancelled = conv.cancel()[0] or cancelled
+    return cancelled
 
-    def chat(self, prompt):
-        """发送用户输入并获取 AI 响应，同时记录日志。"""
-        # 用户输入后立即记录日志
-        user_message = {"role": "user", "content": prompt}
-        self.messages.append(user_message)
-        self.append_to_log(new_message=user_message)
 
-        try:
-            # GPT 响应
-            response = openai.chat.completions.create(
-                model=self.model,
-                messages=self.messages
-            )
-            content = response.choices[0].message.content
-            usage = response.usage
-            token_usage = {
-                "prompt_tokens": usage.prompt_tokens,
-                "completion_tokens": usage.completion_tokens,
-                "total_tokens": usage.total_tokens
-            }
-
-            # GPT 回答后立即记录日志
-            assistant_message = {"role": "assistant", "content": content}
-            self.messages.append(assistant_message)
-            self.append_to_log(token_usage=token_usage, new_message=assistant_message)
-
-            # 附加聊天记录
-            self.messages.append({"role": "assistant", "content": content})
-
-            return content, token_usage
-
-        except Exception as e:
-            print(f"Error during chat: {e}")
-            return None, None
-
-    def has_messages(self):
-        """检查是否有实际的聊天内容（不包括系统消息）"""
-        return any(msg["role"] == "user" or msg["role"] == "assistant" for msg in self.messages)
+def close_all_conversations():
+    """关闭本窗口的所有会话，更新日志头部并从会话登记表中移除。"""
+    with conversations_lock:
+        for conv in conversations[:]:
+            if not conv.closed:
+                conv.bot.append_to_log(conv.total_token_usage)
+                conv.close()
+            conversations.remove(conv)
 
 
 def main():
+    main_start_time = time.perf_counter()
     print("Welcome to ChatGPT CLI!")
     global conversations
     conversations = []
@@ -437,38 +572,75 @@ def main():
     bot = ChatGPT()
 
     try:
-        if getattr(sys, 'frozen', False):
-            # 程序被打包
-            application_path = os.path.dirname(sys.executable)
-        else:
-            # 未打包，直接使用脚本路径
-            application_path = os.path.dirname(os.path.abspath(__file__))
-        if not os.path.exists(application_path + "\\" + "sessions.json"):
-            with open(application_path + "\\" + "sessions.json", "w") as f:
-                f.write("[]")
         parser = argparse.ArgumentParser(description='ChatGPT CLI')
         parser.add_argument('--continue', '--cont', dest='continue_file',
                             help='Continue a previous chat session from a file')
+        parser.add_argument('--engine', action='store_true',
+                            help='Run all sessions in this process with the asyncio engine')
+        parser.add_argument('--batch', dest='batch_file',
+                            help='Run every prompt in a JSONL file without interaction')
+        parser.add_argument('--batch-output', dest='batch_output',
+                            help='JSONL file for batch results (default: <batch file>.results.jsonl)')
+        parser.add_argument('--workers', type=int,
+                            help='Number of batch requests to run at the same time')
+        parser.add_argument('--batch-api-file', dest='batch_api_file',
+                            help='Only write the batch as an OpenAI Batch API request file')
+        parser.add_argument('--bench-startup', dest='bench_startup', type=int, nargs='?', const=5,
+                            help='Measure import time and time to prompt over N cold starts (default 5)')
+        parser.add_argument('--bench-startup-child', action='store_true', help=argparse.SUPPRESS)
         args = parser.parse_args()
 
+        if args.bench_startup:
+            from startup_bench import run_startup_benchmark
+            bot.close_log()
+            run_startup_benchmark(args.bench_startup)
+            sys.exit(0)
+
+        if args.batch_file:
+            from batch import run_batch
+            run_batch(bot.config, args.batch_file, args.batch_output, args.workers, args.batch_api_file)
+            sys.exit(0)
+
         if args.continue_file:
             # 加载指定的聊天历史记录
             bot.load_history(args.continue_file, total_token_usage)
             print(f"Continuing conversation from {args.continue_file}")
 
+        if args.engine:
+            # 所有会话在同一个进程和事件循环中运行
+            from engine import run_engine
+            run_engine(bot, total_token_usage)
+            print("All sessions have been closed. Exiting program.")
+            sys.exit(0)
+
+        # 其他窗口通过控制通道下发命令，不再轮询退出标志文件
+        control_server = ControlServer(control_handlers())
+        control_address = control_server.start()
+
         conv = Conversation(bot, total_token_usage)
+        if args.bench_startup_child:
+            # 基准测试的子进程：正常启动，在第一次显示输入提示前报告耗时，然后正常关闭会话并退出
+            from startup_bench import report_startup
+
+            def report():
+                report_startup(IMPORT_START_TIME, main_start_time)
+                exit_event.set()
+            conv.on_first_prompt = report
         with conversations_lock:
             conversations.append(conv)
-        conv.start()
-        while not exit_event.is_set():
-            time.sleep(1)
-            # 检查退出标志文件
-            if os.path.exists("exit_flag.txt"):
-                exit_event.set()
-            # 程序退出时，所有会话已经被关闭，无需再次关闭
-            # 删除退出标志文件
-        if os.path.exists("exit_flag.txt"):
-            os.remove("exit_flag.txt")
+        conv.start(control_address)
+        start_search_index_refresh(bot.config)
+        try:
+            while not exit_event.is_set():
+                try:
+                    exit_event.wait()
+                except KeyboardInterrupt:
+                    # Ctrl-C 只取消进行中的请求，没有请求时才退出
+                    if not cancel_requests():
+                        raise
+        finally:
+            close_all_conversations()
+            control_server.close()
 
         print("All sessions have been closed. Exiting program.")
         sys.exit(0)
@@ -476,6 +648,7 @@ def main():
     except KeyboardInterrupt:
         print("\nExiting chat.")
         bot.append_to_log(total_token_usage)
+        bot.close_log()
         sys.exit(0)
 
 
@@ -487,5 +660,6 @@ if __name__ == "__main__":
     finally:
         print("Please do not close the program directly.")
         print("Exiting ChatGPT CLI...")
-        time.sleep(4)
+        if "--bench-startup-child" not in sys.argv:
+            time.sleep(4)
         sys.exit(0)
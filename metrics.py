@@ -0,0 +1,232 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import zlib
+
+METRICS_SUFFIX = ".metrics.json"
+OPENMETRICS_PREFIX = "chatgpt_cli_"
+
+
+def geometric_bounds(start, stop, factor=1.25):
+    """按固定比例增长的桶上界，相对误差不超过 factor - 1。"""
+    bounds = []
+    bound = start
+    while bound < stop:
+        bounds.append(round(bound, 6))
+        bound *= factor
+    bounds.append(stop)
+    return bounds
+
+
+SECONDS_BOUNDS = geometric_bounds(0.001, 600)
+RATE_BOUNDS = geometric_bounds(1, 10000)
+# 指标名 -> (说明, 单位, 桶上界)
+HISTOGRAMS = {
+    "request_latency_seconds": ("Time from sending a request to receiving the full response", "seconds",
+                                SECONDS_BOUNDS),
+    "time_to_first_token_seconds": ("Time to the first streamed token", "seconds", SECONDS_BOUNDS),
+    "output_tokens_per_second": ("Output tokens per second of generation time", None, RATE_BOUNDS),
+    "render_seconds": ("Time to render a response in the terminal", "seconds", SECONDS_BOUNDS),
+    "log_write_seconds": ("Time spent writing one batch of chat log data", "seconds", SECONDS_BOUNDS),
+}
+COUNTERS = {
+    "requests": "API requests that returned a response",
+    "request_errors": "API requests that failed after all retries",
+    "retries": "Retried API requests",
+    "response_cache_hits": "Responses served from the local response cache",
+    "hedged_requests": "Hedge requests sent after a slow or failed primary request",
+    "hedge_wins": "Responses that came from the hedge request",
+    "requests_cancelled": "Requests cancelled before their response was complete",
+}
+
+
+class Histogram:
+    """固定桶的直方图，只保存每个桶的计数，可以合并、持久化，并按桶插值估算百分位数。"""
+
+    def __init__(self, bounds, counts=None, total=0.0, minimum=None, maximum=None):
+        self.bounds = bounds
+        # 最后一个桶收集超过最大上界的样本
+        self.counts = counts or [0] * (len(bounds) + 1)
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        for value in (other.minimum, other.maximum):
+            if value is not None:
+                self.minimum = value if self.minimum is None else min(self.minimum, value)
+                self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def percentile(self, q):
+        """估算第 q 百分位数：定位所在的桶后线性插值，并限制在观测到的最小值和最大值之间。"""
+        count = self.count
+        if not count:
+            return None
+        target = q / 100 * count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= target:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.maximum
+                value = lower + (upper - lower) * (target - seen) / bucket_count
+                return min(max(value, self.minimum), self.maximum)
+            seen += bucket_count
+        return self.maximum
+
+    def to_dict(self):
+        return {"bounds": self.bounds, "counts": self.counts, "sum": self.total,
+                "min": self.minimum, "max": self.maximum}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["bounds"], data["counts"], data["sum"], data["min"], data["max"])
+
+
+class SessionMetrics:
+    """一个会话的性能指标：按 (指标, 模型) 记录的直方图和计数器，随会话日志一起保存。"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, model, value):
+        if value is None:
+            return
+        with self.lock:
+            histogram = self.histograms.get((name, model))
+            if histogram is None:
+                histogram = self.histograms[(name, model)] = Histogram(HISTOGRAMS[name][2])
+            histogram.observe(value)
+
+    def increment(self, name, model, amount=1):
+        with self.lock:
+            self.counters[(name, model)] = self.counters.get((name, model), 0) + amount
+
+    def has_samples(self):
+        with self.lock:
+            return bool(self.histograms or self.counters)
+
+    def merge(self, other):
+        with self.lock:
+            for key, histogram in other.histograms.items():
+                if key in self.histograms and self.histograms[key].bounds == histogram.bounds:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = Histogram.from_dict(histogram.to_dict())
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "histograms": [dict(h.to_dict(), name=name, model=model)
+                               for (name, model), h in self.histograms.items()],
+                "counters": [{"name": name, "model": model, "value": value}
+                             for (name, model), value in self.counters.items()],
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        metrics = cls()
+        for item in data.get("histograms", []):
+            if item["name"] in HISTOGRAMS:
+                metrics.histograms[(item["name"], item["model"])] = Histogram.from_dict(item)
+        for item in data.get("counters", []):
+            metrics.counters[(item["name"], item["model"])] = item["value"]
+        return metrics
+
+    def summary_rows(self, percentiles=(50, 95, 99)):
+        """每个 (模型, 指标) 一行：样本数和各百分位数。"""
+        with self.lock:
+            items = sorted(self.histograms.items(), key=lambda item: (str(item[0][1]), item[0][0]))
+            return [(model, name, h.count, [h.percentile(q) for q in percentiles])
+                    for (name, model), h in items]
+
+    def to_openmetrics(self):
+        """OpenMetrics 文本格式，桶为累计计数。"""
+        lines = []
+        with self.lock:
+            for name, (help_text, unit, _) in HISTOGRAMS.items():
+                series = [(model, h) for (metric, model), h in self.histograms.items() if metric == name]
+                if not series:
+                    continue
+                full_name = OPENMETRICS_PREFIX + name
+                lines.append(f"# TYPE {full_name} histogram")
+                if unit:
+                    lines.append(f"# UNIT {full_name} {unit}")
+                lines.append(f"# HELP {full_name} {help_text}.")
+                for model, h in series:
+                    labels = f'model="{model}"'
+                    cumulative = 0
+                    for bound, count in zip(h.bounds + ["+Inf"], h.counts):
+                        cumulative += count
+                        lines.append(f'{full_name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f"{full_name}_count{{{labels}}} {cumulative}")
+                    lines.append(f"{full_name}_sum{{{labels}}} {h.total}")
+            for name, help_text in COUNTERS.items():
+                series = [(model, v) for (metric, model), v in self.counters.items() if metric == name]
+                if not series:
+                    continue
+                full_name = OPENMETRICS_PREFIX + name
+                lines.append(f"# TYPE {full_name} counter")
+                lines.append(f"# HELP {full_name} {help_text}.")
+                for model, value in series:
+                    lines.append(f'{full_name}_total{{model="{model}"}} {value}')
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def metrics_path(log_path):
+    """会话指标文件的路径，与 Markdown 日志放在一起。"""
+    return os.path.splitext(log_path)[0] + METRICS_SUFFIX
+
+
+def load_metrics(path):
+    """读取指标文件，不存在或损坏时返回 None。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return SessionMetrics.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_metrics(metrics, path):
+    """原子地写入指标文件。"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(metrics.to_dict(), f)
+    os.replace(temp_path, path)
+
+
+def load_all_metrics(log_directory):
+    """合并日志目录中所有会话（包括已归档会话）的指标。"""
+    from log_archive import load_manifest, read_member
+    combined = SessionMetrics()
+    for path in glob.glob(os.path.join(log_directory, "*" + METRICS_SUFFIX)):
+        metrics = load_metrics(path)
+        if metrics is not None:
+            combined.merge(metrics)
+    for entry in load_manifest(log_directory).values():
+        try:
+            data = read_member(log_directory, entry, "metrics")
+            if data is not None:
+                combined.merge(SessionMetrics.from_dict(json.loads(data)))
+        except (OSError, ValueError, KeyError, zlib.error):
+            continue
+    return combined
@@ -0,0 +1,229 @@
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from response_cache import make_cache_key
+
+COMPLETIONS_PATH = "/chat/completions"
+
+
+def synthetic_content(tokens):
+    """生成大约 tokens 个 Token 的响应内容（每个词约一个 Token）。"""
+    words = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit")
+    return " ".join(words[i % len(words)] for i in range(tokens))
+
+
+def estimate_prompt_tokens(messages):
+    return sum(len(m.get("content") or "") // 4 + 4 for m in messages)
+
+
+def request_key(request):
+    """录制和回放时用来匹配请求的键：与响应缓存相同，另外区分是否流式。"""
+    return make_cache_key(request) + ("-stream" if request.get("stream") else "")
+
+
+class MockCompletionServer:
+    """本地的 chat.completions 替身服务，用于离线基准测试。
+
+    默认按配置的延迟和输出 Token 数生成响应，支持流式（SSE）和非流式；
+    指定 record_path 和 upstream 时把请求转发到真实服务并录制，
+    指定 replay_path 时按请求内容回放录制的响应。
+
+    Args:
+        latency (float): 返回第一个字节前的等待秒数。
+        tokens (int): 每个响应的输出 Token 数。
+        tokens_per_second (float): 流式响应的输出速度，0 表示不限速。
+        chunk_tokens (int): 每个流式 chunk 包含的 Token 数。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, tokens=100, tokens_per_second=0, chunk_tokens=4,
+                 record_path=None, upstream=None, replay_path=None, replay_timing=False):
+        self.latency = latency
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.record_path = record_path
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.replay_timing = replay_timing
+        self.recordings = self.load_recordings(replay_path) if replay_path else None
+        self.record_lock = threading.Lock()
+        self.request_count = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @staticmethod
+    def load_recordings(path):
+        recordings = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    recordings[entry["key"]] = entry
+        return recordings
+
+    def start(self):
+        """在后台线程中启动服务，返回 base_url。"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                if not self.path.endswith(COMPLETIONS_PATH):
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                request = json.loads(body)
+                with server.record_lock:
+                    server.request_count += 1
+                if server.recordings is not None:
+                    server.replay(self, request)
+                elif server.upstream:
+                    server.forward(self, request, body)
+                elif request.get("stream"):
+                    server.stream(self, request)
+                else:
+                    server.complete(self, request)
+
+            def send_json(self, status, payload):
+                self.send_body(status, "application/json", json.dumps(payload).encode("utf-8"))
+
+            def send_body(self, status, content_type, data):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def usage(self, request, completion_tokens):
+        prompt_tokens = estimate_prompt_tokens(request.get("messages") or [])
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+
+    def complete(self, handler, request):
+        time.sleep(self.latency)
+        handler.send_json(200, {
+            "id": f"chatcmpl-mock-{self.request_count}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": synthetic_content(self.tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": self.usage(request, self.tokens),
+        })
+
+    def stream(self, handler, request):
+        time.sleep(self.latency)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        words = synthetic_content(self.tokens).split(" ")
+        base = {"id": f"chatcmpl-mock-{self.request_count}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": request.get("model", "mock")}
+
+        def send(payload):
+            handler.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+
+        for start in range(0, len(words), self.chunk_tokens):
+            piece = " ".join(words[start:start + self.chunk_tokens])
+            if start:
+                piece = " " + piece
+            send(dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}]))
+            if self.tokens_per_second:
+                time.sleep(self.chunk_tokens / self.tokens_per_second)
+        send(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send(dict(base, choices=[], usage=self.usage(request, self.tokens)))
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+        handler.close_connection = True
+
+    def forward(self, handler, request, body):
+        """把请求原样转发给真实服务，录制响应后返回给客户端。"""
+        upstream_request = urllib.request.Request(
+            self.upstream + COMPLETIONS_PATH, data=body, method="POST",
+            headers={"Content-Type": "application/json", "Authorization": handler.headers.get("Authorization", "")}
+        )
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(upstream_request) as response:
+                status, content_type, data = response.status, response.headers.get("Content-Type"), response.read()
+        except urllib.error.HTTPError as e:
+            status, content_type, data = e.code, e.headers.get("Content-Type"), e.read()
+        latency = time.perf_counter() - start
+        if status == 200 and self.record_path:
+            entry = {"key": request_key(request), "content_type": content_type, "latency": latency,
+                     "body": data.decode("utf-8")}
+            with self.record_lock, open(self.record_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        handler.send_body(status, content_type or "application/json", data)
+
+    def replay(self, handler, request):
+        entry = self.recordings.get(request_key(request))
+        if entry is None:
+            handler.send_json(404, {"error": {"message": "No recorded response for this request."}})
+            return
+        if self.replay_timing:
+            time.sleep(entry["latency"])
+        handler.send_body(200, entry["content_type"], entry["body"].encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the chat completions endpoint")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before the first byte")
+    parser.add_argument("--tokens", type=int, default=200, help="Output tokens per response")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Streaming speed (0 = unlimited)")
+    parser.add_argument("--record", help="Forward requests to --upstream and append the responses to this file")
+    parser.add_argument("--upstream", default="https://api.openai.com/v1")
+    parser.add_argument("--replay", help="Answer requests from a file written by --record")
+    parser.add_argument("--replay-timing", action="store_true", help="Wait as long as the recorded request took")
+    args = parser.parse_args()
+
+    server = MockCompletionServer(
+        port=args.port, latency=args.latency, tokens=args.tokens, tokens_per_second=args.tokens_per_second,
+        record_path=args.record, upstream=args.upstream if args.record else None,
+        replay_path=args.replay, replay_timing=args.replay_timing
+    )
+    print(f"Mock completions server on {server.base_url} (set \"base_url\" in config.json). Ctrl-C to stop.")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import importlib.util
+import threading
+from key_pool import current_api_key
+
+# 每个进程只创建一个同步客户端和一个异步客户端，所有 ChatGPT 实例共享连接池
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+# (客户端, API key) -> 使用该 key 的客户端副本
+_keyed_clients = {}
+
+DEFAULT_HTTP_OPTIONS = {
+    "max_connections": 20,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 60,
+    "connect_timeout": 10,
+    "read_timeout": 600,
+    "http2": False,
+}
+
+
+def get_http_options(config):
+    """合并 config.json 中的 "http" 配置和默认值。"""
+    options = dict(DEFAULT_HTTP_OPTIONS)
+    options.update(config.get("http") or {})
+    if options["http2"] and importlib.util.find_spec("h2") is None:
+        print("HTTP/2 requires the 'h2' package (pip install httpx[http2]). Falling back to HTTP/1.1.")
+        options["http2"] = False
+    return options
+
+
+def _client_options(config):
+    """构造客户端参数和 HTTP 连接池参数。"""
+    import httpx
+    options = get_http_options(config)
+    timeout = httpx.Timeout(options["read_timeout"], connect=options["connect_timeout"])
+    limits = httpx.Limits(
+        max_connections=options["max_connections"],
+        max_keepalive_connections=options["max_keepalive_connections"],
+        keepalive_expiry=options["keepalive_expiry"],
+    )
+    # 重试由 scheduler.RequestScheduler 统一负责，客户端自身不再重试
+    api_key = config.get("api_key") or config["api_keys"][0]["key"]
+    kwargs = {"api_key": api_key, "timeout": timeout, "max_retries": 0}
+    if config.get("base_url"):
+        kwargs["base_url"] = config["base_url"]
+    return kwargs, {"limits": limits, "timeout": timeout, "http2": options["http2"]}
+
+
+def get_client(config):
+    """获取进程内共享的同步客户端，首次调用时按配置创建。"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            # openai（连同 pydantic、httpx）导入较慢，推迟到第一次发送请求时
+            import openai
+            kwargs, http_kwargs = _client_options(config)
+            _client = openai.OpenAI(http_client=openai.DefaultHttpxClient(**http_kwargs), **kwargs)
+        return _client
+
+
+def get_async_client(config):
+    """获取进程内共享的异步客户端，首次调用时按配置创建。"""
+    global _async_client
+    with _client_lock:
+        if _async_client is None:
+            import openai
+            kwargs, http_kwargs = _client_options(config)
+            _async_client = openai.AsyncOpenAI(http_client=openai.DefaultAsyncHttpxClient(**http_kwargs), **kwargs)
+        return _async_client
+
+
+async def close_async_client():
+    """关闭共享的异步客户端（事件循环结束前调用）。"""
+    global _async_client
+    with _client_lock:
+        client, _async_client = _async_client, None
+        for key in [key for key in _keyed_clients if key[0] == id(client)]:
+            del _keyed_clients[key]
+    if client is not None:
+        await client.close()
+
+
+def keyed_client(client):
+    """返回使用调度器为当前请求选出的 API key 的客户端，与原客户端共享连接池。"""
+    api_key = current_api_key.get()
+    if api_key is None or api_key.key == client.api_key:
+        return client
+    with _client_lock:
+        keyed = _keyed_clients.get((id(client), api_key.key))
+        if keyed is None:
+            keyed = _keyed_clients[(id(client), api_key.key)] = client.with_options(api_key=api_key.key)
+        return keyed
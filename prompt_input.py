@@ -0,0 +1,156 @@
+import os
+import re
+import select
+import sys
+import time
+
+DEFAULT_INPUT_OPTIONS = {
+    "paste_burst_seconds": 0.05,  # 上一行读完后这段时间内还有输入的视为同一次粘贴；0 为不合并
+    "max_file_bytes": 1000000,    # --file 最多读取的字节数
+}
+# 单独一行的 """ 开始和结束一个多行块
+BLOCK_DELIMITER = '"""'
+FENCE = "```"
+READ_CHUNK_SIZE = 64 * 1024
+BINARY_CHECK_SIZE = 8192
+
+
+def get_input_options(config):
+    """合并 config.json 中的 "input" 配置和默认值。"""
+    options = dict(DEFAULT_INPUT_OPTIONS)
+    options.update(config.get("input") or {})
+    return options
+
+
+def input_pending(timeout):
+    """timeout 秒内终端是否有尚未读取的输入（例如粘贴的后续行）。输入不是终端时返回 False。"""
+    try:
+        if not sys.stdin.isatty():
+            return False
+        if os.name == "nt":
+            import msvcrt
+            deadline = time.monotonic() + timeout
+            while not msvcrt.kbhit():
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.005)
+            return True
+        readable, _, _ = select.select([sys.stdin.fileno()], [], [], timeout)
+        return bool(readable)
+    except (OSError, ValueError):
+        return False
+
+
+def has_open_fence(lines):
+    """是否有未闭合的 ``` 代码块。"""
+    return sum(1 for line in lines if line.lstrip().startswith(FENCE)) % 2 == 1
+
+
+def read_prompt(read_line, burst_seconds):
+    """读取一条提示，把一次粘贴的多行输入和显式的多行块合并为一条。
+
+    - 单独一行 \"\"\" 开始一个多行块，直到下一行 \"\"\" 结束（分隔行不发送）；
+    - 未闭合的 ``` 代码块会一直读取到闭合；
+    - 一行读完后 burst_seconds 秒内还有输入的，并入同一条提示。
+
+    Args:
+        read_line (callable): read_line(timeout) 读取一行；timeout 为 None 时一直等待，
+            否则在 timeout 秒内没有输入时返回 None。输入结束时抛出 EOFError。
+        burst_seconds (float): 粘贴的判定间隔，0 为不合并。
+
+    Returns:
+        str: 合并后的提示。
+    """
+    lines = [read_line(None)]
+    try:
+        if lines[0].strip() == BLOCK_DELIMITER:
+            lines = []
+            while True:
+                line = read_line(None)
+                if line.strip() == BLOCK_DELIMITER:
+                    return "\n".join(lines)
+                lines.append(line)
+        while True:
+            while burst_seconds:
+                line = read_line(burst_seconds)
+                if line is None:
+                    break
+                lines.append(line)
+            if not has_open_fence(lines):
+                break
+            lines.append(read_line(None))
+    except EOFError:
+        # 输入在多行块中途结束，发送已经读到的内容
+        pass
+    return "\n".join(lines)
+
+
+async def aread_prompt(read_line, burst_seconds):
+    """read_prompt 的异步版本，read_line(timeout) 返回协程。"""
+    lines = [await read_line(None)]
+    try:
+        if lines[0].strip() == BLOCK_DELIMITER:
+            lines = []
+            while True:
+                line = await read_line(None)
+                if line.strip() == BLOCK_DELIMITER:
+                    return "\n".join(lines)
+                lines.append(line)
+        while True:
+            while burst_seconds:
+                line = await read_line(burst_seconds)
+                if line is None:
+                    break
+                lines.append(line)
+            if not has_open_fence(lines):
+                break
+            lines.append(await read_line(None))
+    except EOFError:
+        pass
+    return "\n".join(lines)
+
+
+def read_terminal_line(timeout):
+    """read_prompt 使用的同步读取：用 input() 读一行，timeout 秒内没有输入时返回 None。"""
+    if timeout is not None and not input_pending(timeout):
+        return None
+    return input("")
+
+
+def load_file_attachment(path, max_bytes):
+    """分块读取一个文本文件，生成附加到提示中的 Markdown 代码块。
+
+    只读取前 max_bytes 个字节，不会把整个大文件读入内存。
+
+    Returns:
+        tuple: (代码块文本, 文件是否被截断)。
+
+    Raises:
+        OSError: 文件无法读取。
+        ValueError: 文件看起来是二进制文件。
+    """
+    chunks = []
+    remaining = max_bytes
+    truncated = False
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if not chunks and b"\0" in chunk[:BINARY_CHECK_SIZE]:
+                raise ValueError(f"{path} looks like a binary file.")
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        else:
+            truncated = bool(f.read(1))
+    text = b"".join(chunks).decode("utf-8", errors="replace")
+    if truncated:
+        # 不在多字节字符或行的中间截断
+        text = text[:text.rfind("\n") + 1] if "\n" in text else text.rstrip("�")
+    # 代码块的围栏比文件中最长的连续反引号更长，文件内容不会提前结束代码块
+    longest = max((len(run) for run in re.findall(r"`+", text)), default=0)
+    fence = "`" * max(3, longest + 1)
+    language = os.path.splitext(path)[1].lstrip(".")
+    note = " (truncated)" if truncated else ""
+    block = f"`{os.path.basename(path)}`{note}:\n{fence}{language}\n{text.rstrip(chr(10))}\n{fence}"
+    return block, truncated
@@ -0,0 +1,141 @@
+import hashlib
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+RENDER_MODES = ("auto", "markdown", "raw")
+DEFAULT_RENDER_OPTIONS = {
+    "mode": "auto",              # auto: 超过阈值的响应走快速路径；markdown: 总是完整渲染；raw: 原样输出
+    "large_response_lines": 300, # 超过这么多行视为大响应
+    "chunk_lines": 120,          # 大响应按块渲染，每块的大致行数
+    "pager": False,              # 大响应在分页器中显示
+    "code_theme": "monokai",
+    "code_cache_size": 128,      # 缓存的已高亮代码块数量
+}
+_FENCE_PATTERN = re.compile(r"^\s*(```|~~~)\s*([\w+#.-]*)")
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def split_markdown_blocks(text):
+    """把 Markdown 拆分为普通文本段和代码块。
+
+    Returns:
+        list: ("markdown", 文本) 或 ("code", (语言, 代码)) 组成的列表。
+    """
+    blocks = []
+    lines = []
+    fence = None
+    language = ""
+    for line in text.splitlines(keepends=True):
+        match = _FENCE_PATTERN.match(line)
+        if fence is None and match:
+            if lines:
+                blocks.append(("markdown", "".join(lines)))
+            fence, language, lines = match.group(1), match.group(2), []
+        elif fence is not None and line.strip() == fence:
+            blocks.append(("code", (language, "".join(lines))))
+            fence, lines = None, []
+        else:
+            lines.append(line)
+    if fence is not None:
+        # 未闭合的代码块（例如被截断的响应）
+        blocks.append(("code", (language, "".join(lines))))
+    elif lines:
+        blocks.append(("markdown", "".join(lines)))
+    return blocks
+
+
+def chunk_markdown(text, chunk_lines):
+    """把普通文本按空行切成大约 chunk_lines 行的块，不在段落中间切断。"""
+    chunk = []
+    for line in text.splitlines(keepends=True):
+        chunk.append(line)
+        if len(chunk) >= chunk_lines and not line.strip():
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+class ResponseRenderer:
+    """AI 响应的终端渲染器。
+
+    小响应照常用 rich 的 Markdown 完整渲染；超过阈值的大响应按块渲染，
+    代码块单独高亮并缓存，可选在分页器中显示；raw 模式直接原样输出。
+    """
+
+    def __init__(self, console, options=None):
+        self.console = console
+        self.options = dict(DEFAULT_RENDER_OPTIONS)
+        self.options.update(options or {})
+        self.code_cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def mode(self):
+        return self.options["mode"]
+
+    def set_mode(self, mode):
+        if mode not in RENDER_MODES:
+            raise ValueError(f"Unknown render mode: {mode}. Use one of: {', '.join(RENDER_MODES)}")
+        self.options["mode"] = mode
+
+    def is_large(self, text):
+        return text.count("\n") + 1 > self.options["large_response_lines"]
+
+    def render(self, response, title="AI Response"):
+        """显示一个完整的响应。"""
+        if self.mode == "raw":
+            self.write_raw(f"{title}\n{response}\n")
+        elif self.mode == "markdown" or not self.is_large(response):
+            from rich.markdown import Markdown
+            self.console.print(Markdown(f"# {title}\n{response}", code_theme=self.options["code_theme"]))
+        elif self.options["pager"]:
+            with self.console.pager(styles=True):
+                self.render_large(response, title)
+        else:
+            self.render_large(response, title)
+
+    def render_large(self, response, title):
+        """大响应的快速路径：逐块渲染并立即输出，已高亮的代码块直接复用。"""
+        from rich.markdown import Markdown
+        self.console.rule(title)
+        for kind, block in split_markdown_blocks(response):
+            if kind == "code":
+                self.console.print(self.highlight(*block), soft_wrap=True)
+                continue
+            for chunk in chunk_markdown(block, self.options["chunk_lines"]):
+                self.console.print(Markdown(chunk, code_theme=self.options["code_theme"]))
+
+    def highlight(self, language, code):
+        """高亮代码块，结果按 (语言, 代码) 缓存；高亮结果与终端宽度无关，可以直接复用。"""
+        key = (language, hashlib.sha1(code.encode("utf-8")).hexdigest())
+        with self.lock:
+            text = self.code_cache.get(key)
+            if text is not None:
+                self.code_cache.move_to_end(key)
+                return text
+        from rich.syntax import Syntax
+        syntax = Syntax(code, language or "text", theme=self.options["code_theme"])
+        text = syntax.highlight(code.rstrip("\n"))
+        with self.lock:
+            self.code_cache[key] = text
+            while len(self.code_cache) > self.options["code_cache_size"]:
+                self.code_cache.popitem(last=False)
+        return text
+
+    def write_raw(self, text):
+        """不经过 rich，直接写到终端。"""
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+def get_renderer(config, console):
+    """获取进程内共享的渲染器，参数来自 config.json 的 "rendering"。"""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = ResponseRenderer(console, config.get("rendering"))
+        return _renderer
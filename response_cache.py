@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from utils import get_application_path
+
+# 请求参数中不影响响应内容的字段，不参与缓存键计算
+IGNORED_PARAMS = ("messages", "stream", "stream_options")
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def normalize_messages(messages):
+    """只保留角色和内容，并统一换行符和首尾空白，使等价的对话得到相同的缓存键。"""
+    return [
+        {"role": m["role"], "content": (m["content"] or "").replace("\r\n", "\n").strip()}
+        for m in messages
+    ]
+
+
+def make_cache_key(params):
+    """根据 (模型, 规范化后的消息, 其他参数) 计算缓存键。"""
+    payload = {
+        "messages": normalize_messages(params["messages"]),
+        "params": {k: v for k, v in params.items() if k not in IGNORED_PARAMS},
+    }
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResponseCache:
+    """本地磁盘上的内容寻址响应缓存。
+
+    每个条目是一个以缓存键命名的 JSON 文件，命中时更新文件的修改时间，
+    按修改时间做 LRU 淘汰，并删除超过 max_age_days 的条目。
+    """
+
+    def __init__(self, directory, max_bytes, max_age_days=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _entries(self):
+        """遍历所有缓存条目，返回 (路径, 修改时间, 大小)。"""
+        for sub_dir in os.scandir(self.directory):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        """读取缓存条目，未命中或已过期时返回 None。"""
+        path = self._path(key)
+        try:
+            if self.max_age and time.time() - os.path.getmtime(path) > self.max_age:
+                raise FileNotFoundError(path)
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # 更新修改时间，作为 LRU 的最近使用时间
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """写入缓存条目（先写临时文件再原子替换），超出容量时淘汰最久未使用的条目。"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        with self.lock:
+            # 覆盖已有条目时只计入大小的变化
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(temp_path, path)
+            self.total_bytes += len(data) - old_size
+            over_limit = self.total_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self):
+        """删除过期条目，再按最近使用时间从旧到新删除，直到低于容量的 90%。"""
+        with self.lock:
+            now = time.time()
+            entries = sorted(self._entries(), key=lambda e: e[1])
+            total = sum(size for _, _, size in entries)
+            for path, mtime, size in entries:
+                expired = self.max_age and now - mtime > self.max_age
+                if not expired and total <= self.max_bytes * 0.9:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self.total_bytes = total
+
+    def clear(self):
+        with self.lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
+
+
+def resolve_cache_directory(directory):
+    """相对路径按程序所在目录解析（与日志目录相同），不受启动时工作目录的影响。"""
+    return os.path.join(get_application_path(), directory)
+
+
+def get_response_cache(config):
+    """获取进程内共享的响应缓存；未在 config.json 中启用时返回 None。"""
+    global _cache
+    options = config.get("response_cache") or {}
+    if not options.get("enabled"):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                resolve_cache_directory(options.get("directory", "response_cache")),
+                int(options.get("max_megabytes", 100) * 1024 * 1024),
+                options.get("max_age_days", 30),
+            )
+        return _cache
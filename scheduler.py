@@ -0,0 +1,292 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from key_pool import KeyPool, current_api_key
+
+# 可以重试的 HTTP 状态码：超时、冲突、限流和服务端错误
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class TokenBucket:
+    """按分钟配额匀速补充的令牌桶，同步和异步调用方共用。"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """预留 amount 个令牌，返回调用方需要等待的秒数（余额允许暂时为负）。"""
+        with self.lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait_time(self, amount):
+        """不预留，只计算现在预留 amount 个令牌需要等待的秒数。"""
+        with self.lock:
+            self._refill()
+            balance = self.tokens - min(amount, self.capacity)
+            return 0.0 if balance >= 0 else -balance / self.rate
+
+    def refund(self, amount):
+        """归还 reserve(amount) 预留的令牌。"""
+        self.adjust(min(amount, self.capacity))
+
+    def adjust(self, amount):
+        """按实际消耗修正预留量：正数归还令牌，负数补扣令牌。"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def get_retry_after(error):
+    """读取错误响应中的 Retry-After（秒或 HTTP 日期），没有时返回 None。"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, date.timestamp() - time.time()) if date else None
+
+
+def is_retryable(error):
+    """限流、超时、连接错误和 5xx 可以重试，其他错误（如认证失败、参数错误）直接抛出。"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    import openai
+    return isinstance(error, openai.APIConnectionError)
+
+
+class RequestScheduler:
+    """API 请求调度器：RPM/TPM 令牌桶限流、并发上限，以及带抖动和 Retry-After 的指数退避重试。
+
+    交互会话、异步引擎和批处理的请求都经过同一个调度器，queue_depth 为正在等待发出的请求数。
+    指定 key_pool 时每次尝试从池中选一个 key（保存在 current_api_key 中），限流或认证失败时换 key 重试。
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=None,
+                 max_retries=5, backoff_base=1.0, backoff_max=60.0, key_pool=None):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.sync_slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.async_slots = None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.key_pool = key_pool
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.retries = 0
+
+    def _reserve(self, estimated_tokens):
+        """预留全局配额，并从 key 池中选出本次尝试使用的 key，返回 (key, 需要等待的秒数)。"""
+        delay = 0.0
+        if self.request_bucket:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket and estimated_tokens:
+            delay = max(delay, self.token_bucket.reserve(estimated_tokens))
+        api_key = None
+        if self.key_pool:
+            api_key, key_delay = self.key_pool.acquire(estimated_tokens)
+            delay = max(delay, key_delay)
+        return api_key, delay
+
+    def _refund(self, api_key, estimated_tokens):
+        """归还一次失败的尝试预留的全局配额和 key 的配额。"""
+        if self.request_bucket:
+            self.request_bucket.refund(1)
+        if self.token_bucket and estimated_tokens:
+            self.token_bucket.refund(estimated_tokens)
+        if api_key is not None:
+            self.key_pool.refund(api_key, estimated_tokens)
+
+    def _release(self, api_key, succeeded):
+        if api_key is not None:
+            self.key_pool.release(api_key, succeeded)
+            if succeeded:
+                # 留在调用方的上下文中，settle 时据此修正该 key 的用量
+                current_api_key.set(api_key)
+
+    def settle(self, estimated_tokens, actual_tokens, api_key=None):
+        """请求完成后用实际 Token 数修正 TPM 令牌桶（api_key 默认为当前上下文最近一次请求使用的 key）。"""
+        if self.token_bucket and actual_tokens is not None:
+            self.token_bucket.adjust(estimated_tokens - actual_tokens)
+        api_key = api_key or current_api_key.get()
+        if self.key_pool and api_key is not None:
+            self.key_pool.settle(api_key, estimated_tokens, actual_tokens)
+
+    def retry_wait(self, api_key, error, attempt):
+        """返回重试前的等待秒数，不再重试时返回 None。
+
+        key 因限流或认证失败被移出轮换、且池中还有其他可用 key 时立即换 key 重试（最多每个 key 一次）。
+        """
+        if api_key is not None:
+            retry_after = get_retry_after(error)
+            if (self.key_pool.report_error(api_key, error, retry_after)
+                    and attempt < self.max_retries + len(self.key_pool.keys)):
+                return 0.0
+        return self.backoff(error, attempt)
+
+    def backoff(self, error, attempt):
+        """返回下一次重试前的等待秒数；不可重试或已达到重试上限时返回 None。"""
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, 0.5)
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        # 抖动，避免多个会话同时重试
+        return random.uniform(delay / 2, delay)
+
+    def _update(self, queued=0, in_flight=0, retries=0):
+        with self.lock:
+            self.queue_depth += queued
+            self.in_flight += in_flight
+            self.retries += retries
+
+    def run(self, call, estimated_tokens=0, on_retry=None):
+        """同步执行 call()，按限流等待，失败时按退避策略重试；每次重试前调用 on_retry()。"""
+        attempt = 0
+        self._update(queued=1)
+        queued = True
+        try:
+            while True:
+                api_key, delay = self._reserve(estimated_tokens)
+                if delay:
+                    time.sleep(delay)
+                if self.sync_slots:
+                    self.sync_slots.acquire()
+                if queued:
+                    self._update(queued=-1)
+                    queued = False
+                self._update(in_flight=1)
+                succeeded = False
+                token = current_api_key.set(api_key)
+                try:
+                    result = call()
+                    succeeded = True
+                    return result
+                except Exception as e:
+                    # 失败的尝试归还预留的配额，重试时重新预留，连续的 429 不会耗尽令牌桶
+                    self._refund(api_key, estimated_tokens)
+                    wait = self.retry_wait(api_key, e, attempt)
+                    if wait is None:
+                        raise
+                    error = e
+                finally:
+                    current_api_key.reset(token)
+                    self._release(api_key, succeeded)
+                    self._update(in_flight=-1)
+                    if self.sync_slots:
+                        self.sync_slots.release()
+                attempt += 1
+                self._update(retries=1)
+                if on_retry:
+                    on_retry()
+                if wait:
+                    print(f"Request failed ({error}), retrying in {wait:.1f}s...")
+                    time.sleep(wait)
+                else:
+                    print(f"Request failed ({error}), retrying with another API key...")
+        finally:
+            if queued:
+                self._update(queued=-1)
+
+    async def arun(self, call, estimated_tokens=0, on_retry=None):
+        """run 的异步版本，call() 返回可等待对象。"""
+        if self.max_concurrency and self.async_slots is None:
+            self.async_slots = asyncio.Semaphore(self.max_concurrency)
+        attempt = 0
+        self._update(queued=1)
+        queued = True
+        try:
+            while True:
+                api_key, delay = self._reserve(estimated_tokens)
+                if delay:
+                    await asyncio.sleep(delay)
+                if self.async_slots:
+                    await self.async_slots.acquire()
+                if queued:
+                    self._update(queued=-1)
+                    queued = False
+                self._update(in_flight=1)
+                succeeded = False
+                token = current_api_key.set(api_key)
+                try:
+                    result = await call()
+                    succeeded = True
+                    return result
+                except Exception as e:
+                    # 失败的尝试归还预留的配额，重试时重新预留，连续的 429 不会耗尽令牌桶
+                    self._refund(api_key, estimated_tokens)
+                    wait = self.retry_wait(api_key, e, attempt)
+                    if wait is None:
+                        raise
+                    error = e
+                finally:
+                    current_api_key.reset(token)
+                    self._release(api_key, succeeded)
+                    self._update(in_flight=-1)
+                    if self.async_slots:
+                        self.async_slots.release()
+                attempt += 1
+                self._update(retries=1)
+                if on_retry:
+                    on_retry()
+                if wait:
+                    print(f"Request failed ({error}), retrying in {wait:.1f}s...")
+                    await asyncio.sleep(wait)
+                else:
+                    print(f"Request failed ({error}), retrying with another API key...")
+        finally:
+            if queued:
+                self._update(queued=-1)
+
+    def stats(self):
+        with self.lock:
+            return {"queue_depth": self.queue_depth, "in_flight": self.in_flight, "retries": self.retries}
+
+
+def get_scheduler(config):
+    """获取进程内共享的请求调度器，参数来自 config.json 的 "rate_limits" 和 "api_keys"。"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            options = config.get("rate_limits") or {}
+            _scheduler = RequestScheduler(
+                requests_per_minute=options.get("requests_per_minute"),
+                tokens_per_minute=options.get("tokens_per_minute"),
+                max_concurrency=options.get("max_concurrency"),
+                max_retries=options.get("max_retries", 5),
+                backoff_base=options.get("backoff_base", 1.0),
+                backoff_max=options.get("backoff_max", 60.0),
+                key_pool=KeyPool.from_config(config),
+            )
+        return _scheduler
@@ -0,0 +1,253 @@
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from contextlib import closing
+from log_archive import load_manifest, read_archived_messages
+from session_records import parse_markdown_log, read_records
+from usage_ledger import HEADER_READ_SIZE, parse_log_header
+
+SEARCH_INDEX_FILE = "search_index.db"
+# 片段中标记命中词的控制字符，显示时替换为终端样式
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+# 按相关度排序前，最多只取最近的这么多条匹配，避免常见词在大量日志中排序过慢
+MAX_CANDIDATES = 2000
+FILTER_PATTERN = re.compile(r"^(role|model|since|until|limit):(.+)$", re.IGNORECASE)
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def trigram_supported():
+    """SQLite 3.34 起 FTS5 提供 trigram 分词器，可以按子串匹配中文等不以空格分词的文本。"""
+    return sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+def parse_query(query):
+    """把 --search 的参数拆分为检索词和过滤条件（role:、model:、since:、until:、limit:）。"""
+    terms, filters = [], {}
+    for word in query.split():
+        match = FILTER_PATTERN.match(word)
+        if match:
+            filters[match.group(1).lower()] = match.group(2)
+        else:
+            terms.append(word)
+    return terms, filters
+
+
+class SearchIndex:
+    """聊天记录的增量全文索引（SQLite FTS5）。
+
+    每条消息是一行，附带日志文件名、角色、模型和日期；indexed_logs 记录每个日志已索引的消息数，
+    新消息在写日志时直接加入索引，其他进程写入或更早的日志在第一次搜索时补齐。
+    """
+
+    def __init__(self, log_directory, index_path=None):
+        self.log_directory = log_directory
+        self.index_path = index_path or os.path.join(log_directory, SEARCH_INDEX_FILE)
+        self.refreshed = False
+        self.refresh_thread = None
+        self.lock = threading.Lock()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS indexed_logs ("
+                "path TEXT PRIMARY KEY, model TEXT, day TEXT, messages INTEGER, size INTEGER, mtime_ns INTEGER)"
+            )
+            tokenizer = "trigram" if trigram_supported() else "unicode61 remove_diacritics 2"
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+                "content, path UNINDEXED, role UNINDEXED, model UNINDEXED, day UNINDEXED, seq UNINDEXED, "
+                f"tokenize='{tokenizer}')"
+            )
+            self.trigram = "trigram" in conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'messages'"
+            ).fetchone()[0]
+
+    def _connect(self):
+        return sqlite3.connect(self.index_path, timeout=10)
+
+    def add_message(self, log_path, model, day, message, seq):
+        """把刚写入日志的第 seq 条消息加入索引（由日志写入线程调用）。
+
+        索引中该日志的消息数与 seq 不一致时（例如继续了一个尚未索引的旧日志）不做处理，留给 refresh 补齐。
+        """
+        path = os.path.basename(log_path)
+        with self.lock, closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT messages FROM indexed_logs WHERE path = ?", (path,)).fetchone()
+            if (row[0] if row else 0) != seq:
+                return
+            conn.execute(
+                "INSERT INTO messages (content, path, role, model, day, seq) VALUES (?, ?, ?, ?, ?, ?)",
+                (message["content"], path, message["role"], model, day, seq)
+            )
+            # size/mtime 保持旧值，下次补齐时会发现文件已变化，但只读取 seq 之后的新记录
+            conn.execute(
+                "INSERT INTO indexed_logs (path, model, day, messages, size, mtime_ns) VALUES (?, ?, ?, ?, -1, -1) "
+                "ON CONFLICT(path) DO UPDATE SET messages = messages + 1",
+                (path, model, day, seq + 1)
+            )
+
+    def refresh(self):
+        """补齐索引：读取新增或变化的日志（包括归档日志）中尚未索引的消息，并删除已不存在的日志。
+
+        Returns:
+            int: 新加入索引的消息数。
+        """
+        added = 0
+        with self.lock, closing(self._connect()) as conn, conn:
+            known = {
+                path: (messages, size, mtime_ns)
+                for path, messages, size, mtime_ns in conn.execute(
+                    "SELECT path, messages, size, mtime_ns FROM indexed_logs"
+                )
+            }
+            seen = set()
+            with os.scandir(self.log_directory) as entries:
+                for entry in entries:
+                    if not entry.is_file() or not entry.name.endswith(".md"):
+                        continue
+                    stat = entry.stat()
+                    seen.add(entry.name)
+                    indexed, size, mtime_ns = known.get(entry.name, (0, None, None))
+                    if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    try:
+                        added += self._index_log(conn, entry.path, indexed, stat)
+                    except (OSError, ValueError) as e:
+                        print(f"Error indexing {entry.name}: {e}")
+            # 归档日志保留在索引中；归档前没有索引完的，从归档中流式解压补齐
+            for name, archived in load_manifest(self.log_directory).items():
+                if name in seen:
+                    continue
+                seen.add(name)
+                indexed, size, mtime_ns = known.get(name, (0, None, None))
+                if (size, mtime_ns) == (archived["size"], -1):
+                    continue
+                try:
+                    added += self._index_archived_log(conn, name, archived, indexed)
+                except (OSError, ValueError, zlib.error) as e:
+                    print(f"Error indexing archived {name}: {e}")
+            for path in known:
+                if path not in seen:
+                    conn.execute("DELETE FROM messages WHERE path = ?", (path,))
+                    conn.execute("DELETE FROM indexed_logs WHERE path = ?", (path,))
+        self.refreshed = True
+        return added
+
+    def refresh_in_background(self):
+        """在后台线程中补齐索引，第一次搜索时通常已经完成。"""
+        if self.refreshed or self.refresh_thread is not None:
+            return
+        self.refresh_thread = threading.Thread(target=self._background_refresh, daemon=True)
+        self.refresh_thread.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error refreshing search index: {e}")
+
+    def _index_log(self, conn, log_path, indexed, stat):
+        path = os.path.basename(log_path)
+        with open(log_path, "rb") as f:
+            header = parse_log_header(f.read(HEADER_READ_SIZE))
+        messages = read_records(log_path, indexed)
+        if messages is None:
+            # 没有结构化记录的旧日志，整体重新解析
+            conn.execute("DELETE FROM messages WHERE path = ?", (path,))
+            indexed = 0
+            messages = parse_markdown_log(log_path)
+        conn.executemany(
+            "INSERT INTO messages (content, path, role, model, day, seq) VALUES (?, ?, ?, ?, ?, ?)",
+            [(m["content"], path, m["role"], header["model"], header["day"], indexed + i)
+             for i, m in enumerate(messages)]
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO indexed_logs (path, model, day, messages, size, mtime_ns) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (path, header["model"], header["day"], indexed + len(messages), stat.st_size, stat.st_mtime_ns)
+        )
+        return len(messages)
+
+    def _index_archived_log(self, conn, name, archived, indexed):
+        if "jsonl" not in archived["members"]:
+            conn.execute("DELETE FROM messages WHERE path = ?", (name,))
+            indexed = 0
+        messages = read_archived_messages(self.log_directory, archived, indexed)
+        conn.executemany(
+            "INSERT INTO messages (content, path, role, model, day, seq) VALUES (?, ?, ?, ?, ?, ?)",
+            [(m["content"], name, m["role"], archived["model"], archived["day"], indexed + i)
+             for i, m in enumerate(messages)]
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO indexed_logs (path, model, day, messages, size, mtime_ns) "
+            "VALUES (?, ?, ?, ?, ?, -1)",
+            (name, archived["model"], archived["day"], indexed + len(messages), archived["size"])
+        )
+        return len(messages)
+
+    def search(self, query, limit=20):
+        """按相关度检索消息。
+
+        Args:
+            query (str): 检索词，可以带 role:user、model:gpt-4o、since:2024-01-01、until:2024-12-31、limit:50。
+
+        Returns:
+            list: 每个结果一个字典，包含 path, role, model, day, snippet。
+        """
+        if self.refresh_thread is not None:
+            self.refresh_thread.join()
+        if not self.refreshed:
+            self.refresh()
+        terms, filters = parse_query(query)
+        if not terms:
+            return []
+        limit = int(filters.get("limit", limit))
+        conditions, params = [], []
+        # trigram 分词器只能匹配至少 3 个字符的词，更短的词逐行查找子串
+        match_terms = [t for t in terms if not self.trigram or len(t) >= 3]
+        like_terms = [t for t in terms if t not in match_terms]
+        if match_terms:
+            conditions.append("messages MATCH ?")
+            params.append(" AND ".join('"' + t.replace('"', '""') + '"' for t in match_terms))
+        for term in like_terms:
+            conditions.append("instr(lower(content), ?) > 0")
+            params.append(term.lower())
+        for key, column, operator in (("role", "role", "="), ("model", "model", "="),
+                                      ("since", "day", ">="), ("until", "day", "<=")):
+            if key in filters:
+                conditions.append(f"{column} {operator} ?")
+                params.append(filters[key].lower() if key == "role" else filters[key])
+        where = " AND ".join(conditions)
+        with closing(self._connect()) as conn:
+            if match_terms:
+                # 只在最近的 MAX_CANDIDATES 条匹配中按 bm25 排序（按 rowid 倒序查找可以提前结束）
+                lowest = conn.execute(
+                    f"SELECT min(rowid) FROM (SELECT rowid FROM messages WHERE {where} "
+                    f"ORDER BY rowid DESC LIMIT {MAX_CANDIDATES})", params
+                ).fetchone()[0]
+                if lowest is None:
+                    return []
+                snippet = f"snippet(messages, 0, '{SNIPPET_START}', '{SNIPPET_END}', '...', 16)"
+                sql = (f"SELECT path, role, model, day, {snippet} FROM messages "
+                       f"WHERE {where} AND rowid >= ? ORDER BY bm25(messages) LIMIT ?")
+                params = params + [lowest]
+            else:
+                # 只有短词时逐行匹配，从最新的消息开始，找够结果即停止
+                sql = (f"SELECT path, role, model, day, substr(content, 1, 160) FROM messages "
+                       f"WHERE {where} ORDER BY rowid DESC LIMIT ?")
+            rows = conn.execute(sql, params + [limit]).fetchall()
+        return [{"path": path, "role": role, "model": model, "day": day, "snippet": text}
+                for path, role, model, day, text in rows]
+
+
+def get_search_index(log_directory):
+    """获取进程内共享的搜索索引。"""
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            os.makedirs(log_directory, exist_ok=True)
+            _search_index = SearchIndex(log_directory)
+        return _search_index
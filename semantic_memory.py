@@ -0,0 +1,506 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from log_archive import load_manifest, read_archived_messages
+from session_records import parse_markdown_log, read_records
+
+MEMORY_DIRECTORY = "memory"
+VECTORS_FILE = "vectors.f32"
+CHUNKS_FILE = "chunks.jsonl"
+STATE_FILE = "state.json"
+DEFAULT_MEMORY_OPTIONS = {
+    "enabled": False,
+    "top_k": 4,
+    "min_score": 0.25,        # 相似度低于这个值的片段不注入
+    "max_tokens": 1500,       # 每次请求注入的片段最多占用的 Token 数
+    "chunk_chars": 1000,
+    "min_chunk_chars": 20,    # 更短的消息（如“好的，谢谢”）不进入记忆
+    "dimensions": 1024,       # 本地哈希向量的维数
+    "embedding_model": None,  # 为空时使用离线的哈希向量，否则调用 OpenAI embeddings 接口
+}
+MEMORY_HEADER = "Relevant excerpts from earlier conversations (for reference only, they may be outdated):"
+# 英文等按词，中文等不以空格分词的文字按相邻两个字
+WORD_PATTERN = re.compile(r"[^\W\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]{2,}")
+CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+")
+EMBEDDING_BATCH_SIZE = 100
+# 后台补齐索引（其他进程写入的日志、归档日志）的最短间隔秒数
+REFRESH_INTERVAL = 60
+_semantic_memory = None
+_numpy_missing = False
+_semantic_memory_lock = threading.Lock()
+
+
+def get_memory_options(config):
+    """合并 config.json 中的 "memory" 配置和默认值。"""
+    options = dict(DEFAULT_MEMORY_OPTIONS)
+    options.update(config.get("memory") or {})
+    return options
+
+
+def text_digest(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def split_chunks(text, chunk_chars):
+    """把一条消息按段落切成不超过 chunk_chars 个字符的片段。"""
+    chunks, current = [], ""
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        while len(paragraph) > chunk_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:chunk_chars])
+            paragraph = paragraph[chunk_chars:]
+        if current and len(current) + len(paragraph) + 2 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        if paragraph:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class HashingEmbedder:
+    """离线的向量化：把词和相邻汉字的哈希值映射到固定维数（feature hashing），词频取对数并归一化。"""
+
+    uses_idf = True
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    @staticmethod
+    def features(text):
+        text = text.lower()
+        features = WORD_PATTERN.findall(text)
+        for run in CJK_PATTERN.findall(text):
+            features.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+        return features
+
+    def embed(self, texts, on_usage=None):
+        import numpy as np
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                value = zlib.crc32(feature.encode("utf-8"))
+                rows.append(row)
+                columns.append(value % self.dimensions)
+                # 用哈希的高位决定符号，减小冲突带来的偏差
+                signs.append(1.0 if value >> 31 else -1.0)
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        np.add.at(matrix, (np.array(rows, dtype=np.intp), np.array(columns, dtype=np.intp)),
+                  np.array(signs, dtype=np.float32))
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        return normalize_rows(matrix)
+
+
+class OpenAIEmbedder:
+    """调用 OpenAI embeddings 接口的向量化（需要联网，按 Token 计费）。
+
+    请求经过共享的调度器，与对话请求一起限流、重试，并使用 key 池中的 key。
+    """
+
+    uses_idf = False
+
+    def __init__(self, config, model):
+        self.config = config
+        self.name = model
+
+    def embed(self, texts, on_usage=None):
+        """向量化 texts；on_usage 接收每次请求的 Token 使用数据，用于计入会话的用量。"""
+        import numpy as np
+        from context_window import estimate_tokens
+        from openai_client import get_client, keyed_client
+        from scheduler import get_scheduler
+        scheduler = get_scheduler(self.config)
+        vectors = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            batch = texts[start:start + EMBEDDING_BATCH_SIZE]
+            estimated_tokens = sum(estimate_tokens(text) for text in batch)
+            response = scheduler.run(
+                lambda: keyed_client(get_client(self.config)).embeddings.create(model=self.name, input=batch),
+                estimated_tokens
+            )
+            usage = getattr(response, "usage", None)
+            scheduler.settle(estimated_tokens, usage.total_tokens if usage else None)
+            if usage and on_usage:
+                on_usage({"prompt_tokens": usage.total_tokens, "cached_tokens": 0, "completion_tokens": 0,
+                          "total_tokens": usage.total_tokens})
+            vectors.extend(item.embedding for item in response.data)
+        return normalize_rows(np.array(vectors, dtype=np.float32))
+
+
+def normalize_rows(matrix):
+    import numpy as np
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class SemanticMemory:
+    """聊天记录的向量索引，用于在请求前找出与当前问题相关的旧对话片段。
+
+    向量以 float32 逐行追加到 vectors.f32，片段的元数据追加到 chunks.jsonl，
+    state.json 记录有效行数和每个日志已加入的消息数，只有它更新后追加的内容才算生效，
+    因此中断的写入会在下次加载时被截掉。日志被删除或需要重新解析时才重写整个索引。
+
+    本进程写入日志的新消息由日志写入线程通过 add_message 交给后台线程加入，其他日志由后台的 refresh 补齐，
+    召回时不读取日志。向量化在 lock 之外进行（写入之间用 update_lock 排队），召回不会等待向量化。
+    各方法的 on_usage 接收向量化请求的 Token 使用数据（例如 ChatGPT.defer_usage）。
+    """
+
+    def __init__(self, log_directory, options, embedder):
+        import numpy as np
+        self.log_directory = log_directory
+        self.directory = os.path.join(log_directory, MEMORY_DIRECTORY)
+        self.options = options
+        self.embedder = embedder
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()
+        self.tasks = queue.Queue()
+        self.worker = None
+        self.refresh_pending = False
+        self.last_refresh = None
+        self.chunks = []
+        self.logs = {}  # 日志文件名 -> [已加入的消息数, 大小, mtime_ns]
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.digests = np.zeros(0, dtype=np.uint32)
+        self.document_frequency = None
+        self.count = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        import numpy as np
+        try:
+            with open(self._path(STATE_FILE), "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if state is None or state.get("embedder") != self.embedder.name:
+            # 没有索引或换了向量化方式，从头建立
+            self._rewrite([], np.zeros((0, 0), dtype=np.float32), {})
+            return
+        count, dimensions = state["count"], state["dimensions"]
+        chunks, chunks_size = [], 0
+        try:
+            vectors = np.fromfile(self._path(VECTORS_FILE), dtype=np.float32)
+            with open(self._path(CHUNKS_FILE), "rb") as f:
+                for _, line in zip(range(count), f):
+                    chunks.append(json.loads(line))
+                    chunks_size += len(line)
+        except (OSError, ValueError):
+            vectors = np.zeros(0, dtype=np.float32)
+        if len(chunks) < count or len(vectors) < count * dimensions:
+            self._rewrite([], np.zeros((0, 0), dtype=np.float32), {})
+            return
+        self.logs = state["logs"]
+        self._set(chunks, vectors[:count * dimensions].reshape(count, dimensions))
+        # 截掉 state.json 之后追加的不完整内容
+        with open(self._path(VECTORS_FILE), "r+b") as f:
+            f.truncate(count * dimensions * 4)
+        with open(self._path(CHUNKS_FILE), "r+b") as f:
+            f.truncate(chunks_size)
+
+    def _set(self, chunks, vectors):
+        import numpy as np
+        self.chunks = chunks
+        self.count = len(chunks)
+        self.vectors = vectors
+        self.digests = np.array([c["digest"] for c in chunks], dtype=np.uint32)
+        if self.embedder.uses_idf and self.count:
+            self.document_frequency = np.count_nonzero(vectors, axis=0)
+        else:
+            self.document_frequency = None
+
+    def _save_state(self):
+        state = {"embedder": self.embedder.name, "dimensions": self.vectors.shape[1] if self.count else 0,
+                 "count": self.count, "logs": self.logs}
+        temp_path = self._path(STATE_FILE + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self._path(STATE_FILE))
+
+    def _rewrite(self, chunks, vectors, logs):
+        """重写整个索引（先写临时文件再替换）。"""
+        for name, data in ((VECTORS_FILE, vectors.astype("float32").tobytes()),
+                           (CHUNKS_FILE, "".join(json.dumps(c, ensure_ascii=False) + "\n"
+                                                 for c in chunks).encode("utf-8"))):
+            temp_path = self._path(name + ".tmp")
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self._path(name))
+        self.logs = logs
+        self._set(chunks, vectors)
+        self._save_state()
+
+    def _append(self, chunks, vectors):
+        import numpy as np
+        if not chunks:
+            return
+        with open(self._path(VECTORS_FILE), "ab") as f:
+            f.write(vectors.astype(np.float32).tobytes())
+        with open(self._path(CHUNKS_FILE), "ab") as f:
+            f.write("".join(json.dumps(c, ensure_ascii=False) + "\n" for c in chunks).encode("utf-8"))
+        if not self.count:
+            self._set(chunks, vectors)
+            return
+        # 只对新增的部分计算摘要和文档频率
+        self.chunks.extend(chunks)
+        self.count = len(self.chunks)
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.digests = np.concatenate([self.digests, np.array([c["digest"] for c in chunks], dtype=np.uint32)])
+        if self.document_frequency is not None:
+            self.document_frequency = self.document_frequency + np.count_nonzero(vectors, axis=0)
+
+    def _make_chunks(self, name, messages, start):
+        chunks = []
+        for seq, message in enumerate(messages, start=start):
+            content = message.get("content") or ""
+            if message.get("role") not in ("user", "assistant") or len(content) < self.options["min_chunk_chars"]:
+                continue
+            digest = text_digest(content)
+            for text in split_chunks(content, self.options["chunk_chars"]):
+                chunks.append({"path": name, "seq": seq, "role": message["role"], "digest": digest, "text": text})
+        return chunks
+
+    def refresh(self, on_usage=None):
+        """把新增或变化的日志（包括归档日志）中尚未加入的消息加入索引，删除已不存在的日志。
+
+        Returns:
+            int: 新加入的片段数。
+        """
+        with self.update_lock:
+            return self._refresh(on_usage)
+
+    def _refresh(self, on_usage=None):
+        pending, removed = [], set()
+        seen = set()
+        if os.path.isdir(self.log_directory):
+            with os.scandir(self.log_directory) as entries:
+                for entry in entries:
+                    if not entry.is_file() or not entry.name.endswith(".md"):
+                        continue
+                    stat = entry.stat()
+                    seen.add(entry.name)
+                    indexed, size, mtime_ns = self.logs.get(entry.name, (0, None, None))
+                    if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    try:
+                        messages = read_records(entry.path, indexed)
+                        if messages is None:
+                            # 没有结构化记录的旧日志，整体重新解析
+                            if indexed:
+                                removed.add(entry.name)
+                            indexed, messages = 0, parse_markdown_log(entry.path)
+                    except (OSError, ValueError) as e:
+                        print(f"Error reading {entry.name} for memory: {e}")
+                        continue
+                    pending.append((entry.name, indexed, messages, stat.st_size, stat.st_mtime_ns))
+        for name, archived in load_manifest(self.log_directory).items():
+            if name in seen:
+                continue
+            seen.add(name)
+            indexed, size, mtime_ns = self.logs.get(name, (0, None, None))
+            if (size, mtime_ns) == (archived["size"], -1):
+                continue
+            try:
+                if "jsonl" not in archived["members"] and indexed:
+                    removed.add(name)
+                    indexed = 0
+                messages = read_archived_messages(self.log_directory, archived, indexed)
+            except (OSError, ValueError, zlib.error) as e:
+                print(f"Error reading archived {name} for memory: {e}")
+                continue
+            pending.append((name, indexed, messages, archived["size"], -1))
+        removed.update(name for name in self.logs if name not in seen)
+        chunks = []
+        for name, indexed, messages, _, _ in pending:
+            chunks.extend(self._make_chunks(name, messages, indexed))
+        # 向量化可能需要请求 API，不持有 lock，召回可以同时进行
+        vectors = self.embedder.embed([c["text"] for c in chunks], on_usage) if chunks else None
+        with self.lock:
+            if removed:
+                self._remove_logs(removed)
+            for name, indexed, messages, size, mtime_ns in pending:
+                self.logs[name] = [indexed + len(messages), size, mtime_ns]
+            if chunks:
+                self._append(chunks, vectors)
+            if chunks or pending or removed:
+                self._save_state()
+        self.last_refresh = time.monotonic()
+        return len(chunks)
+
+    def add_message(self, log_path, message, seq, on_usage=None):
+        """把刚写入日志的第 seq 条消息交给后台线程加入索引（由日志写入线程调用，不等待向量化）。"""
+        self._submit(("message", os.path.basename(log_path), message, seq, on_usage))
+
+    def refresh_in_background(self, on_usage=None):
+        """在后台线程中补齐索引；距离上次补齐不到 REFRESH_INTERVAL 秒或已在排队时不重复。"""
+        with self.lock:
+            if self.refresh_pending:
+                return
+            if self.last_refresh is not None and time.monotonic() - self.last_refresh < REFRESH_INTERVAL:
+                return
+            self.refresh_pending = True
+        self._submit(("refresh", on_usage))
+
+    def wait_idle(self):
+        """等待后台线程处理完已提交的任务。"""
+        self.tasks.join()
+
+    def _submit(self, task):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+        self.tasks.put(task)
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task[0] == "refresh":
+                    with self.lock:
+                        self.refresh_pending = False
+                    self.refresh(task[1])
+                else:
+                    self._add_message(*task[1:])
+            except Exception as e:
+                print(f"Error updating memory: {e}")
+            finally:
+                self.tasks.task_done()
+
+    def _add_message(self, name, message, seq, on_usage=None):
+        with self.update_lock:
+            indexed, _, _ = self.logs.get(name, (0, None, None))
+            if indexed != seq:
+                # 与已加入的消息数不一致（例如继续了一个尚未加入的旧日志），留给 refresh 补齐
+                return
+            chunks = self._make_chunks(name, [message], seq)
+            vectors = self.embedder.embed([c["text"] for c in chunks], on_usage) if chunks else None
+            with self.lock:
+                # 大小和 mtime 记为 -1，下次补齐时只读取 seq 之后的新记录
+                self.logs[name] = [seq + 1, -1, -1]
+                if chunks:
+                    self._append(chunks, vectors)
+                self._save_state()
+
+    def rebuild(self, on_usage=None):
+        """丢弃整个索引并从所有日志重新建立，返回片段数。"""
+        import numpy as np
+        with self.update_lock:
+            with self.lock:
+                self._rewrite([], np.zeros((0, 0), dtype=np.float32), {})
+            return self._refresh(on_usage)
+
+    def _remove_logs(self, names):
+        keep = [i for i, c in enumerate(self.chunks) if c["path"] not in names]
+        logs = {name: value for name, value in self.logs.items() if name not in names}
+        self._rewrite([self.chunks[i] for i in keep], self.vectors[keep], logs)
+
+    def recall(self, query, top_k=None, exclude_digests=(), on_usage=None):
+        """找出与 query 最相关的片段。
+
+        Args:
+            query (str): 当前的问题。
+            exclude_digests (iterable): 已经在上下文中的消息内容的摘要（text_digest），这些消息的片段不再返回。
+
+        Returns:
+            list: (相似度, 片段) 列表，按相似度从高到低排列。
+        """
+        import numpy as np
+        top_k = top_k or self.options["top_k"]
+        with self.lock:
+            if not self.count:
+                return []
+        # 查询的向量化可能需要请求 API，不持有 lock
+        query_vector = self.embedder.embed([query], on_usage)[0]
+        with self.lock:
+            if not self.count or self.vectors.shape[1] != len(query_vector):
+                return []
+            if self.document_frequency is not None:
+                # 逆文档频率只加在查询向量上，已存的向量不需要随文档数变化重新计算
+                idf = np.log((self.count + 1) / (self.document_frequency + 1)).astype(np.float32) + 1.0
+                query_vector = query_vector * idf
+                norm = np.linalg.norm(query_vector)
+                if norm:
+                    query_vector /= norm
+            scores = self.vectors @ query_vector
+            if exclude_digests:
+                scores[np.isin(self.digests, np.fromiter(exclude_digests, dtype=np.uint32))] = -1.0
+            candidates = min(self.count, top_k * 3)
+            order = np.argpartition(-scores, candidates - 1)[:candidates]
+            order = order[np.argsort(-scores[order])]
+            results, texts = [], set()
+            for index in order:
+                score = float(scores[index])
+                chunk = self.chunks[index]
+                if score < self.options["min_score"] or len(results) >= top_k:
+                    break
+                if chunk["text"] in texts:
+                    continue
+                texts.add(chunk["text"])
+                results.append((score, chunk))
+            return results
+
+    def stats(self):
+        with self.lock:
+            return {"embedder": self.embedder.name, "chunks": self.count, "logs": len(self.logs),
+                    "bytes": self.vectors.nbytes}
+
+
+def format_memory(results, count_tokens, max_tokens):
+    """把召回的片段整理为一条注入请求的消息内容，超出 max_tokens 的片段不再加入。
+
+    Returns:
+        tuple: (消息内容, 使用的片段数)。没有片段时内容为 None。
+    """
+    lines, used = [MEMORY_HEADER], count_tokens(MEMORY_HEADER)
+    for _, chunk in results:
+        text = f"\n[{chunk['path']}, {chunk['role']}]\n{chunk['text']}"
+        tokens = count_tokens(text)
+        if used + tokens > max_tokens:
+            break
+        lines.append(text)
+        used += tokens
+    if len(lines) == 1:
+        return None, 0
+    return "\n".join(lines), len(lines) - 1
+
+
+def get_semantic_memory(config, log_directory, on_usage=None):
+    """获取进程内共享的语义记忆（第一次使用时加载），没有安装 numpy 时返回 None。
+
+    on_usage 接收第一次加载时后台补齐索引产生的向量化用量。
+    """
+    global _semantic_memory, _numpy_missing
+    options = get_memory_options(config)
+    with _semantic_memory_lock:
+        if _semantic_memory is None:
+            if _numpy_missing:
+                return None
+            try:
+                import numpy  # noqa: F401
+            except ImportError:
+                print("Semantic memory requires numpy (pip install numpy). Memory is turned off.")
+                _numpy_missing = True
+                return None
+            if options["embedding_model"]:
+                embedder = OpenAIEmbedder(config, options["embedding_model"])
+            else:
+                embedder = HashingEmbedder(options["dimensions"])
+            os.makedirs(log_directory, exist_ok=True)
+            _semantic_memory = SemanticMemory(log_directory, options, embedder)
+            # 其他进程写入和归档的日志在后台补齐，召回时不等待
+            _semantic_memory.refresh_in_background(on_usage)
+        return _semantic_memory
@@ -0,0 +1,149 @@
+import json
+import mmap
+import os
+import struct
+import time
+
+# 每条消息在索引文件中占一个 8 字节的小端偏移量
+INDEX_ENTRY = struct.Struct("<Q")
+LOG_ROLES = {"## User": "user", "## Assistant": "assistant", "## System": "system"}
+
+
+def sidecar_paths(log_path):
+    """返回 Markdown 日志对应的结构化记录文件和偏移索引文件路径。"""
+    stem = os.path.splitext(log_path)[0]
+    return f"{stem}.jsonl", f"{stem}.idx"
+
+
+def encode_record(message):
+    """把一条消息编码为一行 JSON 记录（换行符在 JSON 字符串中会被转义，内容原样保留）。"""
+    record = {"role": message["role"], "content": message["content"], "time": round(time.time(), 3)}
+    if message.get("model"):
+        record["model"] = message["model"]
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def write_records(log_path, messages):
+    """为已有的 Markdown 日志一次性生成结构化记录和索引（旧日志迁移用）。"""
+    records_path, index_path = sidecar_paths(log_path)
+    offset = 0
+    with open(records_path, "wb") as records, open(index_path, "wb") as index:
+        for message in messages:
+            data = encode_record(message)
+            records.write(data)
+            index.write(INDEX_ENTRY.pack(offset))
+            offset += len(data)
+
+
+def read_offsets(data, index_path):
+    """读取偏移索引；索引缺失或没有覆盖到记录文件末尾时扫描记录重建。
+
+    Args:
+        data (mmap): 记录文件内容。
+        index_path (str): 索引文件路径。
+    """
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as f:
+            raw = f.read()
+        raw = raw[:len(raw) - len(raw) % INDEX_ENTRY.size]
+        offsets = [entry[0] for entry in INDEX_ENTRY.iter_unpack(raw)]
+        if offsets and offsets[-1] < len(data) and data.find(b"\n", offsets[-1]) == len(data) - 1:
+            return offsets
+    offsets = []
+    offset = 0
+    while offset < len(data):
+        end = data.find(b"\n", offset)
+        if end == -1:
+            # 写入中断留下的不完整记录
+            break
+        offsets.append(offset)
+        offset = end + 1
+    with open(index_path, "wb") as f:
+        f.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+    return offsets
+
+
+def load_records_tail(log_path, token_budget=None, count_tokens=None):
+    """从结构化记录中加载能放进上下文预算的最近若干条消息。
+
+    记录文件以 mmap 方式打开，按索引从末尾向前只解码需要的记录。
+
+    Args:
+        log_path (str): Markdown 日志路径。
+        token_budget (int): 上下文 Token 预算，为 None 时加载全部消息。
+        count_tokens (callable): 计算单条消息 Token 数的函数。
+
+    Returns:
+        tuple: (消息列表, 记录总条数)；没有结构化记录时返回 (None, 0)。
+    """
+    records_path, index_path = sidecar_paths(log_path)
+    if not os.path.exists(records_path) or os.path.getsize(records_path) == 0:
+        return None, 0
+    with open(records_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offsets = read_offsets(data, index_path)
+        messages = []
+        tokens = 0
+        for offset in reversed(offsets):
+            end = data.find(b"\n", offset)
+            record = json.loads(data[offset:end])
+            message = {"role": record["role"], "content": record["content"]}
+            if token_budget is not None and count_tokens is not None:
+                tokens += count_tokens(message)
+                if tokens > token_budget and messages:
+                    break
+            messages.append(message)
+    messages.reverse()
+    # 保持一问一答的顺序，上下文不以助手消息开头
+    while len(messages) > 1 and messages[0]["role"] == "assistant":
+        messages.pop(0)
+    return messages, len(offsets)
+
+
+def read_records(log_path, start=0):
+    """按顺序读取第 start 条及之后的结构化记录；没有结构化记录时返回 None。"""
+    records_path, index_path = sidecar_paths(log_path)
+    if not os.path.exists(records_path):
+        return None
+    if os.path.getsize(records_path) == 0:
+        return []
+    messages = []
+    with open(records_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for offset in read_offsets(data, index_path)[start:]:
+            record = json.loads(data[offset:data.find(b"\n", offset)])
+            messages.append({"role": record["role"], "content": record["content"]})
+    return messages
+
+
+def parse_markdown_log(log_path):
+    """无损解析 Markdown 日志中的消息（没有结构化记录的旧日志使用）。
+
+    只把单独成行的 "## User"、"## Assistant"、"## System" 视为消息边界，
+    其余各行（包括缩进、以 - # ** 开头的行）原样保留，只去掉写入时追加的结尾空行。
+    """
+    with open(log_path, "r", encoding="utf-8", newline="") as f:
+        return parse_markdown_text(f.read())
+
+
+def parse_markdown_text(text):
+    """parse_markdown_log 的解析部分，也用于从归档中解压出的日志内容。"""
+    lines = text.splitlines(keepends=True)
+    messages = []
+    current = None
+    for line in lines:
+        role = LOG_ROLES.get(line.rstrip("\r\n"))
+        if role:
+            current = {"role": role, "parts": []}
+            messages.append(current)
+        elif current is not None:
+            current["parts"].append(line)
+
+    history = []
+    for message in messages:
+        content = "".join(message["parts"])
+        # append_to_log 在每条消息后写入 "\n\n"
+        if content.endswith("\n\n"):
+            content = content[:-2]
+        elif content.endswith("\n"):
+            content = content[:-1]
+        history.append({"role": message["role"], "content": content})
+    return history
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+HEARTBEAT_INTERVAL = 10
+# 超过这么多个心跳周期没有更新的会话视为已失效
+STALE_HEARTBEATS = 3
+
+
+def pid_alive(pid):
+    """检查进程是否仍在运行。"""
+    if not pid:
+        return False
+    if os.name == "nt":
+        import ctypes
+        process_query_limited_information = 0x1000
+        still_active = 259
+        handle = ctypes.windll.kernel32.OpenProcess(process_query_limited_information, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == still_active
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SessionRegistry:
+    """跨进程共享的会话登记表（SQLite WAL 模式）。
+
+    每个会话一行，增删改只影响对应的行；每行记录所属进程的 PID 和心跳时间，
+    列出会话时会清理进程已退出或心跳超时的记录。
+    """
+
+    def __init__(self, db_path, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.db_path = db_path
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_thread = None
+        self.heartbeat_stop = threading.Event()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_name TEXT PRIMARY KEY, status TEXT, pid INTEGER, started_at REAL, heartbeat REAL, "
+                "address TEXT)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]
+            if "address" not in columns:
+                conn.execute("ALTER TABLE sessions ADD COLUMN address TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def upsert(self, session_name, status, address=None):
+        """新增会话或更新已有会话的状态，归属当前进程。address 为该进程控制通道的地址。"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO sessions (session_name, status, pid, started_at, heartbeat, address) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(session_name) DO UPDATE SET status = excluded.status, pid = excluded.pid, "
+                "heartbeat = excluded.heartbeat, address = excluded.address",
+                (session_name, status, os.getpid(), now, now, address)
+            )
+
+    def remove(self, session_name):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM sessions WHERE session_name = ?", (session_name,))
+
+    def clear(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM sessions")
+
+    def heartbeat(self):
+        """刷新当前进程所有会话的心跳时间。"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE sessions SET heartbeat = ? WHERE pid = ?", (time.time(), os.getpid()))
+
+    def list(self):
+        """列出仍然有效的会话，同时删除失效的记录。
+
+        Returns:
+            list: 每个会话一个字典，包含 session_name, status, pid, started_at, heartbeat, address。
+        """
+        deadline = time.time() - self.heartbeat_interval * STALE_HEARTBEATS
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                "SELECT session_name, status, pid, started_at, heartbeat, address FROM sessions ORDER BY started_at"
+            ).fetchall()
+            sessions, stale = [], []
+            for session_name, status, pid, started_at, heartbeat, address in rows:
+                if heartbeat < deadline or not pid_alive(pid):
+                    stale.append((session_name,))
+                    continue
+                sessions.append({
+                    "session_name": session_name, "status": status, "pid": pid,
+                    "started_at": started_at, "heartbeat": heartbeat, "address": address
+                })
+            conn.executemany("DELETE FROM sessions WHERE session_name = ?", stale)
+        return sessions
+
+    def start_heartbeat(self):
+        """启动本进程的心跳线程（每个进程只启动一次）。"""
+        if self.heartbeat_thread is not None:
+            return
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self.heartbeat_stop.set()
+
+    def _heartbeat_loop(self):
+        while not self.heartbeat_stop.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                print(f"Error updating session heartbeat: {e}")
@@ -0,0 +1,76 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# 子进程在到达输入提示时输出的一行结果的前缀
+RESULT_PREFIX = "BENCH_STARTUP "
+# 应该推迟到第一次使用时才导入的模块，出现在提示前说明启动变慢了
+HEAVY_MODULES = ("openai", "httpx", "pydantic", "rich.markdown", "rich.live", "pygments", "charset_normalizer",
+                 "tiktoken", "numpy")
+
+
+def report_startup(import_start, main_start):
+    """在子进程中第一次显示输入提示前调用：输出导入耗时、初始化耗时和提示前已加载的重量级模块。"""
+    now = time.perf_counter()
+    result = {
+        "import_time": main_start - import_start,
+        "init_time": now - main_start,
+        "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def startup_command():
+    if getattr(sys, 'frozen', False):
+        return [sys.executable, "--bench-startup-child"]
+    return [sys.executable, os.path.abspath(sys.argv[0]), "--bench-startup-child"]
+
+
+def measure_once():
+    """启动一个子进程，返回 (到达输入提示的总耗时, 子进程报告的结果)。"""
+    start = time.perf_counter()
+    process = subprocess.Popen(startup_command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               stdin=subprocess.DEVNULL, text=True, encoding="utf-8")
+    result = None
+    for line in process.stdout:
+        if line.startswith(RESULT_PREFIX):
+            time_to_prompt = time.perf_counter() - start
+            result = json.loads(line[len(RESULT_PREFIX):])
+            result["time_to_prompt"] = time_to_prompt
+            break
+    # 等子进程关闭会话后退出，不留下会话记录和控制通道
+    try:
+        process.communicate(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+    return result
+
+
+def run_startup_benchmark(runs=5):
+    """多次冷启动程序，报告导入耗时和到达输入提示的耗时（毫秒）。"""
+    from rich.console import Console
+    from rich.table import Table
+
+    results = []
+    for _ in range(runs):
+        result = measure_once()
+        if result is None:
+            print("The startup benchmark child process did not reach the prompt.")
+            return
+        results.append(result)
+
+    table = Table(show_header=True, header_style="bold magenta")
+    for column in ("Phase", "Min (ms)", "Median (ms)", "Max (ms)"):
+        table.add_column(column)
+    phases = (("Imports", "import_time"), ("Initialization", "init_time"), ("Time to prompt", "time_to_prompt"))
+    for label, key in phases:
+        values = [result[key] * 1000 for result in results]
+        table.add_row(label, f"{min(values):.1f}", f"{statistics.median(values):.1f}", f"{max(values):.1f}")
+    Console().print(table)
+
+    heavy_modules = sorted({name for result in results for name in result["heavy_modules"]})
+    print(f"Runs: {runs}. Heavy modules loaded before the prompt: {', '.join(heavy_modules) or 'none'}")
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from attachments import AttachmentReader, get_attach_options, get_attachment_cache, iter_token_chunks
+from context_window import estimate_tokens
+from response_cache import make_cache_key
+from utils import get_application_path
+
+USAGE = {"prompt_tokens": 10, "cached_tokens": 0, "completion_tokens": 5, "total_tokens": 15}
+
+
+class FakeBot:
+    """按提示返回固定内容的 ChatGPT 替身，记录推迟计入的用量。"""
+
+    def __init__(self, answer=lambda prompt: "note"):
+        self.answer = answer
+        self.context_window = mock.Mock(count_text=estimate_tokens)
+        self.prompts = []
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    def complete(self, messages, cache=None):
+        key = make_cache_key({"model": "o1-mini", "messages": messages})
+        if cache is not None and cache.get(key) is not None:
+            return cache.get(key)["content"], {"response_cache_hit": True}
+        prompt = messages[0]["content"]
+        with self.lock:
+            self.prompts.append(prompt)
+        content = self.answer(prompt)
+        if cache is not None and content is not None:
+            cache.put(key, {"content": content})
+        return content, dict(USAGE)
+
+    def defer_usage(self, token_usage):
+        with self.lock:
+            self.deferred.append(token_usage)
+
+
+class AttachmentsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = mock.patch("attachments._cache", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.options = get_attach_options({"attach": {
+            "chunk_tokens": 20, "workers": 2, "cache_directory": os.path.join(self.directory.name, "cache")
+        }})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, text, name="server.log"):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_chunks_respect_token_limit(self):
+        path = self.write("".join(f"line number {i}\n" for i in range(50)) + "x" * 500 + "\n")
+        chunks = list(iter_token_chunks(path, 20, estimate_tokens))
+        self.assertTrue(all(estimate_tokens(chunk) <= 20 for chunk in chunks))
+        with open(path, "r", encoding="utf-8") as f:
+            self.assertEqual("".join(chunks), f.read())
+
+    def test_cache_directory_is_resolved_like_the_logs(self):
+        with mock.patch("attachments.ResponseCache") as cache:
+            get_attachment_cache(get_attach_options({}))
+        self.assertEqual(cache.call_args[0][0], os.path.join(get_application_path(), "attachment_cache"))
+
+    def test_small_file_is_sent_whole(self):
+        path = self.write("short file\n")
+        bot = FakeBot()
+        prompt = AttachmentReader(bot, self.options).read(path, "what is this?")
+        self.assertTrue(prompt.startswith("what is this?\n\n`server.log`"))
+        self.assertEqual(bot.prompts, [])
+
+    def test_parts_are_mapped_and_combined(self):
+        path = self.write("".join(f"event {i} happened here\n" for i in range(40)))
+        bot = FakeBot(lambda prompt: "deploy failed" if "event 7 " in prompt else "NONE")
+        reader = AttachmentReader(bot, self.options)
+        prompt = reader.read(path, "why did the deploy fail?")
+        self.assertGreater(reader.parts, 2)
+        self.assertEqual(len(bot.prompts), reader.parts)
+        self.assertIn("deploy failed", prompt)
+        self.assertEqual(prompt.count("### Part"), 1)
+        self.assertEqual(len(bot.deferred), reader.parts)
+        # 再次提问时分块结果来自缓存
+        again = AttachmentReader(bot, self.options)
+        self.assertEqual(again.read(path, "why did the deploy fail?"), prompt)
+        self.assertEqual(again.cached, again.parts)
+
+    def test_empty_content_is_treated_as_no_notes(self):
+        path = self.write("".join(f"event {i} happened here\n" for i in range(40)))
+        prompt = AttachmentReader(FakeBot(lambda prompt: None), self.options).read(path, "anything?")
+        self.assertIn("No part of the file was relevant", prompt)
+
+    def test_long_notes_are_reduced(self):
+        path = self.write("".join(f"event {i} happened here\n" for i in range(40)))
+        bot = FakeBot(lambda prompt: "combined" if prompt.startswith("Combine") else "relevant detail")
+        prompt = AttachmentReader(bot, self.options).read(path, "details?")
+        self.assertTrue(any(p.startswith("Combine") for p in bot.prompts))
+        self.assertIn("combined", prompt)
+
+    def test_cancel_does_not_wait_for_running_parts(self):
+        path = self.write("".join(f"event {i} happened here\n" for i in range(40)))
+        release = threading.Event()
+        cancelled = threading.Event()
+
+        def answer(prompt):
+            release.wait(5)
+            return "note"
+
+        threading.Timer(0.2, cancelled.set).start()
+        start = time.monotonic()
+        bot = FakeBot(answer)
+        reader = AttachmentReader(bot, self.options)
+        result = reader.read(path, "q", cancelled.is_set)
+        elapsed = time.monotonic() - start
+        release.set()
+        # 清理临时目录前等待进行中的分块写完缓存
+        reader.join()
+        self.assertIsNone(result)
+        self.assertLess(elapsed, 2)
+        # 只有已经开始的分块发出了请求
+        self.assertLessEqual(len(bot.prompts), self.options["workers"])
+        self.assertEqual(len(bot.deferred), len(bot.prompts))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+import batch
+from batch import BatchRunner, item_messages, load_completed_ids, read_batch_items, write_batch_api_file
+
+CONFIG = {"model": "o1-mini", "api_key": "sk-test", "pricing": [0.000003, 0.0000015, 0.000012]}
+
+
+class FakeBot:
+    """代替 ChatGPT，记录写入日志的消息；内容为 "fail" 的请求失败。"""
+
+    instances = []
+
+    def __init__(self, model=None):
+        self.model = model or CONFIG["model"]
+        self.messages = []
+        self.logged = []
+        self.last_error = None
+        self.log_file_name = f"chat_{len(self.instances)}.md"
+        self.closed = False
+        self.instances.append(self)
+
+    def append_to_log(self, token_usage=None, new_message=None, model=None):
+        self.logged.append(new_message)
+
+    async def achat(self, client, prompt, on_delta=None, use_cache=True):
+        if prompt == "fail":
+            self.last_error = "Error code: 400 - bad request"
+            return None, None
+        return prompt.upper(), {"prompt_tokens": 3, "cached_tokens": 0, "completion_tokens": 2, "total_tokens": 5}
+
+    def close_log(self):
+        self.closed = True
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.directory.name, "prompts.jsonl")
+        self.output_path = os.path.join(self.directory.name, "prompts.results.jsonl")
+        FakeBot.instances = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_input(self, *lines):
+        with open(self.input_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def read_results(self):
+        with open(self.output_path, "r", encoding="utf-8") as f:
+            return {result["id"]: result for result in map(json.loads, f)}
+
+    def run_batch(self):
+        async def close():
+            pass
+        with mock.patch.object(batch, "ChatGPT", FakeBot), \
+                mock.patch.object(batch, "get_async_client", return_value=None), \
+                mock.patch.object(batch, "close_async_client", close):
+            asyncio.run(BatchRunner(CONFIG, self.input_path, self.output_path, 2).run())
+
+    def test_item_messages(self):
+        self.assertEqual(item_messages({"prompt": "hi", "system": "be brief"}), [
+            {"role": "system", "content": "be brief"}, {"role": "user", "content": "hi"}
+        ])
+        with self.assertRaises(ValueError):
+            item_messages({"id": "x"})
+        with self.assertRaises(ValueError):
+            item_messages({"messages": [{"content": "no role"}]})
+
+    def test_malformed_lines_become_errors(self):
+        self.write_input('{"id": "a", "prompt": "one"}', '{"id": "b", "prompt": ', '"two"', '[1, 2]',
+                         '{"id": "c"}')
+        items = list(read_batch_items(self.input_path))
+        self.assertEqual([(item_id, error is None) for item_id, _, error in items],
+                         [("a", True), ("2", False), ("3", True), ("4", False), ("c", False)])
+        self.assertTrue(items[1][2].startswith("Line 2:"))
+
+    def test_run_records_errors_and_logs_every_message(self):
+        self.write_input(
+            '{"id": "a", "prompt": "one", "system": "be brief"}',
+            'not json',
+            '{"id": "b", "messages": [{"role": "user", "content": "q"}, {"role": "assistant", "content": "r"}, '
+            '{"role": "user", "content": "two"}]}',
+            '{"id": "c", "prompt": "fail"}',
+        )
+        self.run_batch()
+        results = self.read_results()
+        self.assertEqual(results["a"]["content"], "ONE")
+        self.assertEqual(results["b"]["status"], "ok")
+        self.assertEqual(results["2"]["status"], "error")
+        self.assertIn("Line 2", results["2"]["error"])
+        self.assertEqual(results["c"]["error"], "Error code: 400 - bad request")
+        logged = {bot.log_file_name: bot.logged for bot in FakeBot.instances}
+        self.assertEqual(logged[results["a"]["log_file"]], [{"role": "system", "content": "be brief"}])
+        self.assertEqual([m["role"] for m in logged[results["b"]["log_file"]]], ["user", "assistant"])
+        self.assertTrue(all(bot.closed for bot in FakeBot.instances))
+        self.assertEqual(load_completed_ids(self.output_path), {"a", "b"})
+
+    def test_rerun_skips_completed(self):
+        self.write_input('{"id": "a", "prompt": "one"}', '{"id": "c", "prompt": "fail"}')
+        self.run_batch()
+        FakeBot.instances = []
+        self.run_batch()
+        self.assertEqual(len(FakeBot.instances), 1)
+
+    def test_completed_ids_skip_lines_without_id(self):
+        with open(self.output_path, "w", encoding="utf-8") as f:
+            f.write('{"id": "a", "status": "ok"}\n{"status": "ok"}\n[1]\n{"id": "b", "status": "error"}\n{"id":')
+        self.assertEqual(load_completed_ids(self.output_path), {"a"})
+
+    def test_batch_api_file_skips_malformed_lines(self):
+        self.write_input('{"id": "a", "prompt": "one"}', '{oops')
+        api_path = os.path.join(self.directory.name, "api.jsonl")
+        self.assertEqual(write_batch_api_file(self.input_path, api_path, "o1-mini"), 1)
+        with open(api_path, "r", encoding="utf-8") as f:
+            request = json.loads(f.readline())
+        self.assertEqual(request["custom_id"], "a")
+        self.assertEqual(request["body"]["messages"], [{"role": "user", "content": "one"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from chatgpt import ChatGPT
+from utils import get_application_path
+
+
+def content_chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+
+def usage_chunk(prompt_tokens, completion_tokens):
+    usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                            total_tokens=prompt_tokens + completion_tokens, prompt_tokens_details=None)
+    return SimpleNamespace(choices=[], usage=usage)
+
+
+class FakeStream:
+    """按顺序产生 chunk 的流式响应替身，before_chunk 在产生每个 chunk 前调用。"""
+
+    def __init__(self, chunks, before_chunk=None):
+        self.chunks = chunks
+        self.before_chunk = before_chunk
+        self.closed = False
+
+    def __iter__(self):
+        for index, chunk in enumerate(self.chunks):
+            if self.before_chunk:
+                self.before_chunk(index)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class ChatGPTStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(get_application_path(), "config.json"), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        config.update(output_directory=self.directory.name, stream=True, search_index=False)
+        self.config_file = os.path.join(self.directory.name, "config.json")
+        with open(self.config_file, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+        self.client = mock.Mock()
+        patcher = mock.patch.object(ChatGPT, "client", new_callable=mock.PropertyMock, return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bot = ChatGPT(self.config_file)
+
+    def tearDown(self):
+        self.bot.close_log_writer()
+        self.directory.cleanup()
+
+    def read_log(self):
+        self.bot.close_log()
+        with open(self.bot.log_file_name, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def test_stream_assembles_content_and_usage(self):
+        self.client.chat.completions.create.return_value = FakeStream(
+            [content_chunk("Hello"), content_chunk(None), content_chunk(", world"), usage_chunk(12, 3)])
+        deltas = []
+        content, token_usage = self.bot.chat("hi", on_delta=deltas.append)
+        self.assertEqual(content, "Hello, world")
+        self.assertEqual(deltas, ["Hello", ", world"])
+        self.assertEqual(token_usage, {"prompt_tokens": 12, "cached_tokens": 0, "completion_tokens": 3,
+                                       "total_tokens": 15})
+        self.assertTrue(self.client.chat.completions.create.call_args.kwargs["stream"])
+        self.assertEqual(self.bot.messages, [{"role": "user", "content": "hi"},
+                                             {"role": "assistant", "content": "Hello, world"}])
+        self.assertIsNotNone(self.bot.last_ttft)
+        self.assertIn("## User\nhi\n\n## Assistant\nHello, world\n\n", self.read_log())
+
+
+    def test_cancel_during_stream_rolls_back_the_turn(self):
+        self.client.chat.completions.create.return_value = FakeStream(
+            [content_chunk("first answer"), usage_chunk(5, 2)])
+        self.assertEqual(self.bot.chat("first")[0], "first answer")
+
+        def before_chunk(index):
+            # 收到一部分内容后，另一个线程（例如 Ctrl-C）取消这一轮
+            if index == 1:
+                self.assertTrue(self.bot.cancel())
+
+        stream = FakeStream([content_chunk("partial"), content_chunk(" more"), usage_chunk(8, 2)], before_chunk)
+        self.client.chat.completions.create.return_value = stream
+        self.assertEqual(self.bot.chat("second"), (None, None))
+        self.assertTrue(stream.closed)
+        self.assertEqual([m["content"] for m in self.bot.messages], ["first", "first answer"])
+        self.assertFalse(self.bot.cancel())
+        log = self.read_log()
+        self.assertIn("first answer", log)
+        self.assertNotIn("second", log)
+        self.assertNotIn("partial", log)
+
+
+if __name__ == "__main__":
+    unittest.main()
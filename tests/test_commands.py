@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from log_archive import MANIFEST_FILE, archive_directory
+from metrics import SessionMetrics
+
+try:
+    import commands
+except ImportError:
+    commands = None
+
+
+@unittest.skipIf(commands is None, "the commands require rich")
+class PrintStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bot = mock.Mock(config={"output_directory": self.directory.name},
+                             log_file_name=os.path.join(self.directory.name, "chat_1.md"))
+        self.bot.metrics = SessionMetrics()
+        self.bot.metrics.observe("request_latency_seconds", "o1-mini", 1.5)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_openmetrics_file(self):
+        path = os.path.join(self.directory.name, "metrics.txt")
+        with mock.patch("builtins.print") as output:
+            commands.print_stats(self.bot, f"--stats openmetrics {path}")
+        output.assert_called_once_with(f"Metrics written to {path}")
+        with open(path, "r", encoding="utf-8") as f:
+            self.assertIn("request_latency_seconds", f.read())
+
+    def test_openmetrics_write_error_is_reported(self):
+        path = os.path.join(self.directory.name, "missing", "metrics.txt")
+        with mock.patch("builtins.print") as output:
+            commands.print_stats(self.bot, f"--stats openmetrics {path}")
+        self.assertTrue(output.call_args.args[0].startswith("Failed to write metrics: "))
+
+
+@unittest.skipIf(commands is None, "the commands require rich")
+class PrintLogFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        log_directory = os.path.join(self.directory.name, "chat_logs")
+        os.makedirs(archive_directory(log_directory))
+        with open(os.path.join(log_directory, "chat_2.md"), "w", encoding="utf-8") as f:
+            f.write("## User\nhi\n\n")
+        with open(os.path.join(archive_directory(log_directory), MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump({"logs": {"chat_1.md": {}}}, f)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_logs_are_listed_from_the_application_directory(self):
+        # 当前目录不是程序目录时，相对的 output_directory 仍按程序目录解析
+        with mock.patch("utils.get_application_path", return_value=self.directory.name), \
+                mock.patch("builtins.print") as output:
+            commands.print_log_files({"output_directory": "chat_logs"})
+        output.assert_called_once_with("chat_2.md\nchat_1.md (archived)")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from context_window import MESSAGE_OVERHEAD_TOKENS, ContextWindow, estimate_tokens
+
+
+def turns(count, size=100):
+    messages = [{"role": "system", "content": "You are helpful."}]
+    for i in range(count):
+        messages.append({"role": "user", "content": f"question {i} " + "x" * size})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "y" * size})
+    return messages
+
+
+class ContextWindowTest(unittest.TestCase):
+    def window(self, budget, trim_ratio=0.75):
+        window = ContextWindow("o1-preview", budget, trim_ratio)
+        # 使用估算，结果不依赖是否安装了 tiktoken
+        window.count_text = estimate_tokens
+        return window
+
+    def test_no_budget_sends_everything(self):
+        window = self.window(None)
+        messages = turns(5)
+        self.assertEqual(window.select(messages), messages)
+        self.assertEqual(window.last_stats["trimmed"], 0)
+
+    def test_count_is_cached(self):
+        window = self.window(None)
+        message = {"role": "user", "content": "abcd" * 10}
+        self.assertEqual(window.count(message), 10 + MESSAGE_OVERHEAD_TOKENS)
+        window.count_text = None
+        self.assertEqual(window.count(dict(message)), 10 + MESSAGE_OVERHEAD_TOKENS)
+
+    def test_trims_oldest_turns_to_low_water_mark(self):
+        window = self.window(500)
+        messages = turns(10)
+        selected = window.select(messages)
+        self.assertEqual(selected[0]["role"], "system")
+        self.assertEqual(selected[1]["role"], "user")
+        self.assertEqual(selected[-1], messages[-1])
+        self.assertLessEqual(window.last_stats["tokens"], 500 * 0.75)
+        self.assertEqual(window.last_stats["messages"], len(selected))
+        self.assertEqual(window.last_stats["trimmed"], len(messages) - len(selected))
+
+    def test_prefix_stays_stable_until_next_trim(self):
+        window = self.window(500)
+        messages = turns(10)
+        first = window.select(messages)
+        messages += [{"role": "user", "content": "next"}]
+        second = window.select(messages)
+        self.assertEqual(second[:len(first)], first)
+
+    def test_latest_message_is_always_sent(self):
+        window = self.window(10)
+        messages = [{"role": "user", "content": "z" * 1000}]
+        self.assertEqual(window.select(messages), messages)
+
+    def test_tokenizer_loads_on_first_count(self):
+        window = ContextWindow("o1-preview", None)
+        self.assertFalse(window.tokenizer_loaded)
+        self.assertGreater(window.count_text("hello world"), 0)
+        self.assertTrue(window.tokenizer_loaded)
+
+    def test_describe(self):
+        window = self.window(500)
+        self.assertEqual(window.describe(), "")
+        window.select(turns(10))
+        self.assertIn("trimmed", window.describe())
+
+
+if __name__ == "__main__":
+    unittest.main()
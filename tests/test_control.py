@@ -0,0 +1,66 @@
+import asyncio
+import os
+import unittest
+from control import ControlServer, other_process_addresses, send_command
+
+
+class ControlServerTest(unittest.TestCase):
+    def setUp(self):
+        self.closed = []
+        self.server = ControlServer({
+            "ping": lambda _: "pong",
+            "close": lambda request: self.closed.append(request.get("reason")),
+            "fail": lambda _: 1 / 0,
+        })
+
+    def test_commands_reach_handlers(self):
+        address = self.server.start()
+        try:
+            self.assertEqual(send_command(address, "ping"), {"ok": True, "result": "pong"})
+            self.assertEqual(send_command(address, "close", reason="all"), {"ok": True, "result": None})
+            self.assertEqual(self.closed, ["all"])
+            self.assertEqual(send_command(address, "exit")["error"], "unknown command: exit")
+            self.assertFalse(send_command(address, "fail")["ok"])
+        finally:
+            self.server.close()
+        # 关闭后连接失败返回 None，不抛出异常
+        self.assertIsNone(send_command(address, "ping", timeout=0.5))
+        if self.server.socket_path:
+            self.assertFalse(os.path.exists(self.server.socket_path))
+
+    def test_invalid_token_is_rejected(self):
+        address = self.server.start()
+        try:
+            forged = address.partition("#")[0] + "#" + "0" * 32
+            self.assertEqual(send_command(forged, "close"), {"ok": False, "error": "invalid token"})
+            self.assertEqual(self.closed, [])
+        finally:
+            self.server.close()
+
+    def test_async_server(self):
+        async def run():
+            address = await self.server.start_async()
+            try:
+                return await asyncio.to_thread(send_command, address, "ping")
+            finally:
+                self.server.close()
+
+        self.assertEqual(asyncio.run(run()), {"ok": True, "result": "pong"})
+
+    def test_no_address(self):
+        self.assertIsNone(send_command(None, "ping"))
+
+
+class OtherProcessAddressesTest(unittest.TestCase):
+    def test_skips_own_process_and_duplicates(self):
+        sessions = [
+            {"pid": os.getpid(), "address": "unix:/tmp/own.sock#a"},
+            {"pid": 1, "address": "unix:/tmp/other.sock#b"},
+            {"pid": 1, "address": "unix:/tmp/other.sock#b"},
+            {"pid": 2, "address": None},
+        ]
+        self.assertEqual(other_process_addresses(sessions), ["unix:/tmp/other.sock#b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
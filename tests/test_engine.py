@@ -0,0 +1,128 @@
+import asyncio
+import unittest
+from unittest import mock
+
+try:
+    import engine
+except ImportError:
+    engine = None
+
+
+def fake_bot(name):
+    bot = mock.Mock(log_file_name=name)
+    bot.remove_empty_log.return_value = False
+    return bot
+
+
+@unittest.skipIf(engine is None, "the engine requires rich")
+class SessionEngineTest(unittest.TestCase):
+    def setUp(self):
+        for name in ("get_async_client", "ControlServer", "get_renderer", "add_session_to_file",
+                     "remove_session_from_file", "start_search_index_refresh"):
+            patcher = mock.patch(f"engine.{name}")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("engine.close_async_client", new_callable=mock.AsyncMock)
+        self.close_async_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_engine(self, prompts, handle_commands):
+        """按顺序读入 prompts（读完后相当于 EOF），返回引擎和第一个会话的 bot。"""
+        lines = list(prompts)
+
+        async def read_prompt():
+            await asyncio.sleep(0)
+            if not lines:
+                raise EOFError()
+            return lines.pop(0)
+
+        async def start():
+            session_engine = engine.SessionEngine({})
+            session_engine.control.start_async = mock.AsyncMock(return_value="127.0.0.1:1")
+            session_engine.read_prompt = read_prompt
+            session_engine.handle_commands = handle_commands
+            bot = fake_bot("chat_1.md")
+            session_engine.open_session(bot)
+            await session_engine.run()
+            return session_engine, bot
+
+        with mock.patch("builtins.print"):
+            return asyncio.run(start())
+
+    def test_failed_command_does_not_end_the_session(self):
+        handled = []
+
+        async def handle_commands(prompt):
+            handled.append(prompt)
+            if prompt == "--stats openmetrics /nonexistent/x":
+                raise OSError("No such file or directory")
+            return True
+
+        session_engine, bot = self.run_engine(["--stats openmetrics /nonexistent/x", "--cu"], handle_commands)
+        self.assertEqual(handled, ["--stats openmetrics /nonexistent/x", "--cu"])
+        # 退出时照常关闭会话和异步客户端
+        bot.close_log.assert_called_once()
+        self.assertEqual(session_engine.sessions, [])
+        self.close_async_client.assert_awaited_once()
+
+    def test_prompts_are_answered_in_order(self):
+        answered = []
+
+        async def achat(client, prompt, use_cache=True):
+            answered.append(prompt)
+            return f"re: {prompt}", {"prompt_tokens": 2, "completion_tokens": 1}
+
+        async def start():
+            session_engine = engine.SessionEngine({})
+            bot = fake_bot("chat_1.md")
+            bot.achat = achat
+            session = session_engine.open_session(bot)
+            session_engine.deliver = mock.Mock()
+            await session.submit("first")
+            await session.submit("--fresh second")
+            while session_engine.deliver.call_count < 2:
+                await asyncio.sleep(0.01)
+            await session.close()
+            return session_engine, session
+
+        with mock.patch("builtins.print"):
+            session_engine, session = asyncio.run(start())
+        self.assertEqual(answered, ["first", "second"])
+        self.assertEqual([c.args[1] for c in session_engine.deliver.call_args_list], ["re: first", "re: second"])
+        self.assertEqual(session.total_token_usage["prompt_tokens"], 4)
+
+
+    def test_cancel_all_drops_queued_prompts(self):
+        started = []
+
+        async def achat(client, prompt, use_cache=True):
+            started.append(prompt)
+            await asyncio.sleep(5)
+
+        async def start():
+            session_engine = engine.SessionEngine({})
+            bot = fake_bot("chat_1.md")
+            bot.achat = achat
+            session = session_engine.open_session(bot)
+            session_engine.deliver_notice = mock.Mock()
+            for prompt in ("first", "second", "third"):
+                await session.submit(prompt)
+            while not started:
+                await asyncio.sleep(0.01)
+            result = session.cancel(drain=True)
+            while session.busy:
+                await asyncio.sleep(0.01)
+            idle = session.cancel()
+            await session.close()
+            return session_engine, result, idle
+
+        with mock.patch("builtins.print"):
+            session_engine, result, idle = asyncio.run(start())
+        self.assertEqual(result, (True, 2))
+        self.assertEqual(idle, (False, 0))
+        self.assertEqual(started, ["first"])
+        session_engine.deliver_notice.assert_called_once_with(mock.ANY, "Request cancelled.")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import asyncio
+import tempfile
+import threading
+import unittest
+from hedging import AttemptCancel, HedgePolicy, arun_hedged, get_hedging_options, run_hedged
+from metrics import SessionMetrics
+
+
+class APIError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class HedgePolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def policy(self, **options):
+        return HedgePolicy(get_hedging_options({"hedging": dict({"enabled": True}, **options)}), self.directory.name)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(get_hedging_options({}))
+
+    def test_deadline_until_enough_samples(self):
+        policy = self.policy(deadline=30, min_samples=5, min_delay=0.5)
+        metrics = SessionMetrics()
+        self.assertEqual(policy.delay(metrics, "o1-mini", stream=False), 30)
+        for _ in range(5):
+            metrics.observe("request_latency_seconds", "o1-mini", 4.0)
+        self.assertAlmostEqual(policy.delay(metrics, "o1-mini", stream=False), 4.0)
+        # 流式请求按首 token 延迟判断，还没有样本
+        self.assertEqual(policy.delay(metrics, "o1-mini", stream=True), 30)
+
+    def test_no_deadline_and_min_delay(self):
+        metrics = SessionMetrics()
+        self.assertIsNone(self.policy(deadline=None).delay(metrics, "o1-mini", stream=False))
+        for _ in range(20):
+            metrics.observe("request_latency_seconds", "o1-mini", 0.01)
+        self.assertEqual(self.policy(min_delay=2.0).delay(metrics, "o1-mini", stream=False), 2.0)
+
+    def test_fallback_model(self):
+        self.assertEqual(self.policy().hedge_model("o1"), "o1")
+        self.assertEqual(self.policy(fallback_model="o1-mini").hedge_model("o1"), "o1-mini")
+
+
+class AttemptCancelTest(unittest.TestCase):
+    def test_callbacks_run_once(self):
+        cancel = AttemptCancel()
+        calls = []
+        cancel.on_cancel(lambda: calls.append("before"))
+        cancel.set()
+        cancel.set()
+        cancel.on_cancel(lambda: calls.append("after"))
+        self.assertTrue(cancel.is_set())
+        self.assertEqual(calls, ["before", "after"])
+
+
+class RunHedgedTest(unittest.TestCase):
+    def test_fast_primary_wins_without_hedge(self):
+        hedges = []
+        index, result = run_hedged(lambda model, cancel: model, ("a", "b"), 5, None, lambda: hedges.append(1))
+        self.assertEqual((index, result, hedges), (0, "a", []))
+
+    def test_slow_primary_is_cancelled_and_discarded(self):
+        release = threading.Event()
+        discarded = threading.Event()
+        cancels = {}
+
+        def open_attempt(model, cancel):
+            cancels[model] = cancel
+            if model == "a":
+                # 模拟一个被胜出请求关闭的流式响应
+                cancel.on_cancel(release.set)
+                release.wait(5)
+            return model
+
+        def discard(model, result):
+            self.assertEqual((model, result), ("a", "a"))
+            discarded.set()
+
+        index, result = run_hedged(open_attempt, ("a", "b"), 0.05, discard)
+        self.assertEqual((index, result), (1, "b"))
+        self.assertTrue(discarded.wait(5))
+        self.assertTrue(cancels["a"].is_set())
+        self.assertFalse(cancels["b"].is_set())
+
+    def test_non_retryable_primary_error_is_raised_without_hedge(self):
+        models = []
+
+        def open_attempt(model, cancel):
+            models.append(model)
+            raise APIError(400)
+
+        with self.assertRaises(APIError):
+            run_hedged(open_attempt, ("a", "b"), 5, None)
+        self.assertEqual(models, ["a"])
+
+    def test_retryable_primary_error_starts_hedge(self):
+        def open_attempt(model, cancel):
+            if model == "a":
+                raise APIError(503)
+            return model
+
+        self.assertEqual(run_hedged(open_attempt, ("a", "b"), 5, None), (1, "b"))
+
+    def test_both_failing_raise_primary_error(self):
+        def open_attempt(model, cancel):
+            raise APIError(503 if model == "a" else 500)
+
+        with self.assertRaises(APIError) as context:
+            run_hedged(open_attempt, ("a", "b"), 5, None)
+        self.assertEqual(context.exception.status_code, 503)
+
+
+class AsyncRunHedgedTest(unittest.TestCase):
+    def test_slow_primary_is_cancelled(self):
+        discarded = []
+
+        async def open_attempt(model):
+            if model == "a":
+                await asyncio.sleep(5)
+            return model
+
+        result = asyncio.run(arun_hedged(open_attempt, ("a", "b"), 0.05, lambda *args: discarded.append(args)))
+        self.assertEqual(result, (1, "b"))
+        self.assertEqual(discarded, [("a", None)])
+
+    def test_non_retryable_primary_error_is_raised_without_hedge(self):
+        models = []
+
+        async def open_attempt(model):
+            models.append(model)
+            raise APIError(401)
+
+        with self.assertRaises(APIError):
+            asyncio.run(arun_hedged(open_attempt, ("a", "b"), 5, None))
+        self.assertEqual(models, ["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+from unittest import mock
+from key_pool import ApiKey, KeyPool, current_api_key, mask_key
+from scheduler import RequestScheduler
+
+
+class HTTPError(Exception):
+    """与 openai.APIStatusError 相同的 status_code、code 和 response.headers。"""
+
+    def __init__(self, status_code, headers=None, code=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.code = code
+        self.response = mock.Mock(headers=headers or {})
+
+
+def pool(*keys, **limits):
+    return KeyPool([ApiKey(key, name, **limits) for key, name in keys])
+
+
+class KeyPoolTest(unittest.TestCase):
+    def test_from_config(self):
+        single = KeyPool.from_config({"api_key": "sk-single-key-0001"})
+        self.assertEqual([k.key for k in single.keys], ["sk-single-key-0001"])
+        configured = KeyPool.from_config({"api_key": "sk-unused", "api_keys": [
+            {"key": "sk-first", "name": "first", "requests_per_minute": 60},
+            {"key": "sk-second", "tokens_per_minute": 1000},
+        ]})
+        self.assertEqual([k.name for k in configured.keys], ["first", "***"])
+        self.assertIsNotNone(configured.keys[0].request_bucket)
+        self.assertIsNotNone(configured.keys[1].token_bucket)
+
+    def test_mask_key(self):
+        self.assertEqual(mask_key("sk-abcdefghijklmnop"), "sk-...mnop")
+        self.assertEqual(mask_key("short"), "***")
+
+    def test_acquire_spreads_requests(self):
+        keys = pool(("sk-a", "a"), ("sk-b", "b"))
+        first, _ = keys.acquire()
+        second, _ = keys.acquire()
+        self.assertNotEqual(first, second)
+        keys.release(first, True)
+        keys.release(second, False)
+        stats = {item["name"]: item for item in keys.stats()}
+        self.assertEqual((stats["a"]["requests"], stats["b"]["requests"]), (1, 0))
+        self.assertEqual(stats["a"]["in_flight"] + stats["b"]["in_flight"], 0)
+
+    def test_prefers_key_with_quota(self):
+        keys = pool(("sk-a", "a"), ("sk-b", "b"), requests_per_minute=1)
+        first, wait = keys.acquire()
+        keys.release(first, True)
+        second, wait = keys.acquire()
+        self.assertNotEqual(first, second)
+        self.assertEqual(wait, 0.0)
+
+    def test_rate_limited_key_cools_down(self):
+        keys = pool(("sk-a", "a"), ("sk-b", "b"))
+        a = keys.keys[0]
+        self.assertTrue(keys.report_error(a, HTTPError(429), retry_after=60))
+        self.assertTrue(a.status().startswith("rate limited"))
+        for _ in range(3):
+            api_key, _ = keys.acquire()
+            self.assertEqual(api_key.name, "b")
+            keys.release(api_key, True)
+        # 其他错误不影响 key 的状态，也不换 key
+        self.assertFalse(keys.report_error(keys.keys[1], HTTPError(500)))
+
+    def test_auth_failure_disables_key(self):
+        keys = pool(("sk-a", "a"))
+        a = keys.keys[0]
+        self.assertFalse(keys.report_error(a, HTTPError(401)))
+        self.assertEqual(a.status(), "disabled (HTTP 401)")
+        with self.assertRaises(RuntimeError):
+            keys.acquire()
+        keys.add("sk-a")
+        self.assertEqual(a.status(), "ok")
+        self.assertEqual(len(keys.keys), 1)
+
+    def test_insufficient_quota_disables_key(self):
+        keys = pool(("sk-a", "a"))
+        keys.report_error(keys.keys[0], HTTPError(429, code="insufficient_quota"))
+        self.assertEqual(keys.keys[0].disabled, "insufficient quota")
+
+    def test_settle_and_refund(self):
+        keys = pool(("sk-a", "a"), tokens_per_minute=1000)
+        a, _ = keys.acquire(400)
+        keys.refund(a, 400)
+        self.assertAlmostEqual(a.token_bucket.tokens, 1000, delta=5)
+        a, _ = keys.acquire(400)
+        keys.settle(a, 400, 100)
+        self.assertAlmostEqual(a.token_bucket.tokens, 900, delta=5)
+        self.assertEqual(keys.stats()[0]["tokens"], 100)
+
+
+class SchedulerKeyPoolTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("scheduler.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rate_limited_key_is_swapped_immediately(self):
+        keys = pool(("sk-a", "a"), ("sk-b", "b"))
+        scheduler = RequestScheduler(max_retries=0, key_pool=keys)
+        used = []
+
+        def call():
+            api_key = current_api_key.get()
+            used.append(api_key.name)
+            if len(used) == 1:
+                raise HTTPError(429, {"retry-after": "60"})
+            return api_key.name
+
+        result = scheduler.run(call, 10)
+        self.assertEqual(len(used), 2)
+        self.assertNotEqual(used[0], used[1])
+        self.assertEqual(result, used[1])
+        # 换 key 重试不等待退避
+        self.sleep.assert_not_called()
+        stats = {item["name"]: item for item in keys.stats()}
+        self.assertEqual(stats[used[0]]["rate_limited"], 1)
+        self.assertEqual(stats[used[1]]["requests"], 1)
+
+    def test_all_keys_disabled(self):
+        keys = pool(("sk-a", "a"))
+        scheduler = RequestScheduler(max_retries=3, key_pool=keys)
+
+        def call():
+            raise HTTPError(401)
+
+        with self.assertRaises(HTTPError):
+            scheduler.run(call)
+        with self.assertRaises(RuntimeError):
+            scheduler.run(call)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from log_archive import (archive_directory, archive_logs, load_manifest, manifest_lock, read_archived_messages,
+                         read_member, restore_log)
+from log_writer import format_log_header
+from session_records import read_records, write_records
+
+PRICING = [0.000015, 0.0000075, 0.00006]
+MESSAGES = [{"role": "user", "content": "old question"}, {"role": "assistant", "content": "old answer"}]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LogArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_log(self, name, age_days):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(format_log_header(datetime(2024, 1, 1), "o1-mini",
+                                      {"prompt_tokens": 100, "completion_tokens": 50}, PRICING))
+            f.write("## User\nold question\n\n## Assistant\nold answer\n\n")
+        write_records(path, MESSAGES)
+        mtime = time.time() - age_days * 86400
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_archive_and_read(self):
+        self.write_log("chat_old.md", 100)
+        self.write_log("chat_new.md", 1)
+        count, raw_bytes, archived_bytes = archive_logs(self.directory.name, 90)
+        self.assertEqual(count, 1)
+        self.assertGreater(raw_bytes, 0)
+        self.assertGreater(archived_bytes, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "chat_old.md")))
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, "chat_new.md")))
+        entry = load_manifest(self.directory.name)["chat_old.md"]
+        self.assertEqual((entry["model"], entry["input_tokens"], entry["output_tokens"]), ("o1-mini", 100, 50))
+        self.assertEqual(read_archived_messages(self.directory.name, entry), MESSAGES)
+        self.assertEqual(read_archived_messages(self.directory.name, entry, 1), MESSAGES[1:])
+        self.assertIn(b"old answer", read_member(self.directory.name, entry, "md"))
+        self.assertIsNone(read_member(self.directory.name, entry, "metrics"))
+
+    def test_excluded_logs_are_kept(self):
+        path = self.write_log("chat_open.md", 100)
+        self.assertEqual(archive_logs(self.directory.name, 90, exclude=[path]), (0, 0, 0))
+        self.assertTrue(os.path.exists(path))
+
+    def test_repeated_archives_keep_earlier_segments(self):
+        self.write_log("chat_1.md", 100)
+        archive_logs(self.directory.name, 90)
+        self.write_log("chat_2.md", 100)
+        archive_logs(self.directory.name, 90)
+        manifest = load_manifest(self.directory.name)
+        self.assertNotEqual(manifest["chat_1.md"]["segment"], manifest["chat_2.md"]["segment"])
+        for entry in manifest.values():
+            self.assertEqual(read_archived_messages(self.directory.name, entry), MESSAGES)
+
+    def test_restore(self):
+        path = self.write_log("chat_old.md", 100)
+        archive_logs(self.directory.name, 90)
+        self.assertTrue(restore_log(self.directory.name, "chat_old.md"))
+        self.assertEqual(read_records(path), MESSAGES)
+        self.assertNotIn("chat_old.md", load_manifest(self.directory.name))
+        self.assertFalse(restore_log(self.directory.name, "chat_old.md"))
+
+    def test_restore_without_archive_does_not_create_it(self):
+        self.assertFalse(restore_log(self.directory.name, "chat_missing.md"))
+        self.assertFalse(os.path.exists(archive_directory(self.directory.name)))
+
+    def test_manifest_lock_is_held_across_processes(self):
+        code = ("import sys; from log_archive import manifest_lock\n"
+                "with manifest_lock(sys.argv[1]): print('locked', flush=True)\n")
+        with manifest_lock(self.directory.name):
+            process = subprocess.Popen([sys.executable, "-c", code, self.directory.name], cwd=ROOT,
+                                       stdout=subprocess.PIPE, text=True)
+            time.sleep(0.5)
+            self.assertIsNone(process.poll())
+        output, _ = process.communicate(timeout=10)
+        self.assertEqual(output.strip(), "locked")
+
+
+if __name__ == "__main__":
+    unittest.main()
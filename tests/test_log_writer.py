@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from log_writer import ChatLogWriter, claim_log_file_name, format_log_header
+from session_records import parse_markdown_log, read_records
+from usage_ledger import parse_log_header
+
+PRICING = [0.000015, 0.0000075, 0.00006]
+START = datetime(2024, 12, 4, 23, 35, 43)
+
+
+class LogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "chat_20241204_233543.md")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def writer(self, **options):
+        return ChatLogWriter(self.path, START, "o1-preview", PRICING, **options)
+
+    def read(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def test_header_has_fixed_length(self):
+        small = format_log_header(START, "o1", {"prompt_tokens": 1, "completion_tokens": 2}, PRICING)
+        large = format_log_header(START, "o1", {"prompt_tokens": 123456789, "cached_tokens": 5000,
+                                                "completion_tokens": 98765432}, PRICING)
+        self.assertEqual(len(small), len(large))
+
+    def test_usage_is_updated_in_place(self):
+        writer = self.writer()
+        writer.append("## User\nhello\n\n")
+        writer.update_usage({"prompt_tokens": 10, "cached_tokens": 0, "completion_tokens": 5})
+        writer.flush()
+        size = os.path.getsize(self.path)
+        writer.update_usage({"prompt_tokens": 123456, "cached_tokens": 1024, "completion_tokens": 54321})
+        writer.close()
+        self.assertEqual(os.path.getsize(self.path), size)
+        with open(self.path, "rb") as f:
+            header = parse_log_header(f.read())
+        self.assertEqual((header["input_tokens"], header["cached_tokens"], header["output_tokens"]),
+                         (123456, 1024, 54321))
+        self.assertEqual(parse_markdown_log(self.path), [{"role": "user", "content": "hello"}])
+
+    def test_oversized_usage_rewrites_the_header(self):
+        writer = self.writer()
+        writer.append("## User\nhello\n\n")
+        writer.update_usage({"prompt_tokens": 10 ** 15, "cached_tokens": 0, "completion_tokens": 1})
+        writer.close()
+        with open(self.path, "rb") as f:
+            self.assertEqual(parse_log_header(f.read())["input_tokens"], 10 ** 15)
+        self.assertEqual(parse_markdown_log(self.path), [{"role": "user", "content": "hello"}])
+
+    def test_rollback_truncates_to_checkpoint(self):
+        writer = self.writer()
+        writer.append("## User\nfirst\n\n")
+        writer.checkpoint()
+        writer.append("## User\nsecond\n\n## Assistant\npartial")
+        # 头部变化不影响检查点在正文中的位置
+        writer.update_usage({"prompt_tokens": 10 ** 15, "cached_tokens": 0, "completion_tokens": 1})
+        writer.rollback()
+        writer.append("## Assistant\nanswer\n\n")
+        writer.close()
+        self.assertEqual(parse_markdown_log(self.path), [
+            {"role": "user", "content": "first"}, {"role": "assistant", "content": "answer"}
+        ])
+
+    def test_commit_clears_checkpoint(self):
+        writer = self.writer()
+        writer.checkpoint()
+        writer.append("## User\nkept\n\n")
+        writer.commit()
+        writer.rollback()
+        writer.close()
+        self.assertIn("kept", self.read())
+
+    def test_records_are_written_with_index(self):
+        seen = []
+        writer = self.writer(on_record=lambda message, seq: seen.append(seq))
+        writer.record({"role": "user", "content": "line 1\nline 2"})
+        writer.record({"role": "assistant", "content": "ok"}, model="o1-mini")
+        writer.close()
+        self.assertEqual(read_records(self.path, 1), [{"role": "assistant", "content": "ok"}])
+        self.assertEqual(read_records(self.path)[0]["content"], "line 1\nline 2")
+        self.assertEqual(seen, [0, 1])
+
+    def test_empty_session_creates_no_file(self):
+        self.writer().close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_write_errors_are_raised_on_flush(self):
+        self.path = os.path.join(self.directory.name, "missing", "chat.md")
+        writer = self.writer()
+        writer.append("## User\nhello\n\n")
+        with self.assertRaises(OSError):
+            writer.flush()
+        # 错误只报告一次，写入线程仍在运行
+        writer.flush()
+        writer.close()
+
+    def test_claimed_names_are_unique(self):
+        first = claim_log_file_name(self.directory.name, "chat_x")
+        second = claim_log_file_name(self.directory.name, "chat_x")
+        self.assertNotEqual(first, second)
+        self.assertTrue(second.endswith("chat_x_2.md"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+from metrics import (Histogram, SessionMetrics, geometric_bounds, load_all_metrics, load_metrics, metrics_path,
+                     save_metrics)
+
+
+class HistogramTest(unittest.TestCase):
+    def test_geometric_bounds(self):
+        bounds = geometric_bounds(1, 100, factor=2)
+        self.assertEqual(bounds, [1, 2, 4, 8, 16, 32, 64, 100])
+
+    def test_observe_and_overflow_bucket(self):
+        histogram = Histogram([1, 2, 4])
+        for value in (0.5, 1, 1.5, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual((histogram.minimum, histogram.maximum), (0.5, 10))
+        self.assertAlmostEqual(histogram.total, 16.0)
+
+    def test_percentile_within_relative_error(self):
+        histogram = Histogram(geometric_bounds(0.001, 600))
+        values = [i / 100 for i in range(1, 1001)]
+        for value in values:
+            histogram.observe(value)
+        for q in (50, 95, 99):
+            exact = values[int(q / 100 * len(values)) - 1]
+            self.assertLess(abs(histogram.percentile(q) - exact) / exact, 0.25)
+
+    def test_percentile_is_clamped_to_observed_range(self):
+        histogram = Histogram([1, 10, 100])
+        histogram.observe(5)
+        self.assertEqual(histogram.percentile(1), 5)
+        self.assertEqual(histogram.percentile(100), 5)
+        self.assertIsNone(Histogram([1]).percentile(50))
+
+    def test_merge_and_round_trip(self):
+        first, second = Histogram([1, 2]), Histogram([1, 2])
+        first.observe(0.5)
+        second.observe(5)
+        first.merge(second)
+        self.assertEqual(first.counts, [1, 0, 1])
+        self.assertEqual((first.minimum, first.maximum), (0.5, 5))
+        copy = Histogram.from_dict(first.to_dict())
+        self.assertEqual((copy.counts, copy.total, copy.minimum, copy.maximum),
+                         (first.counts, first.total, first.minimum, first.maximum))
+
+
+class SessionMetricsTest(unittest.TestCase):
+    def test_observe_ignores_none(self):
+        metrics = SessionMetrics()
+        metrics.observe("request_latency_seconds", "o1-mini", None)
+        self.assertFalse(metrics.has_samples())
+        metrics.increment("requests", "o1-mini")
+        self.assertTrue(metrics.has_samples())
+
+    def test_merge(self):
+        first, second = SessionMetrics(), SessionMetrics()
+        first.observe("request_latency_seconds", "o1-mini", 1.0)
+        second.observe("request_latency_seconds", "o1-mini", 2.0)
+        second.observe("render_seconds", "o1-mini", 0.01)
+        first.increment("requests", "o1-mini")
+        second.increment("requests", "o1-mini", 2)
+        first.merge(second)
+        self.assertEqual(first.histograms[("request_latency_seconds", "o1-mini")].count, 2)
+        self.assertEqual(first.histograms[("render_seconds", "o1-mini")].count, 1)
+        self.assertEqual(first.counters[("requests", "o1-mini")], 3)
+
+    def test_from_dict_skips_unknown_histograms(self):
+        metrics = SessionMetrics()
+        metrics.observe("request_latency_seconds", "o1-mini", 1.0)
+        data = metrics.to_dict()
+        data["histograms"].append(dict(data["histograms"][0], name="removed_metric"))
+        loaded = SessionMetrics.from_dict(data)
+        self.assertEqual(list(loaded.histograms), [("request_latency_seconds", "o1-mini")])
+
+    def test_summary_rows(self):
+        metrics = SessionMetrics()
+        for value in (1.0, 2.0, 3.0):
+            metrics.observe("request_latency_seconds", "o1-mini", value)
+        [(model, name, count, values)] = metrics.summary_rows()
+        self.assertEqual((model, name, count), ("o1-mini", "request_latency_seconds", 3))
+        self.assertTrue(all(1.0 <= value <= 3.0 for value in values))
+
+    def test_openmetrics(self):
+        metrics = SessionMetrics()
+        metrics.observe("request_latency_seconds", "o1-mini", 1.0)
+        metrics.increment("retries", "o1-mini")
+        text = metrics.to_openmetrics()
+        self.assertIn("# TYPE chatgpt_cli_request_latency_seconds histogram", text)
+        self.assertIn('chatgpt_cli_request_latency_seconds_bucket{model="o1-mini",le="+Inf"} 1', text)
+        self.assertIn('chatgpt_cli_request_latency_seconds_count{model="o1-mini"} 1', text)
+        self.assertIn('chatgpt_cli_retries_total{model="o1-mini"} 1', text)
+        self.assertTrue(text.endswith("# EOF\n"))
+
+
+class MetricsFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_metrics_path(self):
+        self.assertEqual(metrics_path(os.path.join("logs", "chat_1.md")), os.path.join("logs", "chat_1.metrics.json"))
+
+    def test_save_load_and_combine(self):
+        for name, value in (("chat_1.md", 1.0), ("chat_2.md", 2.0)):
+            metrics = SessionMetrics()
+            metrics.observe("request_latency_seconds", "o1-mini", value)
+            save_metrics(metrics, metrics_path(os.path.join(self.directory.name, name)))
+        loaded = load_metrics(metrics_path(os.path.join(self.directory.name, "chat_1.md")))
+        self.assertEqual(loaded.histograms[("request_latency_seconds", "o1-mini")].maximum, 1.0)
+        combined = load_all_metrics(self.directory.name)
+        histogram = combined.histograms[("request_latency_seconds", "o1-mini")]
+        self.assertEqual((histogram.count, histogram.minimum, histogram.maximum), (2, 1.0, 2.0))
+
+    def test_load_missing_or_corrupt(self):
+        path = os.path.join(self.directory.name, "chat_1.metrics.json")
+        self.assertIsNone(load_metrics(path))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("{")
+        self.assertIsNone(load_metrics(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from prompt_input import aread_prompt, get_input_options, has_open_fence, load_file_attachment, read_prompt
+
+
+def reader(lines):
+    """按顺序返回 lines 中的行；值为 None 的项表示这段时间内没有更多输入，读完后抛出 EOFError。"""
+    lines = list(lines)
+
+    def read_line(timeout):
+        while lines:
+            line = lines.pop(0)
+            if line is not None:
+                return line
+            if timeout is not None:
+                return None
+        raise EOFError()
+    return read_line
+
+
+def async_reader(lines):
+    read_line = reader(lines)
+
+    async def aread_line(timeout):
+        return read_line(timeout)
+    return aread_line
+
+
+class ReadPromptTest(unittest.TestCase):
+    def test_single_line(self):
+        self.assertEqual(read_prompt(reader(["hello", None, "next"]), 0.05), "hello")
+
+    def test_paste_burst_is_one_prompt(self):
+        self.assertEqual(read_prompt(reader(["line 1", "line 2", "line 3", None, "next"]), 0.05),
+                         "line 1\nline 2\nline 3")
+
+    def test_burst_disabled(self):
+        self.assertEqual(read_prompt(reader(["line 1", "line 2"]), 0), "line 1")
+
+    def test_explicit_block(self):
+        lines = ['"""', "first", None, "", "second", '"""', "next"]
+        self.assertEqual(read_prompt(reader(lines), 0.05), "first\n\nsecond")
+
+    def test_open_fence_waits_for_close(self):
+        lines = ["look at this:", "```python", None, "print(1)", None, "```", None, "next"]
+        self.assertEqual(read_prompt(reader(lines), 0.05), "look at this:\n```python\nprint(1)\n```")
+
+    def test_eof_inside_block_returns_what_was_read(self):
+        self.assertEqual(read_prompt(reader(['"""', "partial"]), 0.05), "partial")
+
+    def test_async_matches_sync(self):
+        for lines in (["line 1", "line 2", None], ['"""', "a", "b", '"""'], ["```", None, "x", "```", None]):
+            self.assertEqual(asyncio.run(aread_prompt(async_reader(lines), 0.05)), read_prompt(reader(lines), 0.05))
+
+    def test_has_open_fence(self):
+        self.assertTrue(has_open_fence(["```"]))
+        self.assertFalse(has_open_fence(["```", "code", "  ```"]))
+        self.assertFalse(has_open_fence(["inline ``` fence"]))
+
+    def test_options(self):
+        self.assertEqual(get_input_options({"input": {"paste_burst_seconds": 0}})["paste_burst_seconds"], 0)
+        self.assertIn("max_file_bytes", get_input_options({}))
+
+
+class FileAttachmentTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_code_block(self):
+        path = self.write("example.py", b"print('hi')\n")
+        block, truncated = load_file_attachment(path, 1000)
+        self.assertFalse(truncated)
+        self.assertEqual(block, "`example.py`:\n```py\nprint('hi')\n```")
+
+    def test_fence_is_longer_than_file_backticks(self):
+        path = self.write("notes.md", b"```\ncode\n```\n")
+        block, _ = load_file_attachment(path, 1000)
+        self.assertTrue(block.split("\n")[1].startswith("````"))
+        self.assertTrue(block.endswith("\n````"))
+
+    def test_truncates_at_line_boundary(self):
+        path = self.write("big.txt", b"first line\nsecond line\nthird line\n")
+        block, truncated = load_file_attachment(path, 15)
+        self.assertTrue(truncated)
+        self.assertIn("(truncated)", block)
+        self.assertIn("first line", block)
+        self.assertNotIn("second", block)
+
+    def test_rejects_binary_files(self):
+        path = self.write("data.bin", b"\x00\x01\x02")
+        with self.assertRaises(ValueError):
+            load_file_attachment(path, 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
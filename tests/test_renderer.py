@@ -0,0 +1,72 @@
+import hashlib
+import unittest
+from unittest import mock
+from renderer import ResponseRenderer, chunk_markdown, split_markdown_blocks
+
+try:
+    import rich.markdown
+except ImportError:
+    rich = None
+
+LARGE_RESPONSE = "intro\n\n" + "".join(f"line {i}\n" for i in range(20)) + "\n```python\nprint(1)\n```\nend\n"
+
+
+class RendererHelpersTest(unittest.TestCase):
+    def test_split_markdown_blocks(self):
+        text = "intro\n```python\nprint(1)\n```\nmiddle\n~~~\nraw ``` text\n~~~\noutro\n"
+        self.assertEqual(split_markdown_blocks(text), [
+            ("markdown", "intro\n"), ("code", ("python", "print(1)\n")), ("markdown", "middle\n"),
+            ("code", ("", "raw ``` text\n")), ("markdown", "outro\n"),
+        ])
+
+    def test_unclosed_code_block(self):
+        self.assertEqual(split_markdown_blocks("```sh\nls\n"), [("code", ("sh", "ls\n"))])
+
+    def test_chunks_end_at_blank_lines(self):
+        text = "a\nb\nc\n\nd\ne\n\nf\n"
+        chunks = list(chunk_markdown(text, 2))
+        self.assertEqual(chunks, ["a\nb\nc\n\n", "d\ne\n\n", "f\n"])
+        self.assertEqual("".join(chunks), text)
+
+
+class ResponseRendererTest(unittest.TestCase):
+    def setUp(self):
+        self.console = mock.Mock()
+        self.renderer = ResponseRenderer(self.console, {"large_response_lines": 10, "chunk_lines": 5})
+
+    def test_set_mode(self):
+        self.renderer.set_mode("raw")
+        self.assertEqual(self.renderer.mode, "raw")
+        with self.assertRaises(ValueError):
+            self.renderer.set_mode("html")
+        self.assertEqual(self.renderer.mode, "raw")
+
+    def test_is_large(self):
+        self.assertFalse(self.renderer.is_large("x\n" * 9))
+        self.assertTrue(self.renderer.is_large("x\n" * 10))
+
+    def test_raw_mode_bypasses_rich(self):
+        self.renderer.set_mode("raw")
+        with mock.patch.object(self.renderer, "write_raw") as write_raw:
+            self.renderer.render("**bold**", title="Answer")
+        write_raw.assert_called_once_with("Answer\n**bold**\n")
+        self.console.print.assert_not_called()
+
+    def test_highlighted_code_is_cached(self):
+        key = ("python", hashlib.sha1(b"print(1)").hexdigest())
+        self.renderer.code_cache[key] = "cached"
+        self.assertEqual(self.renderer.highlight("python", "print(1)"), "cached")
+
+    @unittest.skipIf(rich is None, "rendering Markdown requires rich")
+    def test_large_response_is_rendered_in_chunks(self):
+        with mock.patch.object(self.renderer, "highlight", return_value="highlighted") as highlight:
+            self.renderer.render(LARGE_RESPONSE)
+        self.console.rule.assert_called_once_with("AI Response")
+        highlight.assert_called_once_with("python", "print(1)\n")
+        printed = [c.args[0] for c in self.console.print.call_args_list]
+        self.assertIn("highlighted", printed)
+        self.assertGreater(len(printed), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
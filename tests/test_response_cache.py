@@ -0,0 +1,81 @@
+import os
+import tempfile
+import time
+import unittest
+from response_cache import ResponseCache, make_cache_key, resolve_cache_directory
+from utils import get_application_path
+
+
+def params(content, **extra):
+    return dict({"model": "o1-mini", "messages": [{"role": "user", "content": content}]}, **extra)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def cache(self, max_bytes=10000, max_age_days=None):
+        return ResponseCache(self.directory.name, max_bytes, max_age_days)
+
+    def test_cache_key_ignores_whitespace_and_stream_options(self):
+        self.assertEqual(make_cache_key(params("hi")),
+                         make_cache_key(params(" hi\r\n", stream=True, stream_options={"include_usage": True})))
+        self.assertNotEqual(make_cache_key(params("hi")), make_cache_key(params("hi", model="o1-preview")))
+        self.assertNotEqual(make_cache_key(params("hi")), make_cache_key(params("hello")))
+
+    def test_get_and_put(self):
+        cache = self.cache()
+        self.assertIsNone(cache.get("ab" * 32))
+        cache.put("ab" * 32, {"content": "answer"})
+        self.assertEqual(cache.get("ab" * 32)["content"], "answer")
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (1, 1))
+
+    def test_overwrite_counts_size_once(self):
+        cache = self.cache()
+        cache.put("ab" * 32, {"content": "x" * 100})
+        size = cache.stats()["bytes"]
+        cache.put("ab" * 32, {"content": "x" * 100})
+        self.assertEqual(cache.stats()["bytes"], size)
+        cache.put("ab" * 32, {"content": "x" * 10})
+        self.assertEqual(cache.stats()["bytes"], size - 90)
+        self.assertEqual(self.cache().stats()["bytes"], size - 90)
+
+    def test_evicts_least_recently_used(self):
+        cache = self.cache(max_bytes=500)
+        keys = [f"{i:02d}" * 32 for i in range(4)]
+        for age, key in enumerate(keys):
+            cache.put(key, {"content": "x" * 100})
+            past = time.time() - 100 + age
+            os.utime(cache._path(key), (past, past))
+        # 读取最旧的条目，使它变成最近使用
+        self.assertIsNotNone(cache.get(keys[0]))
+        cache.put("99" * 32, {"content": "x" * 100})
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertLessEqual(cache.stats()["bytes"], 500 * 0.9)
+
+    def test_expired_entries_miss(self):
+        cache = self.cache(max_age_days=1)
+        cache.put("ab" * 32, {"content": "old"})
+        past = time.time() - 2 * 86400
+        os.utime(cache._path("ab" * 32), (past, past))
+        self.assertIsNone(cache.get("ab" * 32))
+
+    def test_clear(self):
+        cache = self.cache()
+        cache.put("ab" * 32, {"content": "answer"})
+        cache.clear()
+        self.assertIsNone(cache.get("ab" * 32))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_relative_directory_is_under_application_path(self):
+        self.assertEqual(resolve_cache_directory("response_cache"),
+                         os.path.join(get_application_path(), "response_cache"))
+        self.assertEqual(resolve_cache_directory(self.directory.name), self.directory.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
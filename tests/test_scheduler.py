@@ -0,0 +1,114 @@
+import asyncio
+import unittest
+from unittest import mock
+from key_pool import current_api_key
+from scheduler import RequestScheduler, TokenBucket, get_retry_after
+
+
+class HTTPError(Exception):
+    """与 openai.APIStatusError 相同的 status_code 和 response.headers。"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = mock.Mock(headers=headers or {})
+
+
+def failing(errors, result="ok"):
+    """依次抛出 errors 中的错误，之后返回 result。"""
+    errors = list(errors)
+    calls = []
+
+    def call():
+        calls.append(current_api_key.get())
+        if errors:
+            raise errors.pop(0)
+        return result
+    return call, calls
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_reserve_and_refund(self):
+        bucket = TokenBucket(600)
+        self.assertEqual(bucket.reserve(600), 0.0)
+        self.assertAlmostEqual(bucket.reserve(60), 6.0, delta=0.1)
+        bucket.refund(60)
+        self.assertAlmostEqual(bucket.wait_time(60), 6.0, delta=0.1)
+        bucket.adjust(600)
+        self.assertEqual(bucket.wait_time(600), 0.0)
+
+    def test_refund_matches_capped_reservation(self):
+        bucket = TokenBucket(100)
+        bucket.reserve(1000)
+        bucket.refund(1000)
+        self.assertAlmostEqual(bucket.tokens, 100, delta=1)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        # 不真正等待退避时间
+        patcher = mock.patch("scheduler.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retry_after_header(self):
+        self.assertEqual(get_retry_after(HTTPError(429, {"retry-after-ms": "1500"})), 1.5)
+        self.assertEqual(get_retry_after(HTTPError(429, {"retry-after": "3"})), 3.0)
+        self.assertIsNone(get_retry_after(HTTPError(429)))
+
+    def test_retries_retryable_errors(self):
+        scheduler = RequestScheduler(max_retries=3, backoff_base=0.01)
+        retries = []
+        call, calls = failing([HTTPError(429), HTTPError(503)])
+        self.assertEqual(scheduler.run(call, 10, lambda: retries.append(1)), "ok")
+        self.assertEqual((len(calls), len(retries)), (3, 2))
+        self.assertEqual(scheduler.stats(), {"queue_depth": 0, "in_flight": 0, "retries": 2})
+
+    def test_gives_up_after_max_retries(self):
+        scheduler = RequestScheduler(max_retries=2, backoff_base=0.01)
+        call, calls = failing([HTTPError(500)] * 5)
+        with self.assertRaises(HTTPError):
+            scheduler.run(call)
+        self.assertEqual(len(calls), 3)
+
+    def test_does_not_retry_client_errors(self):
+        scheduler = RequestScheduler(max_retries=3)
+        call, calls = failing([HTTPError(400)])
+        with self.assertRaises(HTTPError):
+            scheduler.run(call)
+        self.assertEqual(len(calls), 1)
+
+    def test_failed_attempts_refund_their_reservation(self):
+        scheduler = RequestScheduler(requests_per_minute=10, tokens_per_minute=1000, max_retries=5,
+                                     backoff_base=0.01)
+        call, _ = failing([HTTPError(429, {"retry-after-ms": "0"})] * 4)
+        scheduler.run(call, 400)
+        # 只有成功的一次尝试占用配额
+        self.assertAlmostEqual(scheduler.token_bucket.tokens, 600, delta=5)
+        self.assertAlmostEqual(scheduler.request_bucket.tokens, 9, delta=0.1)
+        scheduler.settle(400, 100)
+        self.assertAlmostEqual(scheduler.token_bucket.tokens, 900, delta=5)
+
+    def test_final_failure_refunds_reservation(self):
+        scheduler = RequestScheduler(tokens_per_minute=1000)
+        call, _ = failing([HTTPError(400)])
+        with self.assertRaises(HTTPError):
+            scheduler.run(call, 400)
+        self.assertAlmostEqual(scheduler.token_bucket.tokens, 1000, delta=5)
+
+    def test_async_retries_and_refunds(self):
+        scheduler = RequestScheduler(tokens_per_minute=1000, max_retries=3, backoff_base=0.0)
+        errors = [HTTPError(502), HTTPError(502)]
+
+        async def call():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        with mock.patch("scheduler.asyncio.sleep", new=mock.AsyncMock()):
+            self.assertEqual(asyncio.run(scheduler.arun(call, 400)), "ok")
+        self.assertAlmostEqual(scheduler.token_bucket.tokens, 600, delta=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from log_writer import format_log_header
+from search_index import SNIPPET_END, SNIPPET_START, SearchIndex, parse_query
+from session_records import write_records
+
+PRICING = [0.000015, 0.0000075, 0.00006]
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_log(self, name, messages, model="o1-mini", start=datetime(2024, 6, 1, 10, 0, 0)):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(format_log_header(start, model, {"prompt_tokens": 0, "completion_tokens": 0}, PRICING))
+            for message in messages:
+                f.write(f"## {message['role'].capitalize()}\n{message['content']}\n\n")
+        write_records(path, messages)
+        return path
+
+    def test_parse_query(self):
+        terms, filters = parse_query("sqlite index role:User since:2024-01-01 limit:5")
+        self.assertEqual(terms, ["sqlite", "index"])
+        self.assertEqual(filters, {"role": "User", "since": "2024-01-01", "limit": "5"})
+
+    def test_search_after_refresh(self):
+        self.write_log("chat_20240601_100000.md", [
+            {"role": "user", "content": "How do I vacuum a sqlite database?"},
+            {"role": "assistant", "content": "Run the VACUUM statement."},
+        ])
+        index = SearchIndex(self.directory.name)
+        self.assertEqual(index.refresh(), 2)
+        results = index.search("vacuum")
+        self.assertEqual(len(results), 2)
+        self.assertEqual({result["path"] for result in results}, {"chat_20240601_100000.md"})
+        self.assertTrue(all(SNIPPET_START in result["snippet"] and SNIPPET_END in result["snippet"]
+                            for result in results))
+        self.assertEqual([result["role"] for result in index.search("vacuum role:user")], ["user"])
+        self.assertEqual(index.search("vacuum since:2025-01-01"), [])
+        self.assertEqual(index.search("role:user"), [])
+
+    def test_refresh_is_incremental(self):
+        messages = [{"role": "user", "content": "first question about pandas"}]
+        path = self.write_log("chat_20240601_100000.md", messages)
+        index = SearchIndex(self.directory.name)
+        self.assertEqual(index.refresh(), 1)
+        self.assertEqual(index.refresh(), 0)
+        messages.append({"role": "assistant", "content": "pandas answer"})
+        os.remove(path)
+        self.write_log("chat_20240601_100000.md", messages)
+        self.assertEqual(index.refresh(), 1)
+        self.assertEqual(len(index.search("pandas")), 2)
+
+    def test_add_message_and_removed_logs(self):
+        path = self.write_log("chat_20240601_100000.md", [])
+        index = SearchIndex(self.directory.name)
+        index.refresh()
+        index.add_message(path, "o1-mini", "2024-06-01", {"role": "user", "content": "streamed message"}, 0)
+        # 序号与已索引的消息数不一致时跳过
+        index.add_message(path, "o1-mini", "2024-06-01", {"role": "user", "content": "skipped message"}, 5)
+        self.assertEqual(len(index.search("streamed")), 1)
+        self.assertEqual(index.search("skipped"), [])
+        os.remove(path)
+        index.refresh()
+        self.assertEqual(index.search("streamed"), [])
+
+    def test_short_terms(self):
+        self.write_log("chat_20240601_100000.md", [{"role": "user", "content": "what is Go used for"}])
+        index = SearchIndex(self.directory.name)
+        results = index.search("go")
+        self.assertEqual(len(results), 1)
+        self.assertIn("Go", results[0]["snippet"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from unittest import mock
+from chatgpt import ChatGPT
+from context_window import ContextWindow, estimate_tokens
+from key_pool import KeyPool
+from log_writer import format_log_header
+from scheduler import RequestScheduler
+from semantic_memory import (HashingEmbedder, OpenAIEmbedder, SemanticMemory, format_memory, get_memory_options,
+                             split_chunks, text_digest)
+from session_records import write_records
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PRICING = [0.000015, 0.0000075, 0.00006]
+DATABASE = {"role": "user", "content": "How do I add an index to a PostgreSQL table to speed up queries?"}
+DATABASE_ANSWER = {"role": "assistant", "content": "Use CREATE INDEX on the PostgreSQL table columns you filter by."}
+COOKING = {"role": "user", "content": "What temperature should I bake sourdough bread at?"}
+
+
+@unittest.skipIf(numpy is None, "semantic memory requires numpy")
+class SemanticMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_log(self, name, messages):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(format_log_header(datetime(2024, 6, 1), "o1-mini", {"prompt_tokens": 0, "completion_tokens": 0},
+                                      PRICING))
+            for message in messages:
+                f.write(f"## {message['role'].capitalize()}\n{message['content']}\n\n")
+        write_records(path, messages)
+        return path
+
+    def memory(self, **options):
+        options = dict(get_memory_options({}), min_score=0.05, **options)
+        return SemanticMemory(self.directory.name, options, HashingEmbedder(options["dimensions"]))
+
+    def test_split_chunks(self):
+        self.assertEqual(split_chunks("a\n\nb", 100), ["a\n\nb"])
+        self.assertEqual(split_chunks("x" * 25, 10), ["x" * 10, "x" * 10, "x" * 5])
+        self.assertEqual(split_chunks("first paragraph\n\nsecond paragraph", 20),
+                         ["first paragraph", "second paragraph"])
+
+    def test_refresh_and_recall(self):
+        self.write_log("chat_1.md", [DATABASE, DATABASE_ANSWER])
+        self.write_log("chat_2.md", [COOKING])
+        memory = self.memory()
+        self.assertEqual(memory.refresh(), 3)
+        self.assertEqual(memory.refresh(), 0)
+        results = memory.recall("postgresql index for faster queries")
+        self.assertEqual(results[0][1]["path"], "chat_1.md")
+        self.assertNotIn("chat_2.md", [chunk["path"] for _, chunk in results])
+        excluded = memory.recall("postgresql index", exclude_digests={text_digest(DATABASE["content"])})
+        self.assertNotIn(DATABASE["content"], [chunk["text"] for _, chunk in excluded])
+
+    def test_recall_does_not_read_logs(self):
+        memory = self.memory()
+        self.write_log("chat_1.md", [DATABASE])
+        self.assertEqual(memory.recall("postgresql index"), [])
+        memory.refresh()
+        self.assertTrue(memory.recall("postgresql index"))
+
+    def test_messages_are_added_in_the_background(self):
+        path = self.write_log("chat_1.md", [DATABASE])
+        memory = self.memory()
+        memory.refresh()
+        memory.add_message(path, DATABASE_ANSWER, 1)
+        # 序号与已加入的消息数不一致时留给 refresh
+        memory.add_message(path, COOKING, 5)
+        memory.wait_idle()
+        self.assertEqual(memory.stats()["chunks"], 2)
+        self.assertEqual(memory.logs["chat_1.md"][0], 2)
+
+    def test_index_is_persisted(self):
+        self.write_log("chat_1.md", [DATABASE, DATABASE_ANSWER])
+        self.memory().refresh()
+        # 模拟 state.json 之后被中断的追加
+        with open(os.path.join(self.directory.name, "memory", "vectors.f32"), "ab") as f:
+            f.write(b"\0" * 7)
+        reloaded = self.memory()
+        self.assertEqual(reloaded.stats()["chunks"], 2)
+        self.assertEqual(reloaded.refresh(), 0)
+        self.assertTrue(reloaded.recall("postgresql index"))
+
+    def test_removed_logs_are_dropped(self):
+        path = self.write_log("chat_1.md", [DATABASE])
+        self.write_log("chat_2.md", [COOKING])
+        memory = self.memory()
+        memory.refresh()
+        os.remove(path)
+        memory.refresh()
+        self.assertEqual(memory.stats()["chunks"], 1)
+        self.assertEqual(memory.recall("postgresql index"), [])
+
+    def test_format_memory_respects_budget(self):
+        results = [(0.9, {"path": "chat_1.md", "role": "user", "text": "a" * 40}),
+                   (0.8, {"path": "chat_2.md", "role": "user", "text": "b" * 400})]
+        content, used = format_memory(results, len, 200)
+        self.assertEqual(used, 1)
+        self.assertIn("a" * 40, content)
+        self.assertEqual(format_memory([], len, 200), (None, 0))
+
+    def test_recalled_text_is_merged_into_the_user_message(self):
+        self.write_log("chat_1.md", [DATABASE, DATABASE_ANSWER])
+        memory = self.memory()
+        memory.refresh()
+        bot = ChatGPT.__new__(ChatGPT)
+        bot.config = {"output_directory": self.directory.name}
+        bot.memory_options = memory.options
+        bot.context_window = ContextWindow("o1-mini", None)
+        bot.context_window.count_text = estimate_tokens
+        messages = [{"role": "user", "content": "earlier"}, {"role": "assistant", "content": "reply"},
+                    {"role": "user", "content": "postgresql index again"}]
+        bot.context_window.select(messages)
+        with mock.patch("chatgpt.get_semantic_memory", return_value=memory):
+            request = bot.add_memory(messages)
+        self.assertEqual([m["role"] for m in request], ["user", "assistant", "user"])
+        self.assertTrue(request[-1]["content"].startswith("Relevant excerpts"))
+        self.assertTrue(request[-1]["content"].endswith("postgresql index again"))
+        self.assertEqual(messages[-1]["content"], "postgresql index again")
+        self.assertEqual(bot.context_window.last_stats["messages"], 3)
+        self.assertEqual(bot.context_window.last_stats["recalled"], 2)
+
+    def test_openai_embedder_uses_the_scheduler(self):
+        config = {"api_key": "sk-test"}
+        scheduler = RequestScheduler(key_pool=KeyPool.from_config(config))
+        client = mock.Mock(api_key="sk-test")
+        client.embeddings.create.return_value = mock.Mock(data=[mock.Mock(embedding=[3.0, 4.0])],
+                                                          usage=mock.Mock(total_tokens=5))
+        with mock.patch("scheduler.get_scheduler", return_value=scheduler), \
+                mock.patch("openai_client.get_client", return_value=client):
+            usage = []
+            vectors = OpenAIEmbedder(config, "text-embedding-3-small").embed(["hello"], usage.append)
+        self.assertAlmostEqual(float(vectors[0][0]), 0.6, places=5)
+        client.embeddings.create.assert_called_once_with(model="text-embedding-3-small", input=["hello"])
+        self.assertEqual(scheduler.key_pool.stats()[0]["requests"], 1)
+        self.assertEqual(scheduler.key_pool.stats()[0]["tokens"], 5)
+        self.assertEqual(usage, [{"prompt_tokens": 5, "cached_tokens": 0, "completion_tokens": 0, "total_tokens": 5}])
+
+    def test_embedding_usage_is_deferred_to_the_session(self):
+        self.write_log("chat_1.md", [DATABASE, DATABASE_ANSWER])
+        memory = self.memory()
+        embed = memory.embedder.embed
+
+        def embed_with_usage(texts, on_usage=None):
+            on_usage({"prompt_tokens": len(texts), "total_tokens": len(texts)})
+            return embed(texts)
+
+        memory.embedder.embed = embed_with_usage
+        bot = ChatGPT.__new__(ChatGPT)
+        bot.stats_lock = threading.Lock()
+        bot.discarded_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        memory.refresh(bot.defer_usage)
+        memory.recall("postgresql index", on_usage=bot.defer_usage)
+        memory.add_message("chat_1.md", COOKING, 2, bot.defer_usage)
+        memory.wait_idle()
+        # 两条日志消息、一次查询和一条新消息各向量化一个片段
+        self.assertEqual(bot.take_discarded_usage()["total_tokens"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
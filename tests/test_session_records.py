@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from session_records import (
+    INDEX_ENTRY, encode_record, load_records_tail, parse_markdown_log, read_records, sidecar_paths, write_records
+)
+
+MESSAGES = [
+    {"role": "user", "content": "first question"},
+    {"role": "assistant", "content": "    indented\n- list item\n## not a heading\n"},
+    {"role": "user", "content": "second question"},
+    {"role": "assistant", "content": "second answer"},
+]
+
+
+class SessionRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.directory.name, "chat_20240601_100000.md")
+        self.records_path, self.index_path = sidecar_paths(self.log_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records_round_trip(self):
+        write_records(self.log_path, MESSAGES)
+        self.assertEqual(read_records(self.log_path), MESSAGES)
+        self.assertEqual(read_records(self.log_path, 2), MESSAGES[2:])
+        self.assertEqual(os.path.getsize(self.index_path), INDEX_ENTRY.size * len(MESSAGES))
+
+    def test_missing_index_is_rebuilt(self):
+        write_records(self.log_path, MESSAGES)
+        os.remove(self.index_path)
+        self.assertEqual(read_records(self.log_path), MESSAGES)
+        self.assertEqual(os.path.getsize(self.index_path), INDEX_ENTRY.size * len(MESSAGES))
+
+    def test_stale_index_and_partial_record_are_handled(self):
+        write_records(self.log_path, MESSAGES[:2])
+        # 记录已追加但索引没有跟上，最后还有一条被中断的写入
+        with open(self.records_path, "ab") as f:
+            f.write(encode_record(MESSAGES[2]))
+            f.write(encode_record(MESSAGES[3])[:10])
+        self.assertEqual(read_records(self.log_path), MESSAGES[:3])
+        self.assertEqual(os.path.getsize(self.index_path), INDEX_ENTRY.size * 3)
+
+    def test_tail_fits_token_budget(self):
+        write_records(self.log_path, MESSAGES)
+        count = lambda message: len(message["content"])
+        messages, total = load_records_tail(self.log_path, 30, count)
+        self.assertEqual(total, 4)
+        self.assertEqual(messages, MESSAGES[2:])
+        messages, _ = load_records_tail(self.log_path)
+        self.assertEqual(messages, MESSAGES)
+
+    def test_tail_does_not_start_with_assistant(self):
+        write_records(self.log_path, MESSAGES)
+        messages, _ = load_records_tail(self.log_path, 15, lambda message: len(message["content"]))
+        self.assertEqual(messages, MESSAGES[3:])
+        self.assertEqual(load_records_tail(os.path.join(self.directory.name, "missing.md")), (None, 0))
+
+    def test_markdown_log_is_parsed_losslessly(self):
+        with open(self.log_path, "w", encoding="utf-8", newline="") as f:
+            f.write("# Chat Log - 2024-06-01 10:00:00\n**Model**: o1\n\n")
+            for message in MESSAGES:
+                f.write(f"## {message['role'].capitalize()}\n{message['content']}\n\n")
+        self.assertEqual(parse_markdown_log(self.log_path), MESSAGES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import closing
+from unittest import mock
+from session_registry import SessionRegistry, pid_alive
+
+
+def dead_pid():
+    """返回一个已经退出的进程的 PID。"""
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+class SessionRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry = SessionRegistry(os.path.join(self.directory.name, "sessions.db"), heartbeat_interval=0.05)
+
+    def tearDown(self):
+        self.registry.stop_heartbeat()
+        if self.registry.heartbeat_thread is not None:
+            self.registry.heartbeat_thread.join()
+        self.directory.cleanup()
+
+    def execute(self, sql, *args):
+        with closing(sqlite3.connect(self.registry.db_path)) as conn, conn:
+            conn.execute(sql, args)
+
+    def test_pid_alive(self):
+        self.assertTrue(pid_alive(os.getpid()))
+        self.assertFalse(pid_alive(dead_pid()))
+        self.assertFalse(pid_alive(None))
+
+    def test_upsert_list_and_remove(self):
+        self.registry.upsert("chat_1.md", "Open", "127.0.0.1:5000")
+        self.registry.upsert("chat_2.md", "Open")
+        self.registry.upsert("chat_1.md", "Busy", "127.0.0.1:5001")
+        sessions = self.registry.list()
+        self.assertEqual([s["session_name"] for s in sessions], ["chat_1.md", "chat_2.md"])
+        self.assertEqual((sessions[0]["status"], sessions[0]["address"]), ("Busy", "127.0.0.1:5001"))
+        self.assertEqual(sessions[0]["pid"], os.getpid())
+        self.registry.remove("chat_1.md")
+        self.assertEqual([s["session_name"] for s in self.registry.list()], ["chat_2.md"])
+        self.registry.clear()
+        self.assertEqual(self.registry.list(), [])
+
+    def test_rows_of_exited_processes_are_removed(self):
+        self.registry.upsert("chat_1.md", "Open")
+        self.registry.upsert("chat_2.md", "Open")
+        self.execute("UPDATE sessions SET pid = ? WHERE session_name = ?", dead_pid(), "chat_2.md")
+        self.assertEqual([s["session_name"] for s in self.registry.list()], ["chat_1.md"])
+        # 失效的记录已从表中删除，即使进程状态判断改变也不会再出现
+        with mock.patch("session_registry.pid_alive", return_value=True):
+            self.assertEqual(len(self.registry.list()), 1)
+
+    def test_stale_heartbeat_is_removed(self):
+        self.registry.upsert("chat_1.md", "Open")
+        self.execute("UPDATE sessions SET heartbeat = ?", time.time() - 60)
+        self.assertEqual(self.registry.list(), [])
+
+    def test_heartbeat_refreshes_own_sessions(self):
+        self.registry.upsert("chat_1.md", "Open")
+        self.execute("UPDATE sessions SET heartbeat = ?", time.time() - 60)
+        self.registry.heartbeat()
+        self.assertEqual([s["session_name"] for s in self.registry.list()], ["chat_1.md"])
+
+    def test_heartbeat_thread_starts_once(self):
+        self.registry.start_heartbeat()
+        thread = self.registry.heartbeat_thread
+        self.registry.start_heartbeat()
+        self.assertIs(self.registry.heartbeat_thread, thread)
+        self.assertTrue(thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from log_writer import format_log_header
+from usage_ledger import UsageLedger, parse_log_header
+from utils import calculate_total_cost
+
+PRICING = [0.000015, 0.0000075, 0.00006]
+
+
+def write_log(directory, name, started, model, prompt_tokens, completion_tokens, cached_tokens=0):
+    usage = {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "completion_tokens": completion_tokens}
+    path = os.path.join(directory, name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(format_log_header(started, model, usage, PRICING) + "## User\nhi\n\n")
+    return path
+
+
+class UsageLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.logs = self.directory.name
+        write_log(self.logs, "chat_20240601_100000.md", datetime(2024, 6, 1, 10), "o1-preview", 100, 50, 40)
+        write_log(self.logs, "chat_20240601_120000.md", datetime(2024, 6, 1, 12), "o1-mini", 10, 5)
+        write_log(self.logs, "chat_20240602_090000.md", datetime(2024, 6, 2, 9), "o1-preview", 1, 2)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_parse_log_header(self):
+        with open(os.path.join(self.logs, "chat_20240601_100000.md"), "rb") as f:
+            stats = parse_log_header(f.read())
+        self.assertEqual(stats["day"], "2024-06-01")
+        self.assertEqual(stats["model"], "o1-preview")
+        self.assertEqual((stats["input_tokens"], stats["cached_tokens"], stats["output_tokens"]), (100, 40, 50))
+
+    def test_refresh_only_parses_changed_logs(self):
+        ledger = UsageLedger(self.logs)
+        self.assertEqual(ledger.refresh(), 3)
+        self.assertEqual(ledger.refresh(), 0)
+        write_log(self.logs, "chat_20240602_090000.md", datetime(2024, 6, 2, 9), "o1-preview", 1000, 2)
+        self.assertEqual(ledger.refresh(), 1)
+        totals = ledger.totals()
+        self.assertEqual(totals["total_input_tokens"], 1110)
+        self.assertEqual(totals["file_count"], 3)
+
+    def test_deleted_logs_are_removed(self):
+        ledger = UsageLedger(self.logs)
+        ledger.refresh()
+        os.remove(os.path.join(self.logs, "chat_20240601_120000.md"))
+        ledger.refresh()
+        self.assertEqual(ledger.totals()["total_output_tokens"], 52)
+
+    def test_groups(self):
+        ledger = UsageLedger(self.logs)
+        ledger.refresh()
+        by_day = ledger.totals("day")
+        self.assertEqual([group["day"] for group in by_day], ["2024-06-01", "2024-06-02"])
+        self.assertEqual(by_day[0]["file_count"], 2)
+        by_model = {group["model"]: group for group in ledger.totals("model")}
+        self.assertEqual(by_model["o1-preview"]["total_input_tokens"], 101)
+        with self.assertRaises(ValueError):
+            ledger.totals("week")
+
+    def test_missing_directory_has_empty_groups(self):
+        missing = os.path.join(self.logs, "missing")
+        self.assertEqual(calculate_total_cost(missing, "day")["groups"], [])
+        self.assertNotIn("groups", calculate_total_cost(missing))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import os
+import re
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+LEDGER_FILE = "usage_ledger.db"
+# 日志头部只有几百字节，读取开头这一段就足够解析
+HEADER_READ_SIZE = 4096
+GROUP_COLUMNS = {"day": "day", "model": "model"}
+_FILE_DATE_PATTERN = re.compile(r"chat_(\d{4})(\d{2})(\d{2})")
+
+
+def parse_log_header(raw_data):
+    """解析日志头部中的模型、日期和 Token 统计。
+
+    Args:
+        raw_data (bytes): 日志文件开头的原始字节。
+
+    Returns:
+        dict: 包含 started_at, day, model, input_tokens, cached_tokens, output_tokens, cost 的字典。
+    """
+    try:
+        content = raw_data.decode("utf-8")
+    except UnicodeDecodeError:
+        # 只有非 UTF-8 的旧日志才需要检测编码
+        from charset_normalizer import detect
+        content = raw_data.decode(detect(raw_data)["encoding"] or "utf-8", errors="replace")
+
+    stats = {"started_at": None, "day": None, "model": None, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost": 0.0}
+    for line in content.splitlines():
+        if line.startswith("## "):
+            # 到达消息部分，头部结束
+            break
+        if line.startswith("# Chat Log - "):
+            stats["started_at"] = line[len("# Chat Log - "):].strip()
+            stats["day"] = stats["started_at"][:10]
+        elif line.startswith("**Model**:"):
+            stats["model"] = line.split(":", 1)[1].strip()
+        elif line.startswith("**Cost**: $"):
+            stats["cost"] = float(line.split("$")[1])
+        elif line.startswith("- Input Tokens:"):
+            stats["input_tokens"] = int(line.split(":")[-1].strip())
+        elif line.startswith("- Cached Tokens:"):
+            stats["cached_tokens"] = int(line.split(":")[-1].strip())
+        elif line.startswith("- Output Tokens:"):
+            stats["output_tokens"] = int(line.split(":")[-1].strip())
+    return stats
+
+
+class UsageLedger:
+    """持久化的 Token 使用台账。
+
+    以 (路径, 大小, 修改时间) 为键缓存每个日志文件的统计结果，
+    刷新时只重新解析新增或发生变化的日志，汇总直接由 SQLite 完成。
+    """
+
+    def __init__(self, log_directory, ledger_path=None):
+        self.log_directory = log_directory
+        self.ledger_path = ledger_path or os.path.join(log_directory, LEDGER_FILE)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS log_usage ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, day TEXT, model TEXT, "
+                "input_tokens INTEGER, cached_tokens INTEGER, output_tokens INTEGER, cost REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.ledger_path, timeout=10)
+
+    def refresh(self):
+        """扫描日志目录和归档清单，重新解析新增或已修改的日志，并删除已不存在的记录。
+
+        Returns:
+            int: 本次重新解析的文件数量。
+        """
+        with closing(self._connect()) as conn, conn:
+            known = {
+                path: (size, mtime_ns)
+                for path, size, mtime_ns in conn.execute("SELECT path, size, mtime_ns FROM log_usage")
+            }
+            seen = set()
+            changed = []
+            with os.scandir(self.log_directory) as entries:
+                for entry in entries:
+                    if not entry.is_file() or not entry.name.endswith(".md"):
+                        continue
+                    stat = entry.stat()
+                    seen.add(entry.name)
+                    if known.get(entry.name) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    try:
+                        with open(entry.path, "rb") as f:
+                            stats = parse_log_header(f.read(HEADER_READ_SIZE))
+                    except Exception as e:
+                        print(f"Error reading file {entry.name}: {e}")
+                        continue
+                    if not stats["day"]:
+                        stats["day"] = self._fallback_day(entry.name, stat.st_mtime)
+                    changed.append((
+                        entry.name, stat.st_size, stat.st_mtime_ns, stats["day"], stats["model"],
+                        stats["input_tokens"], stats["cached_tokens"], stats["output_tokens"], stats["cost"]
+                    ))
+            # 归档日志的统计直接取自归档清单，修改时间记为 -1
+            from log_archive import load_manifest
+            for name, entry in load_manifest(self.log_directory).items():
+                if name in seen:
+                    continue
+                seen.add(name)
+                if known.get(name) != (entry["size"], -1):
+                    changed.append((
+                        name, entry["size"], -1, entry["day"] or self._fallback_day(name, 0), entry["model"],
+                        entry["input_tokens"], entry["cached_tokens"], entry["output_tokens"], entry["cost"]
+                    ))
+            conn.executemany("INSERT OR REPLACE INTO log_usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", changed)
+            removed = [(path,) for path in known if path not in seen]
+            conn.executemany("DELETE FROM log_usage WHERE path = ?", removed)
+        return len(changed)
+
+    @staticmethod
+    def _fallback_day(file_name, mtime):
+        match = _FILE_DATE_PATTERN.match(file_name)
+        if match:
+            return "-".join(match.groups())
+        return datetime.fromtimestamp(mtime).strftime("%Y-%m-%d")
+
+    def totals(self, group_by=None):
+        """返回总计或按天/模型分组的统计。
+
+        Args:
+            group_by (str): None、"day" 或 "model"。
+
+        Returns:
+            dict | list: 不分组时返回总计字典，分组时返回每组一个字典的列表。
+        """
+        columns = ("SUM(input_tokens), SUM(cached_tokens), SUM(output_tokens), SUM(cost), COUNT(*)")
+        with closing(self._connect()) as conn:
+            if group_by is None:
+                row = conn.execute(f"SELECT {columns} FROM log_usage").fetchone()
+                return self._row_to_totals(row)
+            if group_by not in GROUP_COLUMNS:
+                raise ValueError(f"Unknown group: {group_by}")
+            column = GROUP_COLUMNS[group_by]
+            rows = conn.execute(
+                f"SELECT {column}, {columns} FROM log_usage GROUP BY {column} ORDER BY {column}"
+            ).fetchall()
+        groups = []
+        for row in rows:
+            totals = self._row_to_totals(row[1:])
+            totals[group_by] = row[0] or "unknown"
+            groups.append(totals)
+        return groups
+
+    @staticmethod
+    def _row_to_totals(row):
+        input_tokens, cached_tokens, output_tokens, cost, file_count = row
+        return {
+            "total_cost": cost or 0.0,
+            "total_input_tokens": input_tokens or 0,
+            "total_cached_tokens": cached_tokens or 0,
+            "total_output_tokens": output_tokens or 0,
+            "file_count": file_count or 0,
+        }
@@ -1,13 +1,13 @@
 import os
 import json
 from datetime import datetime
-from charset_normalizer import detect
 import threading
 import sys
 
-# 获取程序所在目录的绝对路径
-SESSIONS_FILE = "sessions.json"
-sessions_file_lock = threading.Lock()
+# 会话登记表，位于程序所在目录下
+SESSIONS_FILE = "sessions.db"
+_session_registry = None
+session_registry_lock = threading.Lock()
 
 def load_config(file_path="config.json"):
     """加载配置文件。"""
@@ -42,13 +42,19 @@ def calculate_cost(token_usage, pricing):
         cached_tokens = token_usage_dict["cached_tokens"]
     output_tokens = token_usage_dict["completion_tokens"]
 
-    price = input_tokens * pricing[0] + \
+    # prompt_tokens 已包含命中缓存的部分，缓存部分按缓存价格计费
+    price = max(input_tokens - cached_tokens, 0) * pricing[0] + \
             cached_tokens * pricing[1] + \
             output_tokens * pricing[2]
 
     return price
 
 
+def cache_hit_ratio(cached_tokens, prompt_tokens):
+    """计算输入 Token 中命中服务端前缀缓存的比例。"""
+    return cached_tokens / prompt_tokens if prompt_tokens else 0.0
+
+
 def format_markdown(messages, model, token_usage, cost):
     """格式化 Markdown 聊天记录。
 
@@ -82,73 +88,55 @@ def format_markdown(messages, model, token_usage, cost):
     return chat_content
 
 
-def calculate_total_cost(log_directory="chat_logs"):
+def get_application_path():
+    """获取程序所在目录的绝对路径（兼容打包后的可执行文件）。"""
+    if getattr(sys, 'frozen', False):
+        # 程序被打包
+        return os.path.dirname(sys.executable)
+    # 未打包，直接使用脚本路径
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def get_log_directory(config):
+    """程序所在目录下的日志目录。"""
+    return os.path.join(get_application_path(), config["output_directory"])
+
+
+def calculate_total_cost(log_directory="chat_logs", group_by=None):
     """统计所有日志文件中总消耗的钱和 Token 数量。
 
+    结果来自持久化的使用台账，只有新增或修改过的日志才会被重新解析。
+
     Args:
         log_directory (str): 保存日志文件的目录路径。
+        group_by (str): 可选 "day" 或 "model"，按天或模型分组统计。
 
     Returns:
-        dict: 包含总成本和 Token 消耗统计的字典。
+        dict: 包含总成本和 Token 消耗统计的字典；分组时 "groups" 中包含每组的统计。
     """
-    # 确保 log_directory 是程序所在目录下的子文件夹
-    application_path = ""
-    if not getattr(sys, 'frozen', False):
-        # 未打包，直接使用脚本路径
-        application_path = os.path.dirname(os.path.abspath(__file__))
-    else:
-        # 程序被打包
-        application_path = os.path.dirname(sys.executable)
-    log_directory = application_path +"\\" + log_directory
+    from usage_ledger import UsageLedger
 
-    total_cost = 0.0
-    total_input_tokens = 0
-    total_cached_tokens = 0
-    total_output_tokens = 0
+    # 确保 log_directory 是程序所在目录下的子文件夹
+    log_directory = os.path.join(get_application_path(), log_directory)
 
     if not os.path.exists(log_directory):
         print(f"No logs found in the directory: {log_directory}")
-        return {
-            "total_cost": total_cost,
-            "total_input_tokens": total_input_tokens,
-            "total_cached_tokens": total_cached_tokens,
-            "total_output_tokens": total_output_tokens,
+        total_stats = {
+            "total_cost": 0.0,
+            "total_input_tokens": 0,
+            "total_cached_tokens": 0,
+            "total_output_tokens": 0,
         }
+        if group_by:
+            total_stats["groups"] = []
+        return total_stats
 
-    print("Calculating total cost and token usage from log files...\n")
-    for log_file in os.listdir(log_directory):
-        log_path = os.path.join(log_directory, log_file)
-        if os.path.isfile(log_path) and log_file.endswith(".md"):
-            try:
-                with open(log_path, "rb") as f:
-                    raw_data = f.read()
-                    result = detect(raw_data)
-                    encoding = result['encoding']  # 自动检测文件编码
-                    content = raw_data.decode(encoding)
-
-                    # 提取 Token 和成本信息
-                    for line in content.splitlines():
-                        if line.startswith("**Cost**: $"):
-                            cost_value = float(line.split("$")[1])
-                            print(f"File: {log_file}, Cost: ${cost_value:.6f}")
-                            total_cost += cost_value
-                        elif line.startswith("- Input Tokens:"):
-                            total_input_tokens += int(line.split(":")[-1].strip())
-                        elif line.startswith("- Cached Tokens:"):
-                            total_cached_tokens += int(line.split(":")[-1].strip())
-                        elif line.startswith("- Output Tokens:"):
-                            total_output_tokens += int(line.split(":")[-1].strip())
-
-            except Exception as e:
-                print(f"Error reading file {log_file}: {e}")
-
-    return {
-        "total_cost": total_cost,
-        "total_input_tokens": total_input_tokens,
-        "total_cached_tokens": total_cached_tokens,
-        "total_output_tokens": total_output_tokens,
-    }
-
+    ledger = UsageLedger(log_directory)
+    ledger.refresh()
+    total_stats = ledger.totals()
+    if group_by:
+        total_stats["groups"] = ledger.totals(group_by)
+    return total_stats
 
 
 def list_log_files(directory):
@@ -159,106 +147,73 @@ def list_log_files(directory):
     ]
 
 
-def load_chat_history(file_path, token_usage):
-    """如果在名字末尾没有添加上.md那么添加"""
+def resolve_log_path(file_path):
+    """补全 .md 扩展名，并转换为相对于程序所在目录的路径。"""
     if not file_path.endswith(".md"):
         file_path += ".md"
+    return os.path.join(os.path.dirname(__file__), "", file_path)
+
+
+def load_chat_history(file_path, token_usage, token_budget=None, count_tokens=None):
+    """加载聊天历史记录，原日志文件保留不动（已归档的日志会先恢复到日志目录）。
 
-    """给file_path添加相对路径到程序所在目录下的chat_logs"""
-    file_path = os.path.join(os.path.dirname(__file__), "", file_path)
+    优先从结构化记录（.jsonl + .idx）中只加载能放进上下文预算的最近消息；
+    旧日志没有结构化记录时无损解析 Markdown，并生成结构化记录供下次使用。
 
-    """加载聊天历史记录。"""
+    Args:
+        file_path (str): 日志路径（可以省略 .md）。
+        token_usage (dict): 累加日志头部记录的 Token 使用量。
+        token_budget (int): 上下文 Token 预算，为 None 时加载全部消息。
+        count_tokens (callable): 计算单条消息 Token 数的函数。
+
+    Returns:
+        tuple: (消息列表, 日志头部信息)。
+    """
+    from usage_ledger import HEADER_READ_SIZE, parse_log_header
+    from session_records import load_records_tail, parse_markdown_log, write_records
+    from log_archive import restore_log
+
+    file_path = resolve_log_path(file_path)
     if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File {file_path} does not exist.")
-
-    history = []
-    current_role = None
-    current_content = []
-
-    with open(file_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-
-            # 检测新角色标志
-            if line.startswith("## "):
-                # 保存当前角色的内容
-                if current_role and current_content:
-                    history.append({"role": current_role.lower(), "content": "\n".join(current_content)})
-                # 更新角色
-                current_role = line[3:].strip()  # 去掉 "## "
-                current_content = []
-                continue  # 跳过后续检查，直接进入下一行
-
-            total_token_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
-            # 检测历史token消耗
-            if line.startswith("- Input Tokens: "):
-                token_usage["prompt_tokens"] += int(line.split(":")[-1].strip())
-                continue
-
-            if line.startswith("- Cached Tokens: "):
-                token_usage["cached_tokens"] += int(line.split(":")[-1].strip())
-                continue
-
-            if line.startswith("- Output Tokens: "):
-                token_usage["completion_tokens"] += int(line.split(":")[-1].strip())
-                continue
-
-            # 跳过统计信息和空行
-            if not line or line.startswith("#") or line.startswith("**") or line.startswith("-"):
-                continue
-
-            # 累积当前角色的内容
-            current_content.append(line)
-
-        # 保存最后一个角色的内容
-        if current_role and current_content:
-            history.append({"role": current_role.lower(), "content": "\n".join(current_content)})
-
-    """删除掉旧的文件"""
-    os.remove(file_path)
-
-    return history
-
-def add_session_to_file(session_name, status):
-    with sessions_file_lock:
-        if os.path.exists(SESSIONS_FILE):
-            with open(SESSIONS_FILE, 'r') as f:
-                sessions = json.load(f)
-        else:
-            sessions = []
-        # 检查会话是否已经存在
-        for session in sessions:
-            if session['session_name'] == session_name:
-                session['status'] = status
-                break
-        else:
-            # 新的会话
-            sessions.append({'session_name': session_name, 'status': status})
-        with open(SESSIONS_FILE, 'w') as f:
-            json.dump(sessions, f)
+        # 已归档的日志先解压回日志目录，之后的对话继续追加到原文件
+        if not restore_log(os.path.dirname(file_path), os.path.basename(file_path)):
+            raise FileNotFoundError(f"File {file_path} does not exist.")
+
+    with open(file_path, "rb") as f:
+        header = parse_log_header(f.read(HEADER_READ_SIZE))
+    token_usage["prompt_tokens"] += header["input_tokens"]
+    token_usage["cached_tokens"] += header["cached_tokens"]
+    token_usage["completion_tokens"] += header["output_tokens"]
+
+    history, _ = load_records_tail(file_path, token_budget, count_tokens)
+    if history is None:
+        history = parse_markdown_log(file_path)
+        if history:
+            write_records(file_path, history)
+    return history, header
+
+
+def get_session_registry():
+    """获取程序目录下的跨进程会话登记表（所有进程使用同一路径）。"""
+    global _session_registry
+    from session_registry import SessionRegistry
+    with session_registry_lock:
+        if _session_registry is None:
+            _session_registry = SessionRegistry(os.path.join(get_application_path(), SESSIONS_FILE))
+        return _session_registry
+
+
+def add_session_to_file(session_name, status, address=None):
+    """登记或更新一个会话（address 为本进程控制通道的地址），并启动本进程的心跳。"""
+    registry = get_session_registry()
+    registry.upsert(session_name, status, address)
+    registry.start_heartbeat()
+
 
 def remove_session_from_file(session_name):
-    with sessions_file_lock:
-        if getattr(sys, 'frozen', False):
-            # 程序被打包
-            application_path = os.path.dirname(sys.executable)
-        else:
-            # 未打包，直接使用脚本路径
-            application_path = os.path.dirname(os.path.abspath(__file__))
-        session_path = application_path + "\\" + SESSIONS_FILE
-        if not os.path.exists(session_path):
-            return
-        with open(session_path, 'r') as f:
-            sessions = json.load(f)
-        sessions = [s for s in sessions if s['session_name'] != session_name]
-        with open(session_path, 'w') as f:
-            json.dump(sessions, f)
+    get_session_registry().remove(session_name)
 
-def get_all_sessions_from_file():
-    with sessions_file_lock:
-        if not os.path.exists(SESSIONS_FILE):
-            return []
-        with open(SESSIONS_FILE, 'r') as f:
-            sessions = json.load(f)
-        return sessions
 
+def get_all_sessions_from_file():
+    """列出所有仍在运行的会话（自动清理已退出进程留下的记录）。"""
+    return get_session_registry().list()